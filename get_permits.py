@@ -6,78 +6,61 @@ Example Use:
 python permits.py --update
 python permits.py 2017
 python permits.py 2017 --county
+python permits.py --delta
 python permits.py --report
 """
 import argparse
 import os
-import time
 import sys
 from datetime import datetime as dt
 
-from selenium import webdriver
-# from selenium.webdriver.common.keys import Keys
+import dslw
+
+from tools import permit_tables
+from tools import reportserver
 
 CURRENT_YEAR = dt.now().year
 
+DB = "permits.sqlite"
+
 start_fmt = "01/01/{}"
 end_fmt = "12/31/{}"
 
-elements = {
-    "start": "ReportViewerControl$ctl04$ctl03$txtValue",
-    "end": "ReportViewerControl$ctl04$ctl05$txtValue",
-    "submit": "ReportViewerControl$ctl04$ctl00",
-    "save_as": "ReportViewerControl_ctl05_ctl04_ctl00_ButtonImg",
-    "excel": '//*[@title="Excel"]'
-    }
-
-# Rename to download_permit_data
-def get_permits(report_name, out, from_date, to_date):
-    """Retrieves permit data from report generator."""
-    try:
-        driver_exe = os.environ["chromedriver"]
-    except:
-        print("This utility requires Google Chrome")
-        print("It also needs a environment variable 'chromedriver'\n"
-              "that is set to the location of chromedriver.exe")
-        sys.exit(1)
-    
-    profile = webdriver.ChromeOptions()
-    profile.add_argument("--disable-gpu")
-    profile.add_experimental_option(
-        "prefs", {"download.default_directory": out})
-
-    driver = webdriver.Chrome(driver_exe, chrome_options=profile)
-
-    url = ("http://cpdbprod/ReportServer/Pages/ReportViewer.aspx"
-           "?%2fLand%2fStatistics%2fNew+Construction+Report&rs:"
-           "Command=Render")
-    driver.get(url)
-
-    # Collect web elements (i.e. date inputs and submit button)
-    from_date_elem = driver.find_element_by_name(elements["start"])
-    to_date_elem = driver.find_element_by_name(elements["end"])
-    view_report_elem = driver.find_element_by_name(elements["submit"])
-
-    # Enter dates
-    from_date_elem.clear()
-    from_date_elem.send_keys(from_date)
-    to_date_elem.clear()
-    to_date_elem.send_keys(to_date)
-
-    # Submit
-    view_report_elem.click()
-    time.sleep(1)
-
-    # Download
-    save_as_elem = driver.find_element_by_id(elements["save_as"])
-    save_as_elem.click()
 
-    excel_elem = save_as_elem.find_element_by_xpath(elements["excel"])
-    excel_elem.click()
-    time.sleep(3)
-
-    # TODO: rename
-    return
+def download_permit_data(year, date_to=None, client=None):
+    """Downloads a year (or through date_to, 'mm/dd/yyyy') of city permits
+    from the report server to data/city_permits/raw/city_<year>.xlsx."""
+    if date_to is None:
+        date_to = end_fmt.format(year)
+    own_client = client is None
+    if own_client:
+        client = reportserver.ReportClient()
+    try:
+        out = client.download_permits(start_fmt.format(year), date_to)
+    finally:
+        if own_client:
+            client.close()
+    return out
+
+
+def download_delta(year=CURRENT_YEAR, date_to=None, client=None):
+    """Downloads only the city permits issued since the latest one loaded in
+    city_res<year> and merges them into the year's raw report (.xlsx, .csv,
+    or .xml). Falls back to the whole year when there's nothing to start
+    from."""
+    raw = reportserver.raw_report(year)
+    last = None
+    if os.path.exists(DB) and raw is not None:
+        conn = dslw.SpatialDB(DB, verbose=False)
+        last = permit_tables.last_issued(conn.cursor(),
+                                         "city_res{}".format(year))
+        conn.close()
+    if last is None:
+        return download_permit_data(year, date_to, client)
+    out, n = reportserver.download_delta(year, last, date_to, client=client)
+    print("{} permit rows since {:%m/%d/%Y} (less {} days)".format(
+        n, last, reportserver.OVERLAP_DAYS))
+    return out
 
 
 def reset_db(*args):
@@ -89,9 +72,6 @@ def update(*args):
 def report():
     pass
 
-def download_permit_data(*args):
-    pass
-
 def process_permit_data(*args):
     pass
 
@@ -126,6 +106,17 @@ if __name__ == "__main__":
                         default=CURRENT_YEAR, help="End year")
     parser.add_argument("--date", action="store", dest="date_to",
                         type=str, help="Specific date end")
+    parser.add_argument("--months", action="store", dest="months",
+                        type=int, default=1,
+                        help="Months per download chunk (with --range)")
+    parser.add_argument("--processes", action="store", dest="processes",
+                        type=int, default=reportserver.PROCESSES,
+                        help="Chunks to download at once (with --range)")
+
+    parser.add_argument("--delta", action="store_true", default=False,
+                        dest="delta",
+                        help="Download only the permits issued since the "
+                        "last build (of year)")
 
     # Less often used
     parser.add_argument("--reset", action="store_true", default=False,
@@ -156,14 +147,29 @@ if __name__ == "__main__":
                                int(args.date_to.split("/")[-1])))
         else:
             years = list(range(args.yr_from, args.yr_to + 1))
-        for year in years:
-            download_permit_data(year)
-            process_permit_data(year)
-            print(start_fmt.format(year), end_fmt.format(year))
         if args.date_to:
-            download_permit_data(args.yr_to, args.date_to)
-            process_permit_data(args.yr_to, args.date_to)
-            print(start_fmt.format(args.yr_to), args.date_to)
+            years.append(args.yr_to)
+
+        def show(chunk):
+            print("  downloaded {:%m/%d/%Y} - {:%m/%d/%Y}".format(*chunk))
+
+        # Month chunks, several at a time; rerun to resume after a failure
+        reportserver.download_years(years, args.date_to, args.months,
+                                    args.processes, callback=show)
+        for year in years:
+            if year == args.yr_to and args.date_to:
+                process_permit_data(year, args.date_to)
+                print(start_fmt.format(year), args.date_to)
+            else:
+                process_permit_data(year)
+                print(start_fmt.format(year), end_fmt.format(year))
+        sys.exit(0)
+
+    # Only what's new since the last build, e.g. weekly
+    elif args.delta:
+        year = int(args.year)
+        download_delta(year, args.date_to)
+        process_permit_data(year, args.date_to)
         sys.exit(0)
 
     # Process County data differently
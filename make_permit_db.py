@@ -14,6 +14,7 @@ See the documentation for more information.
 
 __version__ = '0.4'
 
+import argparse
 import os
 import re
 import sys
@@ -24,8 +25,24 @@ import pandas as pd
 import dslw
 from aside import status, handle_ex
 
+try:
+    from tools import engine
+except ImportError:
+    # Shapely 2/numpy aren't installed; only the SQL scripts can be used
+    engine = None
+
+from tools import buildlog
 from tools import data
+from tools import geomstore
+from tools import parallel
+from tools import permit_tables
+from tools import pipeline
 from tools import process
+from tools import qa
+from tools import snapshot
+from tools import sqlscript
+from tools import statements
+from tools import tuning
 
 
 # =============================================================================
@@ -41,187 +58,492 @@ FEATURES_DB = os.path.abspath(
 
 PERMIT_TABLES = []
 
-CITY_REPORTS = [os.path.abspath(f) for f in
-                glob("data/city_permits/raw/*.xlsx")]
-CNTY_REPORTS = [os.path.abspath(f) for f in
-                glob("data/county_permits/raw/*.xlsx")]
+# Exported as .xlsx, .csv, or .xml
+CITY_REPORTS = sorted(os.path.abspath(f) for ext in process.REPORT_EXTS
+                      for f in glob("data/city_permits/raw/*" + ext))
+CNTY_REPORTS = sorted(os.path.abspath(f) for ext in process.REPORT_EXTS
+                      for f in glob("data/county_permits/raw/*" + ext))
+
+# Changes to these reprocess every report
+PROCESS_INPUTS = ["tools/process.py", process.REPORT_FORMATS]
+
+SPATIALIZE_SQL = "tools/spatialize.sql"
+DENSITY_SQL = "tools/density.sql"
+OVERRIDES = "data/overrides.txt"
+
+
+# Spatialize/density engines; the in-memory engine is used when available
+ENGINES = ["shapely", "sql"] if engine else ["sql"]
 
 
 # =============================================================================
 # UTILITIES
 
+def report_year(rpt_path):
+    """Gets the year from a report's filename."""
+    return re.findall("\d+", os.path.basename(rpt_path))[0]
 
-def main():
-    # Setup db
-    status.write("Making/connecting to database...")
-    conn = dslw.SpatialDB(DB, verbose=False)
+
+def density_year(table):
+    """Returns the suffix of a permit table's density tables,
+    e.g. 'density2015' for city_res2015 and 'density2015_cnty' for
+    cnty_res2015."""
+    year = table.split("res")[1]
+    if "cnty" in table:
+        year = str(year) + "_cnty"
+    return year
+
+
+def features_source():
+    """Fingerprint of the permit_features database (too big to hash)."""
+    info = os.stat(FEATURES_DB)
+    return "{}:{}".format(info.st_mtime, info.st_size)
+
+
+def make_pipeline(conn, append=False, parallel_spatialize=False,
+                  engine_name=ENGINES[0], fast_build=False,
+                  attach_features=False, explain=False, chunk_rows=None):
+    """Declares the build stages and what they depend on (see main() for the
+    options and tools/pipeline.py for how stale stages are found)."""
     cur = conn.cursor()
+    build = pipeline.Pipeline(conn)
     TABLES = conn.get_tables()
-    status.success()
+    # The Shapely engine reads the features into memory when it's first used
+    engines = {}
 
-    # =========================================================================
-    # PROCESS CITY
-    print("Processing City permits...")
-    for rpt_path in CITY_REPORTS:
-        rpt_name = os.path.basename(rpt_path)
-        status.write("  {}...".format(rpt_name))
-        # Get year from filename
-        year = re.findall("\d+", rpt_name)[0]
-        process.city_permits(rpt_path)
-        # Find processed output
-        csv_rpt = os.path.abspath(
-            "data/city_permits/processed/city_res{}.csv".format(year))
-        name = os.path.basename(csv_rpt).split(".")[0]
-        # Load csv into SQLite db if it's not there already
-        if name not in TABLES:
-            dslw.csv2lite(conn, csv_rpt)
-            # Add a 'notes' column
-            cur.execute("ALTER TABLE {} ADD COLUMN notes TEXT".format(name))
-            status.success()
-        else:
-            status.custom("[SKIP]", "yellow")
+    def get_engine():
+        if engine_name != "shapely":
+            return None
+        if not engines:
+            engines["shapely"] = engine.SpatialEngine(conn)
+        return engines["shapely"]
+
+    def run_sql(script, name, *args):
+        # Time each statement; the reports go with the run's profiles
+        results = sqlscript.run_script(conn, script, *args, explain=explain)
+        if build.report_dir:
+            sqlscript.write_report(
+                results, os.path.join(build.report_dir, name + ".txt"),
+                "{} {}".format(script, " ".join(args)))
+        return
 
     # =========================================================================
-    # PROCESS COUNTY
-    print("Processing County permits...")
-    for rpt_path in CNTY_REPORTS:
-        rpt_name = os.path.basename(rpt_path)
-        status.write("  {}...".format(rpt_name))
-        # Handle the 2015 Odyssey switch
-        out = "data/county_permits/processed/cnty_res2015.csv"
-        if "2015" in rpt_name:
-            if not glob(out):
-                process.combine_odyssey(
-                    *[i for i in CNTY_REPORTS if "2015" in i])
-            year = "2015"
-        else:
-            # Get year from filename
-            year = re.findall("\d+", rpt_name)[0]
-            # PROCESS as normal
-            process.county_permits(rpt_path)
-        # Find processed output
-        csv_rpt = os.path.abspath(
-            "data/county_permits/processed/cnty_res{}.csv".format(year))
-        name = os.path.basename(csv_rpt).split(".")[0]
-        # Load csv into SQLite db if it's not there already
-        if name not in TABLES:
+    # PROCESS CITY/COUNTY
+    # Processing doesn't touch the database, so reports are processed in
+    #  parallel; each processed csv is then loaded into its own table
+    def load_permits(table, csv_rpt, rebuild=False):
+        tables = conn.get_tables()
+        if table in tables and append:
+            status.write("    appending to {}...".format(table))
+            status.custom("[+{}]".format(
+                permit_tables.append_permits(conn, table, csv_rpt)), "green")
+            return
+        if table in tables and not rebuild:
+            return
+        with tuning.stage_transaction(cur, fast_build):
+            if table in tables:
+                # The report changed; replace the table
+                if "geometry" in permit_tables.get_columns(cur, table):
+                    cur.execute("SELECT DropGeoTable(?);", (table,))
+                else:
+                    statements.execute(conn, "DROP TABLE {table};",
+                                       table=table)
             dslw.csv2lite(conn, csv_rpt)
             # Add a 'notes' column, quitely pass if exists
             try:
-                cur.execute(
-                    "ALTER TABLE {} ADD COLUMN notes TEXT".format(name))
+                statements.execute(conn, "ALTER TABLE {table} ADD COLUMN "
+                                   "notes TEXT", table=table)
             except dslw.apsw.SQLError:
                 pass
-            status.success()
-        else:
-            status.custom("[SKIP]", "yellow")
+        return
 
-    # =========================================================================
-    # BACKUP PERMIT TABLES
-    print("Backing up permit tables...")
-    # Get list of PERMIT_TABLES
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    all_ptables = [t[0] for t in cur.fetchall() if "res" in t[0]]
-    # Send the permit tables to the global variable declared earlier
-    PERMIT_TABLES.extend([t for t in all_ptables if "_bk" not in t])
-    
-    for table in PERMIT_TABLES:
-        status.write("  {}...".format(table))
-        if "{}_bk".format(table) not in all_ptables:
-            cur.execute("SELECT CloneTable('main', '{0}', '{0}_bk', 1)".format(
-                table))
-            status.success()
-        else:
-            status.custom("[SKIP]", "yellow")
+    # (process stage name, function, args, inputs, [(table, csv), ...])
+    reports = []
+    # A multi-year export is processed once and split into its years; each
+    #  year comes from one report even if several cover it
+    for rpt_path, years in process.report_owners(CITY_REPORTS):
+        tables = [("city_res" + year, process.CITY_OUT.format(year))
+                  for year in years]
+        span = process.report_years(rpt_path)
+        name = "city_res" + span[0]
+        if len(span) > 1:
+            name = "city_res{}-{}".format(span[0], span[-1])
+        reports.append((name, process.city_permits,
+                        [rpt_path, True, chunk_rows, years], [rpt_path],
+                        tables, []))
+    cnty_years = {}
+    for rpt_path in process.latest_exports(CNTY_REPORTS):
+        cnty_years.setdefault(report_year(rpt_path), []).append(rpt_path)
+    for year, rpt_paths in sorted(cnty_years.items()):
+        table = "cnty_res" + year
+        tables = [(table, process.CNTY_OUT.format(year))]
+        if len(rpt_paths) == 1:
+            reports.append((table, process.county_permits,
+                            rpt_paths + [True, True, chunk_rows], rpt_paths,
+                            tables, []))
+            continue
+        # A year in parts (e.g. cnty_2015_1.xlsx ... cnty_2015_n.xlsx): the
+        #  parts are processed side by side, then merged in part order
+        part_csvs = []
+        part_stages = []
+        for rpt_path in sorted(rpt_paths, key=process.part_number):
+            name = os.path.splitext(os.path.basename(rpt_path))[0]
+            part_csvs.append(os.path.abspath(
+                process.CNTY_PART_OUT.format(name)))
+            part_stages.append(build.add(pipeline.Stage(
+                "process:" + name, process.part_permits,
+                [rpt_path, chunk_rows],
+                inputs=[rpt_path] + PROCESS_INPUTS, files=[part_csvs[-1]],
+                parallel=True)).name)
+        reports.append((table, process.merge_parts, [year, part_csvs],
+                        part_csvs, tables, part_stages))
+
+    load_stages = {}
+    for name, func, args, inputs, tables, deps in reports:
+        tables = [(table, os.path.abspath(csv_rpt))
+                  for table, csv_rpt in tables]
+        process_stage = build.add(pipeline.Stage(
+            "process:" + name, func, args, inputs=inputs + PROCESS_INPUTS,
+            files=[csv_rpt for _, csv_rpt in tables], deps=deps,
+            parallel=True))
+        for table, csv_rpt in tables:
+            load_stages[table] = build.add(pipeline.Stage(
+                "load:" + table, load_permits, [table, csv_rpt],
+                inputs=[csv_rpt], tables=[table],
+                deps=[process_stage.name]))
 
+    # Tables whose reports are gone are still spatialized/densified
+    #  (ignore '_bk' tables left over in older databases)
+    PERMIT_TABLES.extend(sorted(
+        set(t for t in TABLES if "res" in t and "_bk" not in t) |
+        set(load_stages.keys())))
 
     # =========================================================================
     # LOAD SPATIAL DATA
-    # ATTACH the database containing the spatial data
-    print("Loading spatial data...")
-    cur.execute("ATTACH DATABASE '{}' AS permit_features;".format(
-        FEATURES_DB))
-    # Load/"Clone" each feature -- this is much faster and can comfortably be
-    #  done more often than a full data update (i.e. FC2FC)
-    for feature in ALL_FEATURES:
-        status.write("  {}...".format(feature))
-        if feature in conn.get_tables():
-            status.custom("[SKIP]", "yellow")
-            continue
-        sql = "SELECT CloneTable('permit_features', '{0}', '{0}', 1);"
-        cur.execute(sql.format(feature))
-        dslw.utils.reproject(conn, feature, 2256)
-        cur.execute("SELECT CreateSpatialIndex('{}', 'geometry');".format(
-            feature))
-        status.success()
+    def load_features(rebuild=False):
+        with tuning.stage_transaction(cur, fast_build):
+            permit_tables.init_geocode_cache(cur)
+            # Load/"Clone" each feature -- this is much faster and can
+            #  comfortably be done more often than a full data update
+            #  (i.e. FC2FC)
+            source = features_source()
+            for feature in ALL_FEATURES:
+                status.write("    {}...".format(feature))
+                tables = conn.get_tables()
+                if attach_features:
+                    # Unqualified names resolve to 'main' first, so old clones
+                    #  would hide the attached layers
+                    if feature in tables:
+                        cur.execute("SELECT DropGeoTable(?);", (feature,))
+                    # clean_data.py already reprojected these to 2256
+                    permit_tables.sync_feature_version(cur, feature, source)
+                    status.custom("[ATTACHED]", "green")
+                    continue
+                if feature in tables:
+                    if not rebuild:
+                        status.custom("[SKIP]", "yellow")
+                        continue
+                    # permit_features changed; clone it again
+                    cur.execute("SELECT DropGeoTable(?);", (feature,))
+                # CloneTable can't start its own transaction inside the stage's
+                cur.execute("SELECT CloneTable('permit_features', ?, ?, ?);",
+                            (feature, feature, 0 if fast_build else 1))
+                dslw.utils.reproject(conn, feature, 2256)
+                cur.execute("SELECT CreateSpatialIndex(?, 'geometry');",
+                            (feature,))
+                permit_tables.bump_feature_version(cur, feature, source)
+                status.success()
+            # Results based on replaced features can't be reused
+            permit_tables.expire_geocode_cache(cur)
+            # Keep the engine's memory-mapped copies of its layers up to date
+            #  (layers cloned before their source was recorded aren't stored)
+            if engine:
+                for feature, columns in sorted(engine.LAYERS.items()):
+                    feature_source = permit_tables.feature_source(cur, feature)
+                    if (feature_source is None or
+                            geomstore.open_store(feature, feature_source)):
+                        continue
+                    status.write("    storing {}...".format(feature))
+                    geomstore.write_store(conn, feature, columns,
+                                          feature_source)
+                    status.success()
+        return
+
+    # Spatialized permits and densities depend on the features too
+    features_inputs = [features_source,
+                       lambda: "attached={}".format(attach_features)]
+    build.add(pipeline.Stage(
+        "features", load_features, inputs=features_inputs,
+        tables=[] if attach_features else list(ALL_FEATURES)))
 
     # =========================================================================
     # CREATE AND POPULATE overrides TABLE
-    status.write("Populating overrides...")
-    ovr_create = ("CREATE TABLE overrides (permit_number TEXT, "
-                  "address TEXT, geocode TEXT);")
-    if "overrides" not in TABLES:
-        cur.execute(ovr_create)
-    insert_sql = "INSERT INTO overrides VALUES ('{0}', '{1}', '{2}');"
-    for line in open("data/overrides.txt", 'r').readlines():
-        line = line.strip()
-        try:
-            cur.execute(insert_sql.format(*line.split(", ")))
-        except dslw.apsw.SQLError:
-            pass
-    status.success()
+    def load_overrides(rebuild=False):
+        status.write("    loading overrides...")
+        status.custom("[{}]".format(permit_tables.load_overrides(
+            conn, OVERRIDES)), "green")
+        return
+
+    build.add(pipeline.Stage(
+        "overrides", load_overrides, inputs=[OVERRIDES],
+        tables=["overrides"]))
 
     # =========================================================================
     # SPATIALIZE PERMITS
-    print("Spatializing Permits...")
-    for table in PERMIT_TABLES:
-        status.write("  {}...".format(table))
-        cur.execute("PRAGMA table_info('{}')".format(table))
-        if "geometry" not in [f[1] for f in cur.fetchall()]:
-            # Call the spatialize.sql script and send it the current table
-            cur.execute(open("tools/spatialize.sql", "r").read().format(table))
-            # TODO: dslw.utils.execute_script(conn, "tools/spatialize.sql", table)
-            cur.fetchall()
-            status.success()
-        else:
-            status.custom("[SKIP]", "yellow")
+    def spatialize(table, rebuild=False):
+        with tuning.stage_transaction(cur, fast_build):
+            new_table = permit_tables.prep_permit_table(cur, table)
+            if rebuild and not new_table:
+                # spatialize.sql, the overrides, or the features changed; redo
+                #  the whole table
+                permit_tables.reset_spatialized(cur, table)
+            if permit_tables.count_pending(cur, table, "spatialized"):
+                spatial_engine = get_engine()
+                if spatial_engine:
+                    spatial_engine.spatialize(table)
+                else:
+                    # Call the spatialize.sql script and send it the current
+                    #  table
+                    run_sql(SPATIALIZE_SQL, "spatialize_" + table, table)
+            # Index after the bulk update; triggers maintain it for appends
+            if new_table:
+                cur.execute("SELECT CreateSpatialIndex(?, 'geometry');",
+                            (table,))
+        return
+
+    def spatialize_parallel(tables, rebuild=False):
+        # Workers read the permits database, so this commits as it goes
+        new_tables = [t for t in tables
+                      if permit_tables.prep_permit_table(cur, t)]
+        if rebuild:
+            for table in set(tables) - set(new_tables):
+                permit_tables.reset_spatialized(cur, table)
+        pending = [t for t in tables
+                   if permit_tables.count_pending(cur, t, "spatialized")]
+        parallel.spatialize_tables(
+            conn, DB, pending,
+            features_db=FEATURES_DB if attach_features else None)
+        for table in new_tables:
+            cur.execute("SELECT CreateSpatialIndex(?, 'geometry');",
+                        (table,))
+        return
+
+    # Already spatialized permits only pick up new overrides/features if the
+    #  stage rebuilds, so they're inputs rather than just upstream stages
+    spatialize_inputs = [SPATIALIZE_SQL, OVERRIDES] + features_inputs
+    spatialize_stages = {}
+    if parallel_spatialize:
+        stage = build.add(pipeline.Stage(
+            "spatialize", spatialize_parallel, [PERMIT_TABLES],
+            inputs=spatialize_inputs, reads=PERMIT_TABLES,
+            deps=(["features", "overrides"] +
+                  [s.name for s in load_stages.values()])))
+        spatialize_stages = dict((t, stage) for t in PERMIT_TABLES)
+    else:
+        for table in PERMIT_TABLES:
+            deps = ["features", "overrides"]
+            if table in load_stages:
+                deps.append(load_stages[table].name)
+            spatialize_stages[table] = build.add(pipeline.Stage(
+                "spatialize:" + table, spatialize, [table],
+                inputs=spatialize_inputs, deps=deps, reads=[table]))
 
     # =========================================================================
     # GENERATE REPORTS
-    print("Generating density tables...")
+    def densify(table, year, rebuild=False):
+        with tuning.stage_transaction(cur, fast_build):
+            # Reloaded/respatialized tables start over too
+            densified = statements.execute(
+                conn, "SELECT COUNT(*) FROM {table} WHERE densified = 1",
+                table=table).fetchone()[0]
+            if rebuild or not densified:
+                permit_tables.reset_density(cur, table, year)
+            if permit_tables.count_pending(cur, table, "densified"):
+                spatial_engine = get_engine()
+                if spatial_engine:
+                    spatial_engine.density(table, year)
+                else:
+                    # Call the density.sql script and send it the current table
+                    run_sql(DENSITY_SQL, "density_" + table, table, year)
+        return
+
     for table in PERMIT_TABLES:
-        year = table.split("res")[1]
-        if "cnty" in table:
-            year = str(year) + "_cnty"
-            # E.g. 'density2015_cnty' / 'sfrdev2015_cnty'
-        status.write("  {}...".format(density_table))
-        if density_table or th_dev_table not in conn.get_tables():
-            # Call the spatialize.sql script and send it the current table
-            cur.execute(open("tools/density.sql", "r").read().format(
-                table, density_table, th_dev_table))
-            # TODO: dslw.utils.execute_script(conn, "tools/spatialize.sql", table)
-            cur.fetchall()
-            status.success()
-        else:
-            status.custom("[SKIP]", "yellow")
+        year = density_year(table)
+        build.add(pipeline.Stage(
+            "density:" + table, densify, [table, year],
+            inputs=[DENSITY_SQL] + features_inputs,
+            tables=["density" + year, "th_dev" + year],
+            deps=[spatialize_stages[table].name], reads=[table]))
 
     # =========================================================================
-    # FINISH
-    status.write("VACUUMing...")
-    cur.execute("VACUUM;")
+    # QA
+    # Match rates of each (re)spatialized table, kept for every build
+    def check_matches(table, rebuild=False):
+        qa.record_stats(conn, table, build.run_id)
+        return
+
+    for table in PERMIT_TABLES:
+        build.add(pipeline.Stage(
+            "qa:" + table, check_matches, [table], tables=["qa_match_stats"],
+            deps=[spatialize_stages[table].name], reads=[table]))
+
+    return build
+
+
+def print_plan(plan):
+    """Prints the stages that would run."""
+    if not plan:
+        print("Everything is up to date.")
+    for stage, reason, rebuild in plan:
+        print("  {:<28} {}{}".format(
+            stage.name, reason, "" if rebuild else " (incremental)"))
+    return
+
+
+def main(append=False, parallel_spatialize=False, engine_name=ENGINES[0],
+         fast_build=False, attach_features=False, plan_only=False,
+         profile=False, explain=False, chunk_rows=None):
+    """Builds/updates the permits database.
+    Only the stages that are out of date are run (see make_pipeline), e.g.
+    editing density.sql only rebuilds the density tables. If plan_only is
+    True, the stages that would run are printed and nothing is changed.
+    If append is True, permits in the processed reports that are not already
+    in an existing permit table are appended, spatialized, and added to the
+    density tables on their own.
+    If parallel_spatialize is True, permit tables are spatialized by separate
+    worker processes (see tools/parallel.py).
+    engine_name chooses between the in-memory Shapely engine
+    (tools/engine.py) and the SQL scripts for spatializing and density.
+    If fast_build is True, SQLite is tuned for bulk writes and each stage runs
+    in one transaction (see tools/tuning.py).
+    If attach_features is True, the features are used straight from the
+    attached permit_features database (and its spatial indexes) instead of
+    being cloned, reprojected, and indexed in the permits database.
+    Each stage's timings are recorded in build_steps (see tools/buildlog.py);
+    if profile is True, a cProfile dump of each stage is also written to
+    profiles/<run_id>/. If profile or explain is True, a timing report of each
+    .sql script is written there as well; explain adds an EXPLAIN QUERY PLAN
+    audit of each statement (see tools/sqlscript.py).
+    If chunk_rows is given, reports are read and processed that many rows at
+    a time, so memory stays bounded however large they are (see
+    tools/process.py)."""
+    # Setup db
+    status.write("Making/connecting to database...")
+    conn = dslw.SpatialDB(DB, verbose=False)
+    cur = conn.cursor()
+    TABLES = conn.get_tables()
+    # ATTACH the database containing the spatial data
+    cur.execute("ATTACH DATABASE ? AS permit_features;", (FEATURES_DB,))
+    build = make_pipeline(conn, append, parallel_spatialize, engine_name,
+                          fast_build, attach_features, explain, chunk_rows)
+    plan = build.plan()
     status.success()
 
+    if plan_only:
+        print_plan(plan)
+        return
+    if not plan:
+        print("Everything is up to date.")
+        return
+    # The fast-build settings are put back however the build ends
+    with tuning.pragmas(cur, tuning.FAST_PRAGMAS if fast_build else []):
+        # =====================================================================
+        # SNAPSHOT
+        # Archive a copy of the database before changing it
+        if TABLES:
+            status.write("Archiving database...")
+            snapshot.take_snapshot(conn, DB)
+            status.success()
+
+        # =====================================================================
+        # RUN STALE STAGES
+        print("Running {} stages...".format(len(plan)))
+        options = ("append={} parallel={} engine={} fast_build={} "
+                   "attach_features={} chunk_rows={}".format(
+                       append, parallel_spatialize, engine_name, fast_build,
+                       attach_features, chunk_rows))
+        run_id = buildlog.start_run(cur, options)
+        profile_dir = None
+        if profile or explain:
+            build.report_dir = os.path.join(buildlog.PROFILE_DIR, str(run_id))
+            if not os.path.exists(build.report_dir):
+                os.makedirs(build.report_dir)
+        if profile:
+            profile_dir = build.report_dir
+
+        def show(stage, reason):
+            print("  {} ({})".format(stage.name, reason))
+
+        build.run(callback=show, run_id=run_id, profile_dir=profile_dir)
+
+        # =====================================================================
+        # FINISH
+        if fast_build:
+            status.write("ANALYZEing...")
+            step = buildlog.Step(conn).start()
+            cur.execute("ANALYZE;")
+            buildlog.record_step(cur, run_id, "analyze", step.stop())
+            status.success()
+    # Appends don't free any pages, don't rewrite the whole file for them.
+    # Once the database is auto_vacuum=INCREMENTAL (set by the first full
+    # VACUUM) only its free pages are given back
+    if not append:
+        status.write("VACUUMing...")
+        step = buildlog.Step(conn).start()
+        if tuning.enable_incremental_vacuum(cur):
+            cur.execute("VACUUM;")
+        else:
+            tuning.incremental_vacuum(cur)
+        buildlog.record_step(cur, run_id, "vacuum", step.stop())
+        status.success()
+    buildlog.finish_run(cur, run_id)
+    if build.report_dir:
+        print("Profiles/reports written to {}".format(build.report_dir))
+
 if __name__ == "__main__":
     # Show script info
     print(__doc__)
     print("")
     
+    parser = argparse.ArgumentParser(prog="make_permit_db.py")
+    parser.add_argument("--append", action="store_true", default=False,
+                        help="Append new permits to existing permit tables")
+    parser.add_argument("--parallel", action="store_true", default=False,
+                        help="Spatialize permit tables in parallel")
+    parser.add_argument("--engine", choices=ENGINES, default=ENGINES[0],
+                        help="Spatialize with the in-memory Shapely engine "
+                             "or the SQL scripts (default: %(default)s)")
+    parser.add_argument("--attach-features", action="store_true",
+                        default=False, dest="attach_features",
+                        help="Use permit_features.sqlite's layers directly "
+                             "instead of copying them into the database")
+    parser.add_argument("--fast-build", action="store_true", default=False,
+                        dest="fast_build",
+                        help="Tune SQLite for bulk writes during the build")
+    parser.add_argument("--plan", action="store_true", default=False,
+                        help="List the stages that are out of date and exit")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="Write a cProfile dump of each stage to "
+                             "profiles/<run_id>/")
+    parser.add_argument("--explain", action="store_true", default=False,
+                        help="Audit the .sql scripts' query plans "
+                             "(reports in profiles/<run_id>/)")
+    parser.add_argument("--chunk-rows", type=int, default=None,
+                        dest="chunk_rows", metavar="N",
+                        help="Process reports N rows at a time "
+                             "(bounded memory)")
+    args = parser.parse_args()
+
     # Set working directory
     out_dir = os.getcwd()
 
     # RUN IT!
     try:
-        main()
+        main(append=args.append, parallel_spatialize=args.parallel,
+             engine_name=args.engine, fast_build=args.fast_build,
+             attach_features=args.attach_features, plan_only=args.plan,
+             profile=args.profile, explain=args.explain,
+             chunk_rows=args.chunk_rows)
         print("")
         status.custom("COMPLETE", "cyan")
         raw_input("Press <Enter> to exit. ")
@@ -6,6 +6,8 @@ import sys
 
 import dslw
 
+from tools import sqlscript
+
 
 YEAR = sys.argv[1]
 
@@ -13,9 +15,11 @@ DB = "permits.sqlite"
 CONN = dslw.SpatialDB(DB)
 
 def region_summary(year, aggregation_feature, agg_name_field):
-    cur = CONN.cursor()
-    cur.execute(open("tools/region_summary.sql", "r").read().format(
-        year, aggregation_feature, agg_name_field))
+    # One statement at a time; a plain cur.execute() stops at the first
+    #  statement that returns rows
+    results = sqlscript.run_script(CONN, "tools/region_summary.sql", year,
+                                   aggregation_feature, agg_name_field)
+    print(sqlscript.format_report(results, "region_summary.sql", top=5))
     return
 
 
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+buildlog.py -- Build instrumentation
+Author: Garin Wally; Oct 2016
+
+Every make_permit_db.py build is recorded in the permits database so slow
+stages (and regressions as the permit tables grow) can be found with a query:
+
+    build_runs    one row per build: when it ran and with what options
+    build_steps   one row per stage run: wall and CPU seconds, rows in (the
+                  rows of the tables it reads) and out (rows it inserted,
+                  updated, or deleted), memory, and SQLite page cache
+                  hits/misses
+
+Memory comes from getrusage's ru_maxrss (on Windows, which has no getrusage,
+the PeakWorkingSetSize from GetProcessMemoryInfo). Both are the high-water
+mark of the whole process, not of a stage: peak_rss_kb is that mark when the
+stage ended (it never goes down in the main process or a reused worker), and
+rss_growth_kb is how much the stage raised it (0 if the stage stayed under an
+earlier stage's peak).
+
+E.g. SELECT stage, wall_s FROM build_steps WHERE run_id = 12 ORDER BY 2 DESC;
+
+With --profile, each stage also gets a cProfile dump (profiles/<run>/) that can
+be read with pstats or snakeviz.
+"""
+
+import cProfile
+import ctypes
+import os
+import sys
+import time
+from datetime import datetime as dt
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import dslw
+
+from tools import statements
+
+
+# =============================================================================
+# DATA
+
+PROFILE_DIR = os.path.abspath(os.path.join(".", "profiles"))
+
+RUNS_CREATE = ("CREATE TABLE IF NOT EXISTS build_runs ("
+               "run_id INTEGER PRIMARY KEY, started TEXT, finished TEXT, "
+               "options TEXT)")
+
+STEPS_CREATE = ("CREATE TABLE IF NOT EXISTS build_steps ("
+                "run_id INTEGER, stage TEXT, started TEXT, wall_s REAL, "
+                "cpu_s REAL, rows_in INTEGER, rows_out INTEGER, "
+                "peak_rss_kb INTEGER, cache_hits INTEGER, "
+                "cache_misses INTEGER, profile TEXT, rss_growth_kb INTEGER)")
+
+STEP_COLUMNS = ["run_id", "stage", "started", "wall_s", "cpu_s", "rows_in",
+                "rows_out", "peak_rss_kb", "cache_hits", "cache_misses",
+                "profile", "rss_growth_kb"]
+
+
+# =============================================================================
+# RUNS
+
+def start_run(cur, options=""):
+    """Records the start of a build and returns its run_id."""
+    cur.execute(RUNS_CREATE)
+    cur.execute(STEPS_CREATE)
+    # Tables from before rss_growth_kb was measured
+    if "rss_growth_kb" not in [r[1] for r in cur.execute(
+            "PRAGMA table_info('build_steps')").fetchall()]:
+        cur.execute("ALTER TABLE build_steps ADD COLUMN rss_growth_kb "
+                    "INTEGER")
+    cur.execute("INSERT INTO build_runs (started, options) VALUES (?, ?)",
+                (dt.now().isoformat(), options))
+    return cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+
+def finish_run(cur, run_id):
+    """Records the end of a build."""
+    cur.execute("UPDATE build_runs SET finished = ? WHERE run_id = ?",
+                (dt.now().isoformat(), run_id))
+    return
+
+
+def record_step(cur, run_id, stage, step):
+    """Adds a measured Step to build_steps."""
+    statements.execute(
+        cur, "INSERT INTO build_steps ({columns}) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (run_id, stage, step.started, step.wall_s, step.cpu_s, step.rows_in,
+         step.rows_out, step.peak_rss_kb, step.cache_hits, step.cache_misses,
+         step.profile, step.rss_growth_kb), columns=STEP_COLUMNS)
+    return
+
+
+# =============================================================================
+# MEASURING
+
+def cpu_time():
+    """User + system CPU seconds used by this process."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+    """What GetProcessMemoryInfo fills in (sizes in bytes)."""
+    _fields_ = [("cb", ctypes.c_ulong),
+                ("PageFaultCount", ctypes.c_ulong),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t)]
+
+
+def windows_peak_rss():
+    """Peak working set of this process in KiB (None if it can't be read)."""
+    try:
+        kernel32 = ctypes.windll.kernel32
+        psapi = ctypes.windll.psapi
+    except (AttributeError, OSError):
+        return None
+    kernel32.GetCurrentProcess.restype = ctypes.c_void_p
+    psapi.GetProcessMemoryInfo.argtypes = [
+        ctypes.c_void_p, ctypes.POINTER(PROCESS_MEMORY_COUNTERS),
+        ctypes.c_ulong]
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(),
+                                      ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize // 1024
+
+
+def peak_rss():
+    """Peak resident set size of this process so far in KiB (None if
+    unknown)."""
+    if resource is None:
+        return windows_peak_rss()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on OS X
+    if sys.platform == "darwin":
+        return peak // 1024
+    return peak
+
+
+def count_rows(cur, tables):
+    """Total rows in a list of tables (missing tables count as 0)."""
+    total = 0
+    for table in tables:
+        try:
+            total += statements.execute(
+                cur, "SELECT COUNT(*) FROM {table}",
+                table=table).fetchone()[0]
+        except dslw.apsw.SQLError:
+            pass
+    return total
+
+
+def cache_status(conn, reset=False):
+    """Returns the connection's (page cache hits, misses) so far."""
+    hits = conn.status(dslw.apsw.SQLITE_DBSTATUS_CACHE_HIT, reset)[0]
+    misses = conn.status(dslw.apsw.SQLITE_DBSTATUS_CACHE_MISS, reset)[0]
+    return hits, misses
+
+
+def profile_call(func, args, kwargs=None, profile=None):
+    """Calls func, writing a cProfile dump to the profile path if given."""
+    kwargs = kwargs or {}
+    if not profile:
+        return func(*args, **kwargs)
+    out_dir = os.path.dirname(profile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile)
+
+
+def rss_growth(before, after):
+    """How much a step raised the peak RSS (None if unknown)."""
+    if before is None or after is None:
+        return None
+    return after - before
+
+
+def measured_call(func, args, profile=None):
+    """Runs func(*args) in a worker process and returns
+    (result, cpu seconds, peak RSS, RSS growth) measured there."""
+    cpu = cpu_time()
+    peak = peak_rss()
+    result = profile_call(func, args, profile=profile)
+    after = peak_rss()
+    return result, cpu_time() - cpu, after, rss_growth(peak, after)
+
+
+class Step(object):
+    """Measurements of one stage run.
+    Call start() before the stage and stop() after it; the attributes are
+    what record_step stores. Steps run by workers (db=False) don't use the
+    database, so rows and page cache stats aren't measured for them."""
+    def __init__(self, conn, reads=(), profile=None, db=True):
+        self.conn = conn
+        self.db = db
+        self.cur = conn.cursor()
+        self.reads = list(reads)
+        self.profile = profile
+        self.started = None
+        self.wall_s = None
+        self.cpu_s = None
+        self.rows_in = None
+        self.rows_out = None
+        self.peak_rss_kb = None
+        self.rss_growth_kb = None
+        self.cache_hits = None
+        self.cache_misses = None
+
+    def start(self):
+        self.started = dt.now().isoformat()
+        if self.db:
+            self.rows_in = count_rows(self.cur, self.reads)
+            cache_status(self.conn, reset=True)
+            self._changes = self.conn.totalchanges()
+        self._cpu = cpu_time()
+        self._peak = peak_rss()
+        self._wall = time.time()
+        return self
+
+    def stop(self, cpu_s=None, peak_rss_kb=None, rss_growth_kb=None):
+        """Ends the measurement; workers pass in their own CPU time, peak
+        RSS, and RSS growth."""
+        self.wall_s = time.time() - self._wall
+        self.cpu_s = cpu_time() - self._cpu if cpu_s is None else cpu_s
+        if peak_rss_kb is None:
+            self.peak_rss_kb = peak_rss()
+            self.rss_growth_kb = rss_growth(self._peak, self.peak_rss_kb)
+        else:
+            self.peak_rss_kb = peak_rss_kb
+            self.rss_growth_kb = rss_growth_kb
+        if self.db:
+            self.rows_out = self.conn.totalchanges() - self._changes
+            self.cache_hits, self.cache_misses = cache_status(self.conn)
+        return self
@@ -1,17 +1,66 @@
 /* Density (duac) calculations
 Inputs:
 {0}: res<year> table -- input permit table
-{1}: new density<year> table -- final permit product for mapping/analysis
-{2}: new th_dev<year> table -- townhouse development
+{1}: year suffix -- e.g. '2015' or '2015_cnty'
 
 Outputs:
-Creates the density<year> table(s).
-Creates the th_dev<year> table(s).
+Populates the permit_condo table for the input permit table.
+Creates/updates the density<year> table(s).
+Creates/updates the th_dev<year> table(s).
+
+Only permits that are not in the density table yet (densified = 0) are
+calculated, along with the townhome/condo projects they belong to. On a new
+permit table that is every permit; after an append it is just the new ones.
 */
 
+-- Permits to (re)calculate
+DROP TABLE IF EXISTS temp.new_permits;
+CREATE TEMP TABLE new_permits AS
+  SELECT DISTINCT permit_number FROM {0} WHERE densified = 0;
+
+
+-- Assign each permit to (at most) one townhome/condo project
+-- This is done once using the condos_dis spatial index, everything downstream
+-- joins to it on permit_number rather than re-testing Intersects()
+CREATE TABLE IF NOT EXISTS permit_condo (
+  permit_table TEXT,
+  permit_number TEXT,
+  condo_proj TEXT,
+  PRIMARY KEY (permit_table, permit_number));
+
+-- Projects whose totals change (previous assignments are included)
+DROP TABLE IF EXISTS temp.new_projects;
+CREATE TEMP TABLE new_projects AS
+  SELECT DISTINCT condo_proj FROM permit_condo
+  WHERE permit_table = '{0}'
+    AND permit_number IN (SELECT permit_number FROM temp.new_permits);
+
+DELETE FROM permit_condo
+WHERE permit_table = '{0}'
+  AND permit_number IN (SELECT permit_number FROM temp.new_permits);
+
+INSERT INTO permit_condo
+  SELECT '{0}', p.permit_number, MIN(c.name)
+  FROM {0} p, condos_dis c
+  WHERE p.permit_number IN (SELECT permit_number FROM temp.new_permits)
+    AND c.ROWID IN (
+      -- Query the R-tree itself so this works whether condos_dis was cloned
+      -- into this database or is read from the attached permit_features
+      SELECT pkid FROM idx_condos_dis_geometry
+      WHERE xmin <= MbrMaxX(p.geometry) AND xmax >= MbrMinX(p.geometry)
+        AND ymin <= MbrMaxY(p.geometry) AND ymax >= MbrMinY(p.geometry))
+    AND Intersects(p.geometry, c.geometry)
+  GROUP BY p.permit_number;
+
+INSERT INTO temp.new_projects
+  SELECT DISTINCT condo_proj FROM permit_condo
+  WHERE permit_table = '{0}'
+    AND permit_number IN (SELECT permit_number FROM temp.new_permits);
+
+
 -- Calc duac including total dwellings and total area of parcels intersecting multi-point permits
 -- E.g. 1500 S 14TH ST (2014) 62 duac
-CREATE TABLE density{1} (
+CREATE TABLE IF NOT EXISTS density{1} (
   permit_number TEXT PRIMARY KEY,
   geocode TEXT,
   address TEXT,
@@ -21,15 +70,18 @@ CREATE TABLE density{1} (
   condo_proj TEXT,
   geometry MULTIPOINT);
 
+DELETE FROM density{1}
+WHERE permit_number IN (SELECT permit_number FROM temp.new_permits);
+
 INSERT INTO density{1} SELECT * FROM (
   SELECT 
-	permit_number,
+	p.permit_number,
     u.geocode AS geocode, 
     p.address AS address,
 	sum_dwellings, 
     SUM(Area(u.geometry))/43560.0 AS acres, 
     FLOOR(sum_dwellings/(SUM(Area(u.geometry))/43560.0)) as duac,
-	c.name AS condo_proj,
+	pc.condo_proj AS condo_proj,
 	p.geometry AS geometry
   FROM (
       SELECT DISTINCT permit_number, address, 
@@ -37,39 +89,50 @@ INSERT INTO density{1} SELECT * FROM (
 	    -- Dissolve points
 	    ST_Multi(ST_Collect(geometry)) AS geometry 
       FROM {0}   
+      WHERE permit_number IN (SELECT permit_number FROM temp.new_permits)
       GROUP BY permit_number) AS p
   JOIN ufda_parcels u ON Intersects(p.geometry, u.geometry) 
-  LEFT JOIN condos_dis c ON Intersects(p.geometry, c.geometry) 
+  LEFT JOIN permit_condo pc
+    ON pc.permit_table = '{0}' AND pc.permit_number = p.permit_number
   GROUP BY p.permit_number
   ORDER BY p.address);
-SELECT RecoverGeometryColumn('{1}', 'geometry', 2256, 'MULTIPOINT', 2);
+
+-- Only register the geometry the first time through
+SELECT RecoverGeometryColumn('density{1}', 'geometry', 2256, 'MULTIPOINT', 2)
+WHERE NOT EXISTS (
+  SELECT 1 FROM geometry_columns WHERE f_table_name = 'density{1}');
 
 
 -- Make a table to track townhome (th) / condo development activity
-CREATE TABLE th_dev{1} (
-  name TEXT,
+-- Dwellings are summed per project first so each project's area is counted once
+CREATE TABLE IF NOT EXISTS th_dev{1} (
+  name TEXT PRIMARY KEY,
   sum_dwellings INTEGER,
   acres REAL,
   proj_duac REAL);
 
+DELETE FROM th_dev{1}
+WHERE name IN (SELECT condo_proj FROM temp.new_projects);
+
 INSERT INTO th_dev{1} SELECT * FROM (
   SELECT c.name AS name,  
-    SUM(sum_dwellings) as sum_dwellings, 
-    SUM(Area(c.geometry))/43560.0 AS acres, 
-    FLOOR(SUM(sum_dwellings)/(SUM(Area(c.geometry))/43560.0)) AS proj_duac  
-  FROM {1} d 
-  JOIN condos_dis c 
-  ON Intersects(d.geometry, c.geometry) 
-  GROUP BY c.name);
-
-
--- Change the incorrectly calculated townhome/condo duacs
-UPDATE density{1}  
-SET duac = (
-    SELECT proj_duac
-	FROM th_dev{1} t
-	JOIN density{1} d ON t.name = d.condo_proj)
-WHERE condo_proj IS NOT NULL;
+    d.sum_dwellings AS sum_dwellings, 
+    Area(c.geometry)/43560.0 AS acres, 
+    FLOOR(d.sum_dwellings/(Area(c.geometry)/43560.0)) AS proj_duac  
+  FROM (
+      SELECT condo_proj, SUM(sum_dwellings) AS sum_dwellings
+      FROM density{1}
+      WHERE condo_proj IN (SELECT condo_proj FROM temp.new_projects)
+      GROUP BY condo_proj) AS d
+  JOIN condos_dis c ON c.name = d.condo_proj);
+
+
+-- Change the incorrectly calculated townhome/condo duacs to their project's
+UPDATE density{1}
+SET duac = t.proj_duac
+FROM th_dev{1} t
+WHERE t.name = density{1}.condo_proj
+  AND t.name IN (SELECT condo_proj FROM temp.new_projects);
 
 -- Taking the FLOOR of 0.x results in 0.0, when really it should be 1.0
 UPDATE density{1} 
@@ -81,6 +144,15 @@ SET proj_duac = 1.0
 WHERE proj_duac = 0.0;
 
 
+-- Mark the processed permits as done
+UPDATE {0}
+SET densified = 1
+WHERE densified = 0;
+
+DROP TABLE temp.new_permits;
+DROP TABLE temp.new_projects;
+
+
 /*-- 2013
 CREATE TABLE duacs13_temp AS 
 	SELECT p.address AS address, p.geocode AS geocode, SUM(p.dwellings) AS dwellings, 
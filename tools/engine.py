@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+engine.py -- In-memory spatial engine for spatializing permits and densities
+Author: Garin Wally; Oct 2016
+
+SpatialEngine loads ufda_parcels, ufda_addrs, and condos_dis out of the
+permits database once and then does the work of spatialize.sql and
+density.sql as bulk array operations instead of per-row SQL. A layer is kept
+as WKB with a bounding box per feature: its STRtree is built over the boxes,
+and only the features a lookup or candidate pair needs are parsed into
+Shapely geometries (once). Results are written back with
+one executemany per table.
+
+The output matches the SQL scripts (see test_engine.py), including the
+per-row 'spatialized'/'densified' flags, geocode_cache, and permit_condo
+tables, so either path can be used on the same database.
+
+The layers are read from the memory-mapped geometry store (geomstore.py)
+when it is up to date with the database, otherwise from SpatiaLite.
+
+Requires shapely >= 2.0 and numpy.
+"""
+
+import numpy as np
+import shapely
+from shapely import STRtree
+
+from tools import geomstore
+from tools import permit_tables
+from tools import statements
+
+
+# =============================================================================
+# DATA
+
+SRID = 2256
+
+SQFT_PER_ACRE = 43560.0
+
+# Layers (and attribute columns) the engine loads
+LAYERS = {
+    "ufda_parcels": ["parcelid", "geocode"],
+    "ufda_addrs": ["parcelid", "fulladdress"],
+    "condos_dis": ["name"]
+    }
+
+# Spatialization methods in the order spatialize.sql tries them
+METHODS = ["geocode", "fulladdr", "a.parcelid"]
+
+# Bound with {"density": "density<year>", "srid": SRID}
+DENSITY_CREATE = (
+    "CREATE TABLE IF NOT EXISTS density{year} ("
+    "permit_number TEXT PRIMARY KEY, geocode TEXT, address TEXT, "
+    "sum_dwellings INTEGER, acres REAL, duac REAL, condo_proj TEXT, "
+    "geometry MULTIPOINT);"
+    "SELECT RecoverGeometryColumn(:density, 'geometry', :srid, "
+    "'MULTIPOINT', 2) "
+    "WHERE NOT EXISTS ("
+    "SELECT 1 FROM geometry_columns WHERE f_table_name = :density);"
+    "CREATE TABLE IF NOT EXISTS th_dev{year} ("
+    "name TEXT PRIMARY KEY, sum_dwellings INTEGER, acres REAL, "
+    "proj_duac REAL);"
+    "CREATE TABLE IF NOT EXISTS permit_condo ("
+    "permit_table TEXT, permit_number TEXT, condo_proj TEXT, "
+    "PRIMARY KEY (permit_table, permit_number));")
+
+
+# =============================================================================
+# UTILITIES
+
+class Layer(object):
+    """A layer's geometries, parsed from WKB as they're used.
+    wkbs is a function returning the WKB (an object array) of an array of
+    indexes; bbox is an (n, 4) array of minx, miny, maxx, maxy (NaN for
+    missing geometries)."""
+    def __init__(self, wkbs, bbox):
+        self.wkbs = wkbs
+        bbox = np.asarray(bbox, dtype=np.float64).reshape(-1, 4)
+        self.parsed = np.zeros(len(bbox), dtype=bool)
+        self.geometries = np.full(len(bbox), None, dtype=object)
+        boxes = np.full(len(bbox), None, dtype=object)
+        has_box = ~np.isnan(bbox).any(axis=1)
+        if has_box.any():
+            boxes[has_box] = shapely.box(*bbox[has_box].T)
+        # Same envelopes as the geometries, so the same tree and candidates
+        self.tree = STRtree(boxes)
+
+    def __len__(self):
+        return len(self.parsed)
+
+    def geoms(self, idx):
+        """Returns the geometries at an array of indexes."""
+        idx = np.asarray(idx, dtype=np.intp)
+        todo = np.unique(idx[~self.parsed[idx]])
+        if len(todo):
+            self.geometries[todo] = shapely.from_wkb(self.wkbs(todo))
+            self.parsed[todo] = True
+        return self.geometries[idx]
+
+    def query(self, geoms, predicate="intersects"):
+        """Like STRtree.query(geoms, predicate): (input, layer) index pairs,
+        but only the layer's bounding box candidates are parsed."""
+        pairs = self.tree.query(geoms)
+        if not pairs.shape[1]:
+            return pairs
+        keep = getattr(shapely, predicate)(
+            geoms[pairs[0]], self.geoms(pairs[1]))
+        return pairs[:, keep]
+
+
+def load_layer(cur, table, columns):
+    """Returns a table's attribute columns (as arrays) and its geometry as a
+    Layer."""
+    rows = statements.execute(
+        cur, "SELECT {columns}, AsBinary(geometry), MbrMinX(geometry), "
+        "MbrMinY(geometry), MbrMaxX(geometry), MbrMaxY(geometry) "
+        "FROM {table}", columns=columns, table=table).fetchall()
+    n_cols = len(columns)
+    cols = list(zip(*rows)) or [()] * (n_cols + 5)
+    wkbs = np.array(cols[n_cols], dtype=object)
+    bbox = np.array([r[n_cols + 1:] for r in rows], dtype=np.float64)
+    return ([np.array(c, dtype=object) for c in cols[:n_cols]],
+            Layer(lambda idx: wkbs[idx], bbox))
+
+
+def load_stored_layer(cur, table, columns, store_dir):
+    """Like load_layer, but reads from the geometry store if it was written
+    from the feature's current source (its WKB stays memory-mapped)."""
+    store = geomstore.open_store(
+        table, permit_tables.feature_source(cur, table), store_dir)
+    if store is None:
+        return load_layer(cur, table, columns)
+    return [store.column(c) for c in columns], Layer(store.wkbs, store.bbox)
+
+
+def as_key(value):
+    """Lookup key for a join column; geocodes/parcelids may be stored as
+    numbers in one table and text in another."""
+    return None if value is None else str(value)
+
+
+def first_index(keys):
+    """Maps each key to the index of its first occurrence (what a scalar
+    subquery returns when several rows match)."""
+    lookup = {}
+    for i, k in enumerate(keys):
+        k = as_key(k)
+        if k is not None and k not in lookup:
+            lookup[k] = i
+    return lookup
+
+
+def collect_points(geoms, codes, n):
+    """Equivalent of ST_Multi(ST_Collect()) for an array of (multi)points
+    grouped by sorted integer codes 0..n-1; groups without points are None."""
+    out = np.full(n, None, dtype=object)
+    parts, idx = shapely.get_parts(geoms, return_index=True)
+    if len(parts):
+        shapely.multipoints(parts, indices=np.asarray(codes)[idx], out=out)
+    out[shapely.is_empty(out)] = None
+    return out
+
+
+def to_multipoints(geoms):
+    """Equivalent of ST_Multi() for an array of (multi)points."""
+    return collect_points(geoms, np.arange(len(geoms)), len(geoms))
+
+
+def to_wkb(geom):
+    """WKB for one geometry or None."""
+    return None if geom is None else shapely.to_wkb(geom)
+
+
+def fix_zero(x):
+    """Taking the FLOOR of 0.x results in 0.0, when really it should be
+    1.0"""
+    return 1.0 if x == 0.0 else x
+
+
+# =============================================================================
+# ENGINE
+
+class SpatialEngine(object):
+    """Holds the features used to spatialize permits in memory."""
+    def __init__(self, conn, store_dir=geomstore.STORE_DIR):
+        self.conn = conn
+        cur = conn.cursor()
+        if store_dir:
+            layers = dict(
+                (t, load_stored_layer(cur, t, cols, store_dir))
+                for t, cols in LAYERS.items())
+        else:
+            layers = dict(
+                (t, load_layer(cur, t, cols)) for t, cols in LAYERS.items())
+        (self.parcel_ids, self.parcel_geocodes), self.parcels = layers[
+            "ufda_parcels"]
+        (self.addr_ids, self.addr_names), self.addrs = layers["ufda_addrs"]
+        (self.condo_names,), self.condos = layers["condos_dis"]
+        # Key lookups used by the spatialize cascade
+        self.parcel_lookup = first_index(self.parcel_ids)
+        self.fulladdr_lookup = first_index(self.addr_names)
+        self.addr_parcel_lookup = first_index(self.addr_ids)
+
+    def spatialize(self, table):
+        """Spatializes a permit table's unspatialized rows like spatialize.sql.
+        Returns the number of rows given a geometry."""
+        cur = self.conn.cursor()
+        # Overrides are joined on their primary key
+        rows = statements.execute(
+            cur, "SELECT p.ROWID, p.permit_number, "
+            "  CASE WHEN o.permit_number IS NULL THEN p.geocode "
+            "    ELSE o.geocode END, "
+            "  CASE WHEN o.permit_number IS NULL THEN p.address "
+            "    ELSE o.address END "
+            "FROM {table} p LEFT JOIN overrides o "
+            "  ON o.permit_number = p.permit_number "
+            "WHERE p.spatialized = 0", table=table).fetchall()
+        if not rows:
+            return 0
+        version = cur.execute(
+            "SELECT version FROM geocode_version").fetchone()[0]
+        cache = dict(
+            ((as_key(r[0]), r[1]), (r[2], r[3])) for r in cur.execute(
+                "SELECT geocode, address, method, AsBinary(geometry) "
+                "FROM geocode_cache WHERE feature_version = ?", (version,)))
+
+        # Apply overrides, drop the permits to remove
+        rowids, geocodes, addresses = [], [], []
+        removed = []
+        for rowid, permit_number, geocode, address in rows:
+            if geocode == "REMOVE":
+                removed.append((rowid,))
+                continue
+            rowids.append(rowid)
+            geocodes.append(geocode)
+            addresses.append(address)
+        n = len(rowids)
+
+        # Cache hits first, then the cascade for the rest
+        notes = np.full(n, METHODS[-1], dtype=object)
+        geoms = np.full(n, None, dtype=object)
+        cached = np.zeros(n, dtype=bool)
+        for i in range(n):
+            hit = cache.get((as_key(geocodes[i]), addresses[i]))
+            if hit and geocodes[i] is not None:
+                notes[i] = hit[0]
+                geoms[i] = shapely.from_wkb(hit[1])
+                cached[i] = True
+        cascade = [
+            (METHODS[0], geocodes, self.parcel_lookup,
+             lambda idx: shapely.point_on_surface(self.parcels.geoms(idx))),
+            (METHODS[1], addresses, self.fulladdr_lookup,
+             self.addrs.geoms),
+            (METHODS[2], geocodes, self.addr_parcel_lookup,
+             self.addrs.geoms)]
+        for method, keys, lookup, get_geoms in cascade:
+            todo = [i for i in range(n)
+                    if geoms[i] is None and as_key(keys[i]) in lookup]
+            if not todo:
+                continue
+            idx = np.array([lookup[as_key(keys[i])] for i in todo])
+            geoms[todo] = to_multipoints(get_geoms(idx))
+            notes[todo] = method
+
+        # Write back
+        wkbs = [to_wkb(g) for g in geoms]
+        cur.execute("SAVEPOINT spatialize;")
+        statements.executemany(
+            cur, "DELETE FROM {table} WHERE ROWID = ?", removed, table=table)
+        statements.executemany(
+            cur, "UPDATE {table} SET geocode = ?, address = ?, notes = ?, "
+            "geometry = GeomFromWKB(?, ?), spatialized = 1 "
+            "WHERE ROWID = ?",
+            [(geocodes[i], addresses[i], notes[i], wkbs[i], SRID, rowids[i])
+             for i in range(n)], table=table)
+        cur.executemany(
+            "INSERT OR IGNORE INTO geocode_cache VALUES "
+            "(?, ?, ?, ?, GeomFromWKB(?, ?))",
+            [(geocodes[i], addresses[i], version, notes[i], wkbs[i], SRID)
+             for i in range(n) if wkbs[i] is not None and not cached[i]])
+        cur.execute("RELEASE spatialize;")
+        return sum(1 for w in wkbs if w is not None)
+
+    def density(self, table, year):
+        """Builds/updates the density<year>, th_dev<year>, and permit_condo
+        rows for a permit table's undensified permits like density.sql.
+        Returns the number of permits calculated."""
+        cur = self.conn.cursor()
+        statements.execute(
+            cur, DENSITY_CREATE,
+            {"density": "density{}".format(year), "srid": SRID},
+            year=year).fetchall()
+        rows = statements.execute(
+            cur, "SELECT permit_number, address, dwellings, "
+            "AsBinary(geometry) FROM {table} WHERE permit_number IN ("
+            "  SELECT permit_number FROM {table} WHERE densified = 0) "
+            "ORDER BY permit_number", table=table).fetchall()
+        if not rows:
+            return 0
+
+        # Dissolve the points of each permit
+        permits = sorted(set(r[0] for r in rows))
+        code = dict((p, i) for i, p in enumerate(permits))
+        n = len(permits)
+        addresses = [None] * n
+        dwellings = [set() for _ in range(n)]
+        for permit_number, address, dw, wkb in rows:
+            i = code[permit_number]
+            addresses[i] = address
+            if dw is not None:
+                dwellings[i].add(dw)
+        sum_dwellings = [sum(d) if d else None for d in dwellings]
+        dissolved = collect_points(
+            shapely.from_wkb(np.array([r[3] for r in rows], dtype=object)),
+            [code[r[0]] for r in rows], n)
+        with_geom = np.flatnonzero(~shapely.is_missing(dissolved))
+
+        # Townhome/condo project assignment (first name alphabetically)
+        condo_proj = [None] * n
+        if len(with_geom) and len(self.condos):
+            pairs = self.condos.query(dissolved[with_geom])
+            for g, c in zip(pairs[0], pairs[1]):
+                i = with_geom[g]
+                name = self.condo_names[c]
+                if condo_proj[i] is None or name < condo_proj[i]:
+                    condo_proj[i] = name
+
+        # Parcel area and duac
+        acres = np.zeros(n)
+        geocode = [None] * n
+        joined = np.zeros(n, dtype=bool)
+        if len(with_geom):
+            pairs = self.parcels.query(dissolved[with_geom])
+            areas = shapely.area(self.parcels.geoms(pairs[1]))
+            acres[with_geom] = np.bincount(
+                pairs[0], weights=areas,
+                minlength=len(with_geom)) / SQFT_PER_ACRE
+            joined[with_geom[np.unique(pairs[0])]] = True
+            for g, p in zip(pairs[0], pairs[1]):
+                geocode[with_geom[g]] = self.parcel_geocodes[p]
+        density_rows = []
+        for i in np.flatnonzero(joined):
+            duac = None
+            if sum_dwellings[i] is not None and acres[i]:
+                duac = float(np.floor(sum_dwellings[i] / acres[i]))
+            density_rows.append((
+                permits[i], geocode[i], addresses[i], sum_dwellings[i],
+                float(acres[i]), duac, condo_proj[i], to_wkb(dissolved[i])))
+
+        # Write back
+        permit_args = [(table, p) for p in permits]
+        cur.execute("SAVEPOINT density;")
+        projects = set(r[0] for r in cur.executemany(
+            "SELECT condo_proj FROM permit_condo "
+            "WHERE permit_table = ? AND permit_number = ?", permit_args))
+        cur.executemany(
+            "DELETE FROM permit_condo "
+            "WHERE permit_table = ? AND permit_number = ?", permit_args)
+        cur.executemany(
+            "INSERT INTO permit_condo VALUES (?, ?, ?)",
+            [(table, permits[i], condo_proj[i]) for i in range(n)
+             if condo_proj[i] is not None])
+        projects.update(p for p in condo_proj if p is not None)
+        projects.discard(None)
+        statements.executemany(
+            cur, "DELETE FROM density{year} WHERE permit_number = ?",
+            [(p,) for p in permits], year=year)
+        statements.executemany(
+            cur, "INSERT INTO density{year} VALUES (?, ?, ?, ?, ?, ?, ?, "
+            "GeomFromWKB(?, ?))", [r + (SRID,) for r in density_rows],
+            year=year)
+        self._th_dev(cur, year, sorted(projects))
+        statements.execute(
+            cur, "UPDATE density{year} SET duac = 1.0 WHERE duac = 0.0;"
+            "UPDATE {table} SET densified = 1 WHERE densified = 0;",
+            year=year, table=table)
+        cur.execute("RELEASE density;")
+        return len(density_rows)
+
+    def _th_dev(self, cur, year, projects):
+        """Recalculates th_dev<year> for the given projects and gives their
+        permits the project duac."""
+        if not projects:
+            return
+        condo_lookup = first_index(self.condo_names)
+        args = [(p,) for p in projects]
+        totals = dict(
+            statements.executemany(
+                cur, "SELECT condo_proj, SUM(sum_dwellings) "
+                "FROM density{year} WHERE condo_proj = ?", args, year=year))
+        th_rows = []
+        for name in projects:
+            if totals.get(name) is None or name not in condo_lookup:
+                continue
+            acres = shapely.area(
+                self.condos.geoms([condo_lookup[name]]))[0] / SQFT_PER_ACRE
+            proj_duac = fix_zero(float(np.floor(totals[name] / acres)))
+            th_rows.append((name, totals[name], float(acres), proj_duac))
+        statements.executemany(
+            cur, "DELETE FROM th_dev{year} WHERE name = ?", args, year=year)
+        statements.executemany(
+            cur, "INSERT INTO th_dev{year} VALUES (?, ?, ?, ?)", th_rows,
+            year=year)
+        statements.executemany(
+            cur, "UPDATE density{year} SET duac = ? WHERE condo_proj = ?",
+            [(r[3], r[0]) for r in th_rows], year=year)
+        return
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+geomstore.py -- Memory-mapped WKB geometry store
+Author: Garin Wally; Oct 2016
+
+Pulling ufda_parcels and ufda_addrs out of SpatiaLite for every run of the
+spatial engine is slow. This module writes a feature to a directory of flat
+files when it is loaded into the permits database:
+
+    <store>/<feature>/geoms.wkb      all geometries as one WKB buffer
+    <store>/<feature>/offsets.npy    int64 start of each geometry (+ the end)
+    <store>/<feature>/bbox.npy       float64 (n, 4) minx, miny, maxx, maxy
+    <store>/<feature>/<column>.npy   attribute columns as unicode arrays
+    <store>/<feature>/meta.json      columns, count, and feature source
+
+A store is only used for the source its feature was loaded from (see
+permit_tables.feature_source), not for the permits database's version
+counter: a new database starts counting again, so the counter can't tell one
+copy of the features from another.
+
+Readers open everything with np.memmap/np.load(mmap_mode='r'), so the buffers
+are shared between processes through the OS page cache. The engine builds its
+STRtrees from bbox.npy and only copies out (and parses) the WKB of the
+features it uses; attribute columns are read into memory whole.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+# =============================================================================
+# DATA
+
+STORE_DIR = os.path.abspath(os.path.join(".", "data", "geomstore"))
+
+
+# =============================================================================
+# WRITE
+
+def write_store(conn, feature, columns, source, store_dir=STORE_DIR):
+    """Writes a feature's geometry and attribute columns to the store, keyed
+    on the source it was loaded from. Returns the number of features
+    written."""
+    cur = conn.cursor()
+    out = os.path.join(store_dir, feature)
+    if not os.path.exists(out):
+        os.makedirs(out)
+    rows = cur.execute(
+        "SELECT {}, AsBinary(geometry), MbrMinX(geometry), MbrMinY(geometry), "
+        "MbrMaxX(geometry), MbrMaxY(geometry) FROM {} "
+        "ORDER BY ROWID".format(", ".join(columns), feature)).fetchall()
+    n_cols = len(columns)
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    with open(os.path.join(out, "geoms.wkb"), "wb") as wkb_file:
+        for i, row in enumerate(rows):
+            wkb = bytes(row[n_cols] or b"")
+            wkb_file.write(wkb)
+            offsets[i + 1] = offsets[i] + len(wkb)
+    np.save(os.path.join(out, "offsets.npy"), offsets)
+    bbox = np.array([r[n_cols + 1:] for r in rows], dtype=np.float64)
+    np.save(os.path.join(out, "bbox.npy"), bbox.reshape(len(rows), 4))
+    for i, col in enumerate(columns):
+        # Missing values are stored as ""
+        values = [u"" if r[i] is None else u"{}".format(r[i]) for r in rows]
+        np.save(os.path.join(out, "{}.npy".format(col)),
+                np.array(values, dtype="U"))
+    with open(os.path.join(out, "meta.json"), "w") as meta:
+        json.dump({"feature": feature, "columns": columns,
+                   "count": len(rows), "source": source}, meta)
+    return len(rows)
+
+
+# =============================================================================
+# READ
+
+class GeometryStore(object):
+    """Read-only, memory-mapped view of a stored feature."""
+    def __init__(self, feature, store_dir=STORE_DIR):
+        self.path = os.path.join(store_dir, feature)
+        with open(os.path.join(self.path, "meta.json"), "r") as meta:
+            self.meta = json.load(meta)
+        self.columns = self.meta["columns"]
+        # Stores written before they were keyed on the source have none
+        self.source = self.meta.get("source")
+        self.offsets = self._load("offsets")
+        self.bbox = self._load("bbox")
+        if self.offsets[-1]:
+            self.wkb = np.memmap(os.path.join(self.path, "geoms.wkb"),
+                                 dtype=np.uint8, mode="r")
+        else:
+            # Can't memmap an empty file
+            self.wkb = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, "{}.npy".format(name)),
+                       mmap_mode="r")
+
+    def column(self, name):
+        """Returns an attribute column as an object array (None for "")."""
+        values = np.asarray(self._load(name)).astype(object)
+        values[values == u""] = None
+        return values
+
+    def wkbs(self, idx=None):
+        """Returns an object array of WKB bytes, optionally for a subset."""
+        if idx is None:
+            idx = np.arange(len(self))
+        starts, ends = self.offsets[idx], self.offsets[np.asarray(idx) + 1]
+        buf = memoryview(self.wkb)
+        return np.array([bytes(buf[s:e]) if e > s else None
+                         for s, e in zip(starts, ends)], dtype=object)
+
+    def geometries(self, idx=None):
+        """Returns Shapely geometries built from the stored WKB."""
+        import shapely
+        return shapely.from_wkb(self.wkbs(idx))
+
+    def query_bbox(self, minx, miny, maxx, maxy):
+        """Indexes of features whose bounding box intersects the given one."""
+        b = self.bbox
+        return np.flatnonzero((b[:, 0] <= maxx) & (b[:, 2] >= minx) &
+                              (b[:, 1] <= maxy) & (b[:, 3] >= miny))
+
+
+def open_store(feature, source, store_dir=STORE_DIR):
+    """Returns the GeometryStore for a feature, or None if it hasn't been
+    written, was written from a different source, or the source is unknown
+    (None)."""
+    if source is None:
+        return None
+    if not os.path.exists(os.path.join(store_dir, feature, "meta.json")):
+        return None
+    store = GeometryStore(feature, store_dir)
+    if store.source != source:
+        return None
+    return store
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+parallel.py -- Process-parallel spatialization of permit tables
+Author: Garin Wally; Oct 2016
+
+Each permit table is spatialized by its own worker process. A worker makes its
+own SpatiaLite database, copies the table's unspatialized rows into it, and
+runs spatialize.sql there with the permits database ATTACHed (read-only use)
+for the features, overrides, and geocode_cache. The results are then merged
+back into the permits database one table at a time.
+
+The permits database is switched to WAL mode so the workers' reads never wait
+on each other or on the merge.
+"""
+
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool, cpu_count
+
+import dslw
+
+from tools import permit_tables
+from tools import sqlscript
+from tools import statements
+
+
+# =============================================================================
+# DATA
+
+SPATIALIZE_SQL = "tools/spatialize.sql"
+
+
+# =============================================================================
+# WORKER
+
+def spatialize_table(args):
+    """Spatializes the pending rows of one permit table in a worker database.
+    Takes a (permits_db, table, work_dir, features_db) tuple so it can be used
+    with Pool.imap_unordered; features_db is only given when the features are
+    read from permit_features instead of being cloned into the permits
+    database. Returns the table name and worker database path."""
+    db, table, work_dir, features_db = args
+    work_db = os.path.join(work_dir, "{}.sqlite".format(table))
+    conn = dslw.SpatialDB(work_db, verbose=False)
+    cur = conn.cursor()
+    cur.execute("ATTACH DATABASE ? AS permits;", (db,))
+    if features_db:
+        cur.execute("ATTACH DATABASE ? AS permit_features;", (features_db,))
+    # Unqualified names resolve to 'main' first, so spatialize.sql updates
+    #  these copies and reads everything else from the permits database
+    statements.execute(cur, "CREATE TABLE {table} AS SELECT * "
+                       "FROM permits.{table} WHERE spatialized = 0",
+                       table=table)
+    cur.execute("CREATE TABLE geocode_cache AS "
+                "SELECT * FROM permits.geocode_cache "
+                "WHERE feature_version = "
+                "(SELECT version FROM permits.geocode_version)")
+    cur.execute("CREATE UNIQUE INDEX idx_geocode_cache "
+                "ON geocode_cache (geocode, address, feature_version)")
+    sqlscript.run_script(conn, SPATIALIZE_SQL, table)
+    cur.execute("DETACH DATABASE permits;")
+    if features_db:
+        cur.execute("DETACH DATABASE permit_features;")
+    conn.close()
+    return table, work_db
+
+
+# =============================================================================
+# MERGE
+
+def merge_table(conn, table, work_db):
+    """Replaces a table's unspatialized rows with the worker's results and
+    adds the worker's new geocode_cache entries."""
+    cur = conn.cursor()
+    cols = permit_tables.get_columns(cur, table)
+    cur.execute("ATTACH DATABASE ? AS work;", (work_db,))
+    statements.execute(
+        cur, "SAVEPOINT merge; "
+        "DELETE FROM main.{table} WHERE spatialized = 0; "
+        "INSERT INTO main.{table} ({cols}) SELECT {cols} FROM work.{table}; "
+        "INSERT OR IGNORE INTO main.geocode_cache "
+        "  SELECT * FROM work.geocode_cache; "
+        "RELEASE merge;", table=table, cols=cols)
+    cur.execute("DETACH DATABASE work;")
+    return
+
+
+def spatialize_tables(conn, db, tables, processes=None, features_db=None):
+    """Spatializes permit tables in parallel and merges them into conn.
+    db is the path of conn's database; processes defaults to one per table
+    up to the number of cores. Pass features_db if the features are used
+    from the attached permit_features database."""
+    if not tables:
+        return []
+    if processes is None:
+        processes = min(len(tables), cpu_count())
+    cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL;")
+    cur.fetchall()
+    work_dir = tempfile.mkdtemp(prefix="spatialize_")
+    pool = Pool(processes)
+    try:
+        jobs = [(os.path.abspath(db), table, work_dir, features_db)
+                for table in tables]
+        merged = []
+        for table, work_db in pool.imap_unordered(spatialize_table, jobs):
+            merge_table(conn, table, work_db)
+            merged.append(table)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return merged
@@ -8,6 +8,7 @@ Author: Garin Wally; Aug 2016
 
 import os
 import re
+from collections import OrderedDict
 from glob import glob
 
 import pandas as pd
@@ -15,6 +16,12 @@ import pandas as pd
 import dslw
 from tkit.cli import StatusLine, handle_ex
 
+from tools import permit_tables
+from tools import qa
+from tools import snapshot
+from tools import statements
+from tools import tuning
+
 status = StatusLine()
 
 
@@ -30,9 +37,11 @@ class ParseAddr(object):
                 self.parsed.append(city)
             if state:
                 self.parsed.append(state)
-            self.sql_like = "'{} %{} %'".format(self.st_numb, self.st_name)
+            self.like = "{} %{} %".format(self.st_numb, self.st_name)
+            self.sql_like = "'{}'".format(self.like)
         else:
             self.parsed = u""
+            self.like = u""
             self.sql_like = u""
 
     def parse_addr(self, a):
@@ -73,16 +82,32 @@ def make_sqllist(row):
     return ", ".join(["'{}'".format(v) for v in row])
 
 
-def reset_db(conn):
-    """Drops tables with a backup and clones the backup."""
-    _c = conn.cursor()
-    bks = [t for t in conn.get_tables() if t.endswith("_bk")]
-    drops = [t.split("_")[0] for t in bks]
-    sql = ("DROP TABLE IF EXISTS {0}; "
-           "SELECT CloneTable('main', '{0}_bk', '{0}', 0);")
-    [_c.execute(sql.format(t)) for t in drops]
-    _c.execute("VACUUM")
-    return
+def reset_db(db="permits.sqlite", snapshot_path=None):
+    """Replaces the database with its latest (or the given) snapshot.
+    Close all connections to the database first."""
+    return snapshot.restore_snapshot(db, snapshot_path)
+
+
+def reset_tables(tables, db="permits.sqlite", snapshot_path=None,
+                 max_pages=None):
+    """Restores only some tables (e.g. ['city_res2015', 'cnty_res2015']) from
+    the latest (or the given) snapshot by swapping them in place, then frees
+    the replaced pages with at most max_pages of incremental vacuum.
+    Their build stages are forgotten so the next build re-checks them.
+    Returns the snapshot used."""
+    tables = [statements.check_identifier(t) for t in tables]
+    conn = dslw.SpatialDB(db, verbose=False)
+    cur = conn.cursor()
+    try:
+        used = snapshot.restore_tables(conn, db, tables, snapshot_path)
+        if "build_stages" in conn.get_tables():
+            cur.executemany(
+                "DELETE FROM build_stages WHERE stage LIKE '%:' || ?",
+                [(t,) for t in tables])
+        tuning.incremental_vacuum(cur, max_pages)
+    finally:
+        conn.close()
+    return used
 
 
 # =============================================================================
@@ -90,48 +115,38 @@ def reset_db(conn):
 
 def get_outer_join(conn, permit_table):
     """Get permit geocodes/parcelids that do not join with ufda_parcels"""
-    _c = conn.cursor()
-    join_qry = ("SELECT {0}.address, {0}.geocode, ufda_parcels.parcelid "
-                "FROM {0} LEFT OUTER JOIN ufda_parcels "
-                "ON {0}.geocode=ufda_parcels.parcelid "
-                "WHERE ufda_parcels.parcelid IS NULL").format(permit_table)
-    outer = _c.execute(join_qry).fetchall()
+    join_qry = ("SELECT p.address, p.geocode, ufda_parcels.parcelid "
+                "FROM {table} p LEFT OUTER JOIN ufda_parcels "
+                "ON p.geocode=ufda_parcels.parcelid "
+                "WHERE ufda_parcels.parcelid IS NULL")
+    outer = statements.execute(conn, join_qry, table=permit_table).fetchall()
     return outer
 
 
 def get_outer_addr_join(conn, permit_table):
     """Get permit addrs that do not join with the ufda_addr table"""
-    _c = conn.cursor()
-    join_qry = ("SELECT {0}.address, {0}.geocode, ufda_addrs.parcelid "
-                "FROM {0} LEFT OUTER JOIN ufda_addrs "
-                "ON {0}.address=ufda_addrs.fulladdress "
-                "WHERE ufda_addrs.parcelid IS NULL").format(permit_table)
-    outer = _c.execute(join_qry).fetchall()
+    join_qry = ("SELECT p.address, p.geocode, ufda_addrs.parcelid "
+                "FROM {table} p LEFT OUTER JOIN ufda_addrs "
+                "ON p.address=ufda_addrs.fulladdress "
+                "WHERE ufda_addrs.parcelid IS NULL")
+    outer = statements.execute(conn, join_qry, table=permit_table).fetchall()
     return outer
 
 
 def matches_parcels(conn, permit_table):
-    _c = conn.cursor()
-    check = ("SELECT {0}.geocode "
-             "FROM {0} JOIN ufda_parcels "
-             "ON {0}.geocode=ufda_parcels.parcelid "
-             "WHERE ufda_parcels.geometry IS NOT NULL").format(permit_table)
-    all_permits = "SELECT * FROM {}".format(permit_table)
-    n_permits = len(_c.execute(all_permits).fetchall())
-    parcel_joins = len(_c.execute(check).fetchall())
-    return (parcel_joins//n_permits, "{}/{}".format(parcel_joins, n_permits))
+    """Share of permits whose geocode joins with ufda_parcels.
+    Returns (rate, 'matched/permits'); see qa.py."""
+    n_permits, parcel_joins = qa.parcel_matches(conn, permit_table)
+    return (qa.rate(parcel_joins, n_permits),
+            "{}/{}".format(parcel_joins, n_permits))
 
 
 def matches_addrs(conn, permit_table):
-    """Counts successful joins by address."""
-    _c = conn.cursor()
-    check = ("SELECT {0}.geocode "
-             "FROM {0} JOIN ufda_addrs "
-             "ON {0}.address = ufda_addrs.fulladdress").format(permit_table)
-    all_permits = "SELECT * FROM {}".format(permit_table)
-    n_permits = len(_c.execute(all_permits).fetchall())
-    addr_joins = len(_c.execute(check).fetchall())
-    return (addr_joins//n_permits, "{}/{}".format(addr_joins, n_permits))
+    """Counts successful joins by address.
+    Returns (rate, 'matched/permits'); see qa.py."""
+    n_permits, addr_joins = qa.addr_matches(conn, permit_table)
+    return (qa.rate(addr_joins, n_permits),
+            "{}/{}".format(addr_joins, n_permits))
 
 
 # =============================================================================
@@ -142,115 +157,120 @@ def fix_addrs(conn, permit_table):
     """Fixes permit addr and geo by parse-matching addr to ufda_addrs."""
     _c = conn.cursor()
     addrs = set(_c.execute("SELECT fulladdress FROM ufda_addrs"))
-    permit_addr = set(
-        _c.execute("SELECT address FROM {}".format(permit_table)))
+    addrs_qry = "SELECT address FROM {table}"
+    permit_addr = set(statements.execute(conn, addrs_qry, table=permit_table))
     # Addresses that exist in permits and not in the address points
     fix_addrs = list(permit_addr.difference(addrs))
+    addr_qry = ("SELECT parcelid, fulladdress FROM ufda_addrs "
+                "WHERE fulladdress LIKE ?")
+    update_q = ("UPDATE {table} SET address=?, notes = 'CHANGED: ' || ? "
+                "WHERE address=?")
     for old_addr in fix_addrs:
         if not old_addr[0]:
             continue
-        addr_qry = ("SELECT parcelid, fulladdress FROM ufda_addrs "
-                    "WHERE fulladdress LIKE {}".format(ParseAddr(old_addr[0])))
-        correct = _c.execute(addr_qry).fetchall()
-        update_q = (
-            "UPDATE {} SET address=?, notes = 'CHANGED: {}' "
-            "WHERE address=?")
-        if correct:
-            for match in correct:
-                _c.execute(update_q.format(permit_table, old_addr[0]),
-                           (match[1], old_addr[0]))
-    new_addrs = set(_c.execute("SELECT address FROM {}".format(permit_table)))
+        correct = _c.execute(
+            addr_qry, (ParseAddr(old_addr[0]).like,)).fetchall()
+        statements.executemany(
+            conn, update_q,
+            [(match[1], old_addr[0], old_addr[0]) for match in correct],
+            table=permit_table)
+    new_addrs = set(statements.execute(conn, addrs_qry, table=permit_table))
     not_fixed = list(new_addrs.difference(addrs))
     return not_fixed
 
 
 def correct_misplaced(conn, permit_table):
     """UPDATE permit POINTs that are not within the right parcel.
-    'PointOnSurface()' is better than 'Centroid()' -- ALWAYS within polygon."""
-    _c = conn.cursor()
-    q = ("SELECT AsText(PointOnSurface(u.geometry)), SRID(u.geometry), "
-         "p.geocode "
-         "FROM {} p, ufda_parcels u "
-         "WHERE p.geocode = u.parcelid "
-         "AND NOT Contains(u.geometry, p.geometry)").format(permit_table)
-    rows = _c.execute(q).fetchall()
-    update = "UPDATE {} SET geometry=GeomFromText(?, ?) WHERE geocode=?"
-    for r in rows:
-        _c.execute(update.format(permit_table), r)
-    return
+    'PointOnSurface()' is better than 'Centroid()' -- ALWAYS within polygon.
+    Returns the number of permits moved."""
+    update = ("UPDATE {table} "
+              "SET geometry = ST_Multi(PointOnSurface(u.geometry)) "
+              "FROM ufda_parcels u "
+              "WHERE u.parcelid = {table}.geocode "
+              "AND NOT Contains(u.geometry, {table}.geometry)")
+    statements.execute(conn, update, table=permit_table)
+    return conn.changes()
 
 
 def correct_invalid_geoms(conn, permit_table):
-    _c = conn.cursor()
-    srid_qry = "SELECT SRID(geometry) FROM {} WHERE geometry IS NOT NULL"
-    srid = _c.execute(srid_qry.format(permit_table)).fetchone()[0]
-    invalid_qry = ("SELECT address FROM {} "
-                   "WHERE IsValid(geometry) IS -1")
-    invalids = _c.execute(invalid_qry.format(permit_table)).fetchall()
-    if not invalids:
-        return
-    parcel_center = ("SELECT AsText(ST_Centroid(p.geometry)), p.parcelid "
-                     "FROM ufda_parcels p JOIN ufda_addrs a "
-                     "ON Intersects(a.geometry, p.geometry) "
-                     "AND a.fulladdress='{}'")
-    for row in invalids:
-        point = _c.execute(parcel_center.format(row[0])).fetchone()[0]
-        update_qry = ("UPDATE {} SET geometry=GeomFromText('{}', {}) "
-                      "WHERE address=?")
-        _c.execute(update_qry.format(permit_table, point, srid), row)
-    return
+    """Replaces invalid geometry with the centroid of the parcel under the
+    permit's address point. Returns the number of permits fixed."""
+    # The parcels are found through their R-tree (one lookup per address)
+    update = ("UPDATE {table} "
+              "SET geometry = ST_Multi(SetSRID(ST_Centroid(f.geometry), "
+              "  (SELECT SRID(geometry) FROM {table} "
+              "   WHERE geometry IS NOT NULL LIMIT 1))) "
+              "FROM ("
+              "  SELECT a.fulladdress AS address, p.geometry AS geometry "
+              "  FROM ufda_addrs a JOIN ufda_parcels p "
+              "  ON p.ROWID IN ("
+              "    SELECT pkid FROM idx_ufda_parcels_geometry "
+              "    WHERE xmin <= MbrMaxX(a.geometry) "
+              "      AND xmax >= MbrMinX(a.geometry) "
+              "      AND ymin <= MbrMaxY(a.geometry) "
+              "      AND ymax >= MbrMinY(a.geometry)) "
+              "    AND Intersects(a.geometry, p.geometry) "
+              "  WHERE a.fulladdress IN ("
+              "    SELECT address FROM {table} "
+              "    WHERE IsValid(geometry) IS -1)) f "
+              "WHERE f.address = {table}.address "
+              "AND IsValid({table}.geometry) IS -1")
+    statements.execute(conn, update, table=permit_table)
+    return conn.changes()
 
 
 def correct_null_geoms(conn, permit_table):
-    """Replaces NULL geometry with ufda_addr geometry."""
-    _c = conn.cursor()
-    addr_qry = "SELECT address FROM {} WHERE geometry IS NULL"
-    addrs = _c.execute(addr_qry.format(permit_table)).fetchall()
-    if not addrs:
-        return
-    for addr in addrs:
-        q = ("SELECT a.parcelid, AsText(a.geometry), SRID(a.geometry) "
-             "FROM ufda_addrs a "
-             "JOIN {} p ON p.address=a.fulladdress "
-             "WHERE p.address = ?")
-        _c.execute(q.format(permit_table), addr)
-        fixes = _c.fetchone()
-        update = "UPDATE {} SET geocode=?, geometry=GeomFromText(?, ?)"
-        if fixes:
-            _c.execute(update.format(permit_table), fixes)
-    return
+    """Replaces NULL geometry (and the geocode) with ufda_addr's.
+    Returns the number of permits fixed."""
+    update = ("UPDATE {table} "
+              "SET geocode = a.parcelid, geometry = ST_Multi(a.geometry) "
+              "FROM ufda_addrs a "
+              "WHERE a.fulladdress = {table}.address "
+              "AND {table}.geometry IS NULL")
+    statements.execute(conn, update, table=permit_table)
+    return conn.changes()
 
 
 # LAST RESORT...
 def get_addr_geom(conn, permit_table):
+    """Gives permits without geometry their address point.
+    Returns the number of permits given one."""
     _c = conn.cursor()
-    _c.execute(dslw.utils.AddGeometryColumn(permit_table, 2256, 'POINT'))
-    s = ("SELECT a.geometry, p.address "
-         "FROM {} p JOIN ufda_addrs a "
-         " ON a.fulladdress=p.address "
-         "WHERE p.geometry IS NULL").format(permit_table)
-
-    u = ("UPDATE {} SET geometry=? "
-         "WHERE address=? AND geometry IS NULL").format(permit_table)
-    g = _c.execute(s).fetchall()
-    for t in g:
-        _c.execute(u, t)
-    return
+    if "geometry" not in permit_tables.get_columns(_c, permit_table):
+        _c.execute(dslw.utils.AddGeometryColumn(
+            permit_table, 2256, 'MULTIPOINT'))
+    update = ("UPDATE {table} SET geometry = ST_Multi(a.geometry) "
+              "FROM ufda_addrs a "
+              "WHERE a.fulladdress = {table}.address "
+              "AND {table}.geometry IS NULL")
+    statements.execute(conn, update, table=permit_table)
+    return conn.changes()
 
 
 def get_parcel_geom(conn, permit_table):
+    """Gives permits without geometry a point on their parcel.
+    Returns the number of permits given one."""
+    update = ("UPDATE {table} "
+              "SET geometry = ST_Multi(PointOnSurface(u.geometry)) "
+              "FROM ufda_parcels u "
+              "WHERE u.parcelid = {table}.geocode "
+              "AND {table}.geometry IS NULL")
+    statements.execute(conn, update, table=permit_table)
+    return conn.changes()
+
+
+def repair_table(conn, permit_table):
+    """Runs the repairs above over a permit table (in one transaction) and
+    returns an OrderedDict of how many permits each one changed."""
+    repairs = [correct_misplaced, correct_invalid_geoms, correct_null_geoms,
+               get_parcel_geom]
+    counts = OrderedDict()
     _c = conn.cursor()
-    s = ("SELECT PointOnSurface(u.geometry), p.geocode "
-         "FROM {} p JOIN ufda_parcels u "
-         " ON u.parcelid=p.geocode "
-         "WHERE p.geometry IS NULL").format(permit_table)
-
-    u = ("UPDATE {} SET geometry=? "
-         "WHERE geocode=? AND geometry IS NULL").format(permit_table)
-    g = _c.execute(s).fetchall()
-    for t in g:
-        _c.execute(u, t)
-    return
+    _c.execute("SAVEPOINT repair;")
+    for repair in repairs:
+        counts[repair.__name__] = repair(conn, permit_table)
+    _c.execute("RELEASE repair;")
+    return counts
 
 '''
 def addrs2points(conn, permit_table):
@@ -316,10 +336,10 @@ def dev_density(conn, permits_dissolved):
 def dissolve(conn, permit_table):
     _c = conn.cursor()
     sql = (
-        "CREATE TABLE {0}_dis AS SELECT permit_number, geocode, address, "
+        "CREATE TABLE {table}_dis AS SELECT permit_number, geocode, address, "
         " dwellings, ST_Multi(ST_Collect(geometry)) AS geometry "
-        "FROM {0} GROUP BY  permit_number; "
-        "SELECT RecoverGeometryColumn('{0}_dis', 'geometry', 2256, "
-        " 'MULTIPOINT', 'XY');").format(permit_table)
-    _c.execute(sql)
+        "FROM {table} GROUP BY  permit_number; "
+        "SELECT RecoverGeometryColumn('{table}_dis', 'geometry', 2256, "
+        " 'MULTIPOINT', 'XY');")
+    _c.execute(statements.sql(conn, sql, table=permit_table)).fetchall()
     return
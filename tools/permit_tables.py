@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+permit_tables.py -- Permit table preparation and bookkeeping
+Author: Garin Wally; Oct 2016
+
+Functions used by make_permit_db.py (and the spatial engine/tests) to add the
+processing columns to permit tables, append new permits to them, load the
+overrides, and manage the geocode_cache shared by the spatialization methods.
+"""
+
+import csv
+from datetime import datetime as dt
+
+from tools import statements
+
+
+# =============================================================================
+# PERMIT TABLES
+
+def get_columns(cur, table):
+    """Returns a list of a table's column names."""
+    return [f[1] for f in statements.execute(
+        cur, "PRAGMA table_info('{table}')", table=table).fetchall()]
+
+
+def prep_permit_table(cur, table):
+    """Adds the geometry and progress-flag columns to a permit table.
+    Returns True if the table has never been spatialized."""
+    cols = get_columns(cur, table)
+    new_table = "geometry" not in cols
+    if new_table:
+        cur.execute("SELECT AddGeometryColumn(?, 'geometry', 2256, "
+                    "'MULTIPOINT', 'XY');", (table,))
+        statements.execute(
+            cur, "ALTER TABLE {table} ADD COLUMN condo_project TEXT",
+            table=table)
+    # Per-row flags so appended permits can be processed on their own
+    for flag in ("spatialized", "densified"):
+        if flag in cols:
+            continue
+        statements.execute(
+            cur, "ALTER TABLE {table} ADD COLUMN {flag} INTEGER DEFAULT 0",
+            table=table, flag=flag)
+        # Tables built before the flags existed are already processed
+        if not new_table:
+            statements.execute(cur, "UPDATE {table} SET {flag} = 1",
+                               table=table, flag=flag)
+        statements.execute(cur, "CREATE INDEX IF NOT EXISTS "
+                           "idx_{table}_{flag} ON {table} ({flag})",
+                           table=table, flag=flag)
+    statements.execute(cur, "CREATE INDEX IF NOT EXISTS "
+                       "idx_{table}_permit_number ON {table} (permit_number)",
+                       table=table)
+    return new_table
+
+
+def count_pending(cur, table, flag):
+    """Counts the rows of a permit table that still need a processing step."""
+    return statements.execute(cur, "SELECT COUNT(*) FROM {table} "
+                              "WHERE {flag} = 0", table=table,
+                              flag=flag).fetchone()[0]
+
+
+def last_issued(cur, table):
+    """Returns the latest permit_issued_date (a date) in a permit table, or
+    None if the table doesn't exist or is empty."""
+    if not cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                       "AND name = ?", (table,)).fetchone():
+        return None
+    row = statements.execute(cur, "SELECT MAX(permit_issued_date) "
+                             "FROM {table}", table=table).fetchone()
+    if not row[0]:
+        return None
+    # From the processed csvs: e.g. 2016-10-14 or 2016-10-14 00:00:00
+    return dt.strptime(row[0][:10], "%Y-%m-%d").date()
+
+
+def reset_spatialized(cur, table):
+    """Marks every row of a permit table to be spatialized (and densified)
+    again, e.g. after spatialize.sql changed."""
+    statements.execute(cur, "UPDATE {table} SET geometry = NULL, "
+                       "notes = NULL, spatialized = 0, densified = 0",
+                       table=table)
+    return
+
+
+def reset_density(cur, table, year):
+    """Drops a permit table's density tables and condo assignments and marks
+    its rows to be densified again, e.g. after density.sql changed."""
+    tables = [r[0] for r in cur.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()]
+    density_table = "density{}".format(year)
+    if density_table in tables:
+        # Also unregisters the geometry column
+        cur.execute("SELECT DropGeoTable(?)", (density_table,))
+    statements.execute(cur, "DROP TABLE IF EXISTS th_dev{year}", year=year)
+    if "permit_condo" in tables:
+        cur.execute("DELETE FROM permit_condo WHERE permit_table = ?",
+                    (table,))
+    statements.execute(cur, "UPDATE {table} SET densified = 0", table=table)
+    return
+
+
+def append_permits(conn, table, csv_rpt):
+    """Inserts the rows of a processed csv that are not in the table yet.
+    Rows are matched on permit_number only -- spatializing rewrites the
+    geocode/address of overridden permits -- and permits an override removes
+    are skipped; returns the number added."""
+    cur = conn.cursor()
+    reader = csv.reader(open(csv_rpt, "r"))
+    cols = next(reader)
+    rows = [[v if v != "" else None for v in row] for row in reader]
+    statements.execute(cur, "CREATE TEMP TABLE append_{table} AS "
+                       "SELECT {cols} FROM {table} WHERE 0",
+                       table=table, cols=cols)
+    statements.executemany(cur, "INSERT INTO temp.append_{table} "
+                           "VALUES (" + ", ".join("?" * len(cols)) + ")",
+                           rows, table=table)
+    insert = ("INSERT INTO {table} ({cols}) "
+              "SELECT {cols} FROM temp.append_{table} a "
+              "WHERE NOT EXISTS ("
+              "  SELECT 1 FROM {table} p "
+              "  WHERE p.permit_number = a.permit_number)")
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                   "AND name = 'overrides'").fetchone():
+        insert += ("  AND a.permit_number NOT IN ("
+                   "    SELECT permit_number FROM overrides "
+                   "    WHERE geocode = 'REMOVE')")
+    statements.execute(cur, insert, table=table, cols=cols)
+    n_new = conn.changes()
+    statements.execute(cur, "DROP TABLE temp.append_{table}", table=table)
+    return n_new
+
+
+# =============================================================================
+# OVERRIDES
+
+def init_overrides(cur):
+    """Creates the overrides table, keyed on permit_number.
+    Tables from older builds (no key, duplicated rows) are replaced; they're
+    reloaded from data/overrides.txt anyway."""
+    cols = cur.execute("PRAGMA table_info('overrides')").fetchall()
+    if cols and not any(c[1] == "permit_number" and c[5] for c in cols):
+        cur.execute("DROP TABLE overrides")
+    cur.execute("CREATE TABLE IF NOT EXISTS overrides ("
+                "permit_number TEXT PRIMARY KEY, address TEXT, geocode TEXT)")
+    return
+
+
+def read_overrides(path):
+    """Reads the 'permit_number, address, geocode' lines of an overrides
+    file. Blank lines are skipped; raises a ValueError for malformed ones."""
+    rows = []
+    with open(path, "r") as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            row = [v.strip() for v in line.strip().split(", ")]
+            if len(row) != 3:
+                raise ValueError("{} line {}: expected 'permit_number, "
+                                 "address, geocode': {!r}".format(
+                                     path, n, line.strip()))
+            rows.append(row)
+    return rows
+
+
+def load_overrides(conn, path):
+    """Replaces the overrides with those in a file (see read_overrides) in
+    one executemany upsert; a permit listed twice gets its last line.
+    Returns the number of overrides."""
+    cur = conn.cursor()
+    rows = read_overrides(path)
+    init_overrides(cur)
+    cur.execute("SAVEPOINT overrides;")
+    cur.execute("DELETE FROM overrides;")
+    cur.executemany(
+        "INSERT INTO overrides VALUES (?, ?, ?) "
+        "ON CONFLICT (permit_number) DO UPDATE SET "
+        "address = excluded.address, geocode = excluded.geocode", rows)
+    cur.execute("RELEASE overrides;")
+    return cur.execute("SELECT COUNT(*) FROM overrides").fetchone()[0]
+
+
+# =============================================================================
+# GEOCODE CACHE
+
+def init_geocode_cache(cur):
+    """Creates the tables used to reuse spatialization results.
+    geocode_cache holds the geometry and method found for a geocode/address
+    pair. Entries are only valid for the feature_version they were made with;
+    the version goes up every time ufda_parcels or ufda_addrs is (re)loaded
+    (or, when they're used from the attached permit_features database, every
+    time that database changes)."""
+    cur.execute("CREATE TABLE IF NOT EXISTS feature_versions ("
+                "feature TEXT PRIMARY KEY, version INTEGER, loaded TEXT, "
+                "source TEXT)")
+    cur.execute("CREATE VIEW IF NOT EXISTS geocode_version AS "
+                "SELECT COALESCE(SUM(version), 0) AS version "
+                "FROM feature_versions "
+                "WHERE feature IN ('ufda_parcels', 'ufda_addrs')")
+    cur.execute("CREATE TABLE IF NOT EXISTS geocode_cache ("
+                "geocode TEXT, address TEXT, feature_version INTEGER, "
+                "method TEXT, geometry BLOB, "
+                "PRIMARY KEY (geocode, address, feature_version))")
+    return
+
+
+def bump_feature_version(cur, feature, source=None):
+    """Records that a feature was (re)loaded, optionally from where."""
+    cur.execute("INSERT OR REPLACE INTO feature_versions VALUES (?, "
+                "COALESCE((SELECT version FROM feature_versions "
+                "WHERE feature = ?), 0) + 1, datetime('now'), ?)",
+                (feature, feature, source))
+    return
+
+
+def sync_feature_version(cur, feature, source):
+    """Bumps a feature's version if its source (e.g. the modification time
+    of the attached features database) changed. Returns True if it did."""
+    row = cur.execute("SELECT source FROM feature_versions WHERE feature = ?",
+                      (feature,)).fetchone()
+    if row and row[0] == source:
+        return False
+    bump_feature_version(cur, feature, source)
+    return True
+
+
+def feature_version(cur, feature):
+    """Returns a feature's current version (0 if it was never recorded)."""
+    row = cur.execute("SELECT version FROM feature_versions WHERE feature = ?",
+                      (feature,)).fetchone()
+    return row[0] if row else 0
+
+
+def feature_source(cur, feature):
+    """Returns where a feature's current version was loaded from (None if it
+    was never recorded)."""
+    row = cur.execute("SELECT source FROM feature_versions WHERE feature = ?",
+                      (feature,)).fetchone()
+    return row[0] if row else None
+
+
+def expire_geocode_cache(cur):
+    """Deletes cached results made with out-of-date features."""
+    cur.execute("DELETE FROM geocode_cache WHERE feature_version <> "
+                "(SELECT version FROM geocode_version)")
+    return
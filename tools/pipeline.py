@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+pipeline.py -- Dependency-aware build stages
+Author: Garin Wally; Oct 2016
+
+make_permit_db.py is a chain of stages (process a report, load it, load the
+features, spatialize, build the density tables). Each Stage declares:
+
+    inputs   files (hashed) and/or callables returning a fingerprint string,
+             e.g. a raw report, a SQL script, a feature version
+    tables   tables it writes
+    files    files it writes
+    deps     names of the stages it needs to run first
+    reads    tables it reads (only used to count rows for tools/buildlog.py)
+
+The fingerprint of a stage's inputs is stored in the 'build_stages' table when
+it finishes. On the next build a stage only runs if it is stale: it was never
+recorded, its inputs changed, one of its outputs is missing, or a stage it
+depends on is going to run. So editing density.sql only rebuilds the density
+tables, and a new county report only reloads and reprocesses that county year.
+
+Stages that don't touch the database (parallel=True) can run in a
+multiprocessing Pool alongside each other; the rest run one at a time in the
+main process, in dependency order.
+"""
+
+import hashlib
+import os
+import re
+import time
+from datetime import datetime as dt
+from multiprocessing import Pool, cpu_count
+
+from tools import buildlog
+
+
+# =============================================================================
+# DATA
+
+STAGES_CREATE = ("CREATE TABLE IF NOT EXISTS build_stages ("
+                 "stage TEXT PRIMARY KEY, fingerprint TEXT, finished TEXT)")
+
+
+# =============================================================================
+# FINGERPRINTS
+
+def file_fingerprint(path):
+    """Returns an md5 hex digest of a file's contents ('' if it's missing)."""
+    if not os.path.exists(path):
+        return ""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def fingerprint(inputs):
+    """Combines a stage's inputs into one digest.
+    Strings are treated as file paths, callables are called for a string."""
+    md5 = hashlib.md5()
+    for source in inputs:
+        if callable(source):
+            value = u"{}".format(source())
+        else:
+            value = u"{}:{}".format(os.path.basename(source),
+                                    file_fingerprint(source))
+        md5.update(value.encode("utf-8"))
+        md5.update(b"\0")
+    return md5.hexdigest()
+
+
+# =============================================================================
+# STAGES
+
+class Stage(object):
+    """A build step and what it depends on.
+    func is called as func(*args, rebuild=...) where rebuild is True if the
+    stage's own inputs changed or an output is missing (False if it's only
+    running because an upstream stage did or it was never recorded, i.e. it
+    can work incrementally). Parallel stages are called without rebuild
+    (func(*args)) and must be picklable."""
+    def __init__(self, name, func, args=(), inputs=(), tables=(), files=(),
+                 deps=(), parallel=False, reads=()):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.inputs = list(inputs)
+        self.tables = list(tables)
+        self.files = list(files)
+        self.deps = list(deps)
+        self.parallel = parallel
+        self.reads = list(reads)
+
+    def __repr__(self):
+        return "<Stage {}>".format(self.name)
+
+
+class Pipeline(object):
+    """An ordered set of Stages run against a database connection."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.stages = []
+        # Where stages can write reports for the current run (if anywhere)
+        self.report_dir = None
+        # The build_runs run_id of the current run (if it's recorded)
+        self.run_id = None
+        self.cur = conn.cursor()
+        self.cur.execute(STAGES_CREATE)
+
+    def __getitem__(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def add(self, stage):
+        """Adds a stage; its deps must have been added already."""
+        names = [s.name for s in self.stages]
+        if stage.name in names:
+            raise ValueError("Duplicate stage: {}".format(stage.name))
+        missing = [d for d in stage.deps if d not in names]
+        if missing:
+            raise ValueError("{} depends on unknown stage(s): {}".format(
+                stage.name, ", ".join(missing)))
+        self.stages.append(stage)
+        return stage
+
+    def recorded(self, name):
+        """Returns the fingerprint a stage last finished with (or None)."""
+        self.cur.execute("SELECT fingerprint FROM build_stages "
+                         "WHERE stage = ?", (name,))
+        row = self.cur.fetchone()
+        return row[0] if row else None
+
+    def record(self, stage, digest):
+        """Stores a finished stage's fingerprint."""
+        self.cur.execute(
+            "INSERT OR REPLACE INTO build_stages VALUES (?, ?, ?)",
+            (stage.name, digest, dt.now().isoformat()))
+        return
+
+    def missing_outputs(self, stage):
+        """Returns the stage's output tables/files that don't exist."""
+        tables = set(self.conn.get_tables()) if stage.tables else set()
+        return ([t for t in stage.tables if t not in tables] +
+                [f for f in stage.files if not os.path.exists(f)])
+
+    def plan(self):
+        """Returns a list of (stage, reason, rebuild) for the stages that
+        need to run, in the order they were added (a dependency order).
+        Inputs written by an upstream stage are hashed again when the stage
+        starts (see run), so rebuild can still turn True then."""
+        stale = {}
+        plan = []
+        for stage in self.stages:
+            recorded = self.recorded(stage.name)
+            missing = self.missing_outputs(stage)
+            upstream = [d for d in stage.deps if d in stale]
+            if missing:
+                reason, rebuild = "missing " + ", ".join(missing), True
+            elif recorded is None:
+                # E.g. a database built before stages were recorded; its
+                #  outputs are there, so bring it up to date incrementally
+                reason, rebuild = "never recorded", False
+            elif recorded != fingerprint(stage.inputs):
+                reason, rebuild = "inputs changed", True
+            elif upstream:
+                reason, rebuild = "after " + ", ".join(upstream), False
+            else:
+                continue
+            stale[stage.name] = rebuild
+            plan.append((stage, reason, rebuild))
+        return plan
+
+    def profile_path(self, profile_dir, stage):
+        """Where a stage's cProfile dump goes (None if not profiling)."""
+        if not profile_dir:
+            return None
+        return os.path.join(profile_dir, "{}.prof".format(
+            re.sub(r"\W", "_", stage.name)))
+
+    def run(self, processes=None, callback=None, run_id=None,
+            profile_dir=None):
+        """Runs the stale stages; returns the names of the stages run.
+        Parallel stages use up to processes workers (default: one per core).
+        callback(stage, reason) is called before each stage is started.
+        If run_id is given (see buildlog.start_run) each stage is measured
+        and added to build_steps; if profile_dir is given each stage writes
+        a cProfile dump there."""
+        self.run_id = run_id
+        plan = self.plan()
+        done = set(s.name for s in self.stages) - set(
+            s.name for s, _, _ in plan)
+        waiting = list(plan)
+        running = {}
+        finished = []
+        pool = None
+        if any(s.parallel for s, _, _ in plan):
+            pool = Pool(processes or cpu_count())
+        try:
+            while waiting or running:
+                ready = [p for p in waiting
+                         if all(d in done for d in p[0].deps)]
+                # Hand the database-free stages to the workers first...
+                for item in [p for p in ready if p[0].parallel]:
+                    stage, reason, _ = item
+                    waiting.remove(item)
+                    if callback:
+                        callback(stage, reason)
+                    step = buildlog.Step(
+                        self.conn, profile=self.profile_path(
+                            profile_dir, stage), db=False).start()
+                    running[stage.name] = (
+                        stage, fingerprint(stage.inputs), step,
+                        pool.apply_async(buildlog.measured_call, (
+                            stage.func, stage.args, step.profile)))
+                # ...then run one of the others here while they work
+                serial = [p for p in ready if not p[0].parallel]
+                if serial:
+                    stage, reason, rebuild = serial[0]
+                    waiting.remove(serial[0])
+                    if callback:
+                        callback(stage, reason)
+                    digest = fingerprint(stage.inputs)
+                    # plan() hashed the inputs before the stages it depends
+                    #  on ran; one of them may have rewritten them since
+                    recorded = self.recorded(stage.name)
+                    if recorded is not None and recorded != digest:
+                        rebuild = True
+                    step = buildlog.Step(
+                        self.conn, stage.reads,
+                        self.profile_path(profile_dir, stage)).start()
+                    buildlog.profile_call(stage.func, stage.args,
+                                          {"rebuild": rebuild}, step.profile)
+                    self.finish(stage, digest, step.stop(), run_id)
+                    done.add(stage.name)
+                    finished.append(stage.name)
+                elif running:
+                    time.sleep(0.1)
+                elif waiting:
+                    # Only possible if a dep was never added
+                    raise RuntimeError("Stages can't run: {}".format(
+                        ", ".join(p[0].name for p in waiting)))
+                for name, item in list(running.items()):
+                    stage, digest, step, result = item
+                    if not result.ready():
+                        continue
+                    # Re-raises a worker's exception
+                    _, cpu_s, peak_rss_kb, rss_growth_kb = result.get()
+                    self.finish(stage, digest, step.stop(
+                        cpu_s, peak_rss_kb, rss_growth_kb), run_id)
+                    del running[name]
+                    done.add(name)
+                    finished.append(name)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return finished
+
+    def finish(self, stage, digest, step, run_id=None):
+        """Records a finished stage (and its measurements)."""
+        self.record(stage, digest)
+        if run_id is not None:
+            buildlog.record_step(self.cur, run_id, stage.name, step)
+        return
@@ -1,9 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import csv
+import itertools
+import os
 import re
+import warnings
+from collections import Counter
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    # Python 3.9+
+    import xml.etree.ElementTree as ET
+
 import pandas as pd
 
+try:
+    import yaml
+except ImportError:
+    # Only needed for report_formats.yaml (see load_formats)
+    yaml = None
+
 
 # =============================================================================
 # VARS
@@ -52,6 +70,9 @@ pub_codes = {
 
 CNTY_OUT = "data/county_permits/processed/cnty_res{}.csv"
 
+# Processed parts of a multi-part report, e.g. parts/cnty_2015_1.csv
+CNTY_PART_OUT = "data/county_permits/processed/parts/{}.csv"
+
 CITIES = ["missoula", "bonner"]  # TODO: Lolo, French Town, Piltzville???
 
 UNITS = {
@@ -62,16 +83,7 @@ UNITS = {
     "multi": "???"
     }
 
-RENAMED_COLUMNS = {
-    "Permit Id": "permit_number",
-    "Geo Code": "geocode",
-    "Issued Date": "permit_issued_date",
-    "Property Address": "address",
-    "Type Of Work": "permit_type",
-    "Description": "description",
-    "Property City": "city"
-    }
-
+# Report columns are renamed by the layouts in data/report_formats.yaml
 ORDERED_COLUMNS = [
     "permit_number",
     "geocode",
@@ -96,51 +108,368 @@ def calc_units(x):
         return 0
 
 
-# =============================================================================
-# PROCESSING FUNCTIONS
+def report_years(rpt_path):
+    """Gets the years of a report from its filename: e.g. ['2015'] for
+    city_2015.xlsx and ['2013', ..., '2016'] for city_2013-2016.xlsx."""
+    name = os.path.basename(rpt_path)
+    years = re.findall(r"\d{4}", name)
+    if len(years) < 2:
+        return [re.findall(r"\d+", name)[0]]
+    return [str(y) for y in range(int(years[0]), int(years[-1]) + 1)]
+
+
+def report_owners(rpt_paths):
+    """Decides which report each year's permits come from when city reports
+    overlap (e.g. city_2013-2016.csv next to the old city_2013.xlsx): a
+    report covering fewer years wins, then the newest file. Returns a list
+    of (report, years it owns) for the reports that own any; the others'
+    years are left out with a warning."""
+    owners = {}
+    for path in sorted(rpt_paths, key=lambda p: (
+            len(report_years(p)), -os.path.getmtime(p), p)):
+        for year in report_years(path):
+            if year in owners:
+                warnings.warn("Ignoring {} of {} (using {})".format(
+                    year, os.path.basename(path),
+                    os.path.basename(owners[year])))
+            else:
+                owners[year] = path
+    owned = [(path, [y for y in report_years(path) if owners[y] == path])
+             for path in sorted(rpt_paths)]
+    return [(path, years) for path, years in owned if years]
+
+
+def latest_exports(rpt_paths):
+    """Keeps the newest of the exports with the same name (e.g. a year
+    re-exported as cnty_2016.csv next to cnty_2016.xlsx), with a warning
+    about the others."""
+    latest = {}
+    for path in sorted(rpt_paths, key=lambda p: (-os.path.getmtime(p), p)):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in latest:
+            warnings.warn("Ignoring {} (using {})".format(
+                os.path.basename(path), os.path.basename(latest[name])))
+        else:
+            latest[name] = path
+    return sorted(latest.values())
 
-def city_permits(all_permits):
-    """Cleans, preps, and exports building permit reports."""
-    # Open raw constuction-permit report as DataFrame 'all_const'
-    all_const = pd.read_excel(all_permits)
 
-    # =========================================================================
-    # CLEAN
+# =============================================================================
+# READING REPORTS
+
+# Reports can be exported as any of these
+REPORT_EXTS = [".xlsx", ".csv", ".xml"]
+
+# Layouts of the reports, recognized by the columns of their header row
+REPORT_FORMATS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "..", "data", "report_formats.yaml")
+
+# Rows searched for the header row (exports start with title rows)
+SNIFF_ROWS = 20
+
+# Rows read at a time by iter_report
+CHUNK_ROWS = 50000
+
+
+def header_name(name):
+    """Column name as the permit tables use it: lowercase, "_" for spaces."""
+    return u"{}".format(name).strip().lower().replace(" ", "_")
+
+
+def load_formats(path=REPORT_FORMATS):
+    """Reads the report layouts: {name: {system, signature, columns}}."""
+    if yaml is None:
+        raise ImportError("Reading {} needs PyYAML (pip install pyyaml)"
+                          .format(path))
+    with open(path, "r") as f:
+        return yaml.safe_load(f)
+
+
+def _xml_rows(path):
+    """Yields the cells ({name: value}) of an SSRS XML export's detail rows,
+    streamed with iterparse. Detail rows are the childless elements with
+    attributes; their tag is the most common one among the first few.
+    Finished elements are cleared and removed from their parent, so memory
+    doesn't grow with the number of rows."""
+    tags = Counter()
+    first = []
+    detail = None
+    # The open elements, and whether each has children
+    stack = []
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if stack:
+                stack[-1][1] = True
+            stack.append([elem, False])
+            continue
+        _, has_children = stack.pop()
+        if not has_children and elem.attrib:
+            if detail is None:
+                tags[elem.tag] += 1
+                first.append((elem.tag, dict(elem.attrib)))
+                if len(first) >= SNIFF_ROWS:
+                    detail = tags.most_common(1)[0][0]
+                    for tag, row in first:
+                        if tag == detail:
+                            yield row
+            elif elem.tag == detail:
+                yield dict(elem.attrib)
+        elem.clear()
+        if stack:
+            stack[-1][0].remove(elem)
+    # Short exports
+    if detail is None and first:
+        detail = tags.most_common(1)[0][0]
+        for tag, row in first:
+            if tag == detail:
+                yield row
+
+
+def read_xml(path):
+    """Reads an SSRS XML export: each detail row is an element whose
+    attributes are its cells (named after the report's textboxes)."""
+    rows = list(_xml_rows(path))
+    if not rows:
+        return pd.DataFrame()
+    columns = list(rows[0].keys())
+    for r in rows:
+        columns.extend(k for k in r if k not in columns)
+    return pd.DataFrame(rows, columns=columns)
+
+
+def open_workbook(path):
+    """Opens an .xlsx report read-only with openpyxl (only .xlsx reports need
+    it)."""
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImportError("Reading {} needs openpyxl (pip install openpyxl); "
+                          "or export the report as .csv or .xml".format(path))
+    return openpyxl.load_workbook(path, read_only=True)
+
+
+def sniff_rows(path, n=SNIFF_ROWS):
+    """Returns the first n rows of a report (lists of cells) without reading
+    the rest of it. An XML export's 'row' is its column names."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        with open(path, "r") as f:
+            return [row for _, row in zip(range(n), csv.reader(f))]
+    if ext == ".xml":
+        row = next(_xml_rows(path), None)
+        return [list(row.keys())] if row else []
+    if ext == ".xlsx":
+        wb = open_workbook(path)
+        try:
+            return [[c.value for c in row]
+                    for row in wb.worksheets[0].iter_rows(max_row=n)]
+        finally:
+            wb.close()
+    raise IOError("Unknown report format: {}".format(path))
+
+
+def sniff_format(path, formats=None, n=SNIFF_ROWS):
+    """Finds a report's layout from its first n rows.
+    Returns (format name, format, index of the header row); raises a
+    ValueError if no format's signature matches."""
+    if formats is None:
+        formats = load_formats()
+    rows = sniff_rows(path, n)
+    for i, row in enumerate(rows):
+        names = set(header_name(v) for v in row
+                    if not pd.isnull(v) and u"{}".format(v).strip())
+        matches = [(len(f["signature"]), name) for name, f in formats.items()
+                   if set(f["signature"]) <= names]
+        if matches:
+            name = max(matches)[1]
+            return name, formats[name], i
+    raise ValueError("Unknown report layout in {}; add it to {}".format(
+        path, REPORT_FORMATS))
+
+
+def _check_format(path, system=None, formats=None):
+    """Returns a report's (format, header row index); the format has to be
+    one of system's ('city' or 'county') if given."""
+    name, fmt, skip = sniff_format(path, formats)
+    if system and fmt["system"] != system:
+        raise ValueError("{} is a {} report ({}), not a {} one".format(
+            path, fmt["system"], name, system))
+    return fmt, skip
+
+
+def _name_columns(df, fmt):
+    """Drops the columns without a name and renames the rest with
+    header_name and the format's columns mapping."""
+    df = df[[c for c in df.columns if not pd.isnull(c)]]
+    df.columns = [header_name(c) for c in df.columns]
+    return df.rename(columns=fmt.get("columns") or {})
+
+
+def read_report(path, system=None, formats=None):
+    """Reads a report export (.xlsx, .csv, or SSRS .xml) into a DataFrame.
+    The layout is sniffed from the first rows (see sniff_format): rows above
+    the header row (titles) are skipped, the columns are renamed with
+    header_name and then the format's columns mapping. Columns with no values
+    are dropped. CSV and XML values are read as text.
+    If system is given ('city' or 'county') the layout must be one of its."""
+    fmt, skip = _check_format(path, system, formats)
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        # Pandas' C parser, from the header row on
+        df = pd.read_csv(path, skiprows=skip, header=0, dtype=str,
+                         engine="c")
+    elif ext == ".xml":
+        df = read_xml(path)
+    else:
+        df = pd.read_excel(path, header=None)
+        df.columns = df.iloc[skip]
+        df = df.iloc[skip + 1:]
+    df = _name_columns(df.dropna(axis=1, how="all"), fmt)
+    return df.reset_index(drop=True)
+
+
+def _batches(rows, size):
+    """Groups an iterable into lists of up to size items."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_report(path, system=None, chunksize=CHUNK_ROWS, formats=None,
+                empty=None):
+    """Reads a report like read_report, but yields it in DataFrames of up to
+    chunksize rows, so only one chunk is in memory at a time. All chunks have
+    the same columns (a report with no rows yields one empty chunk). Columns
+    with no values can only be told once every chunk has been read: if a set
+    is passed as empty, it then gets the ones read_report would drop (none
+    for a report with no rows)."""
+    fmt, skip = _check_format(path, system, formats)
+    ext = os.path.splitext(path)[1].lower()
+    wb = None
+    if ext == ".csv":
+        chunks = pd.read_csv(path, skiprows=skip, header=0, dtype=str,
+                             engine="c", chunksize=chunksize)
+        columns = []
+    elif ext == ".xml":
+        rows = _xml_rows(path)
+        first = next(rows, None)
+        columns = list(first.keys()) if first else []
+        if first is not None:
+            rows = itertools.chain([first], rows)
+        chunks = (pd.DataFrame(batch, columns=columns)
+                  for batch in _batches(rows, chunksize))
+    else:
+        wb = open_workbook(path)
+        rows = ([c.value for c in row] for row in wb.worksheets[0].iter_rows(
+            min_row=skip + 1))
+        # Formatted but empty rows at the end of the sheet
+        rows = (row for row in rows if any(v is not None for v in row))
+        columns = next(rows)
+        chunks = (pd.DataFrame(batch, columns=columns)
+                  for batch in _batches(rows, chunksize))
+    names = None
+    filled = set()
+    try:
+        for chunk in chunks:
+            chunk = _name_columns(chunk, fmt)
+            names = list(chunk.columns)
+            filled.update(chunk.columns[chunk.notnull().any().values])
+            yield chunk
+        if names is None:
+            # No rows: keep the layout's columns rather than none
+            chunk = _name_columns(pd.DataFrame(columns=columns), fmt)
+            names = list(chunk.columns)
+            filled.update(names)
+            yield chunk
+    finally:
+        if wb is not None:
+            wb.close()
+    if empty is not None:
+        empty.update(c for c in names if c not in filled)
 
-    # Drop columns will all NULL values
-    all_const.dropna(axis=1, how='all', inplace=True)
 
-    # Rename cols from values in row 3: lowercase and replace spaces with "_"
-    all_const.columns = all_const.ix[3].apply(
-        lambda x: x.lower().replace(" ", "_"))
+# =============================================================================
+# STREAMING GROUP BY
+
+class FirstReducer(object):
+    """A streaming groupby(keys).first().
+
+    Chunks are added one at a time; for every group and column only the
+    first non-null value so far is kept -- first by the order columns, then
+    by position in the input -- so memory grows with the number of groups
+    rather than with the rows. result() is the same as concatenating the
+    chunks, sorting them by keys + order, and taking .first().
+    """
+    def __init__(self, keys, order=()):
+        self.keys = list(keys)
+        self.order = list(order)
+        self.columns = None
+        self.groups = None
+        self.firsts = {}
+        self.rows = 0
+
+    def add(self, chunk):
+        chunk = chunk.dropna(subset=self.keys)
+        if self.columns is None:
+            self.columns = [c for c in chunk.columns if c not in self.keys]
+        # Position in the input breaks ties
+        chunk = chunk.assign(_row=range(self.rows, self.rows + len(chunk)))
+        self.rows += len(chunk)
+        by = self.keys + self.order + ["_row"]
+        self.groups = self._first(self.groups, chunk[self.keys])
+        for col in self.columns:
+            cols = by if col in by else by + [col]
+            self.firsts[col] = self._first(
+                self.firsts.get(col), chunk.loc[chunk[col].notnull(), cols])
+        return
+
+    def _first(self, kept, new):
+        """The first row of each group in kept and new."""
+        both = new if kept is None else pd.concat([kept, new])
+        if "_row" in both.columns:
+            both = both.sort_values(self.keys + self.order + ["_row"],
+                                    kind="mergesort")
+        return both.drop_duplicates(self.keys)
+
+    def result(self):
+        """The first values of every group, one row per group (sorted by the
+        keys), like groupby(keys).first().reset_index()."""
+        if self.groups is None:
+            # Nothing was added
+            return pd.DataFrame(columns=self.keys + (self.columns or []))
+        out = self.groups
+        for col in self.columns:
+            out = out.merge(self.firsts[col][self.keys + [col]],
+                            on=self.keys, how="left")
+        return out.sort_values(self.keys).reset_index(drop=True)
 
-    # Shorten 'dwellings' column name
-    # NOTE: units are not always dwellings
-    #   (e.g. carport with 2 units means 2 cars)
-    all_const.rename(columns={"number_of_dwellings": "dwellings"},
-                     inplace=True)
 
+# =============================================================================
+# PROCESSING FUNCTIONS
+
+def clean_city(all_const):
+    """Cleans a city report (or a chunk of one) read by read_report."""
     # Rename index column 'ix'
     all_const.columns.name = 'ix'
 
-    # Drop rows 0-3 which are just headings
-    all_const.drop([0, 1, 2, 3], inplace=True)
-
-    # Rename subtype column to permit_type
-    all_const.rename(columns={"subtype": "permit_type"},
-                     inplace=True)
     # Remove Subtype field descriptions
-    all_const['permit_type'].fillna("None", inplace=True)
-    all_const['permit_type'] = all_const['permit_type'].apply(
+    #  (assigned rather than filled in place: a column of a frame may be a
+    #  copy, and a text column can't be filled with a number)
+    all_const['permit_type'] = all_const['permit_type'].fillna("None").apply(
         lambda x: x.split(" ")[0])
 
-    # Convert NULL dwellings to 0
-    all_const['dwellings'].fillna(0, inplace=True)
-    # Convert Dwellings to integer
-    all_const['dwellings'] = all_const['dwellings'].apply(lambda x: int(x))
+    # Convert NULL dwellings to 0 and the rest to integers
+    #  (values from CSV/XML reports are text, e.g. "2")
+    all_const['dwellings'] = all_const['dwellings'].apply(
+        lambda x: 0 if pd.isnull(x) else int(float(x)))
 
     # Convert NULL addresses to ""
-    all_const['address'].fillna("", inplace=True)
+    all_const['address'] = all_const['address'].fillna("")
 
     # Convert Geocode to text
     all_const['geocode'] = all_const['geocode'].apply(lambda x: str(x))
@@ -154,30 +483,23 @@ def city_permits(all_permits):
     
     # Select all records that don't have 'MSTR' in the address
     all_const = all_const[~all_const.address.str.contains("MSTR")]
-    
-    # Sort data
-    all_const = all_const.sort(["permit_number", "address", "dwellings"])
-
-    # =========================================================================
-    # GET PERMIT YEAR / ADD YEAR TO OUTPUT REPORT
 
-    years = set()
-    all_const["permit_issued_date"].apply(lambda x: years.add(x.year))
-    assert len(years) == 1, \
-        "Input data shall only consist of one calendar year"
+    # Standardize date column (years are split off by city_permits)
+    all_const["permit_issued_date"] = pd.to_datetime(
+        all_const["permit_issued_date"])
+    return all_const
 
-    year = years.pop()
-
-    # =========================================================================
-    # GENERATE REPORTS
 
+def city_residential(all_const):
+    """Selects the residential permits of a cleaned city report (not grouped
+    by permit yet)."""
     # Create DataFrames for each group of building codes
     '''
     res_const = all_const[(all_const['subtype'].isin(res_codes.keys())) &
                           (all_const['dwellings'] > 0)]
     '''
     # Residential Permit Query
-    res_const = all_const[
+    return all_const[
         # Get permits with >= 3 units filed as commercial
         ((all_const["dwellings"] >= 3) &
          (all_const["construction_type"] == "Commercial Construction") &
@@ -186,19 +508,71 @@ def city_permits(all_permits):
         #   dwellings >= 1
         ((all_const["permit_type"].isin(res_codes.keys()) &
             all_const["dwellings"] >= 1))
+        ]
+
+
+def write_years(res_const, years, out_fmt=CITY_OUT):
+    """Writes one csv per year (e.g. CITY_OUT) of the permits issued in it.
+    Every year gets a csv, even with no permits; permits issued in other
+    years belong to another report and are dropped with a warning.
+    Returns the paths written."""
+    issued = pd.to_datetime(res_const["permit_issued_date"]).dt.year
+    other = res_const[~issued.isin([int(y) for y in years])]
+    if len(other):
+        warnings.warn("Dropped {} permits issued outside of {}".format(
+            len(other), ", ".join(years)))
+    paths = []
+    for year in years:
+        paths.append(out_fmt.format(year))
+        res_const[issued == int(year)].to_csv(paths[-1], index=False)
+    return paths
+
+
+def city_permits(all_permits, out=True, chunksize=None, years=None):
+    """Cleans, preps, and exports building permit reports.
+    A report that spans several years is written out as one csv per year of
+    permit_issued_date (see write_years); years defaults to the ones in its
+    filename (report_years).
+    With chunksize, the report is read, cleaned, and filtered that many rows
+    at a time and the permits are grouped with a FirstReducer, so memory use
+    doesn't grow with the size of the report."""
+    # Open raw constuction-permit report as DataFrame 'all_const'
+    #  (headings dropped; cols lowercase, spaces replaced with "_", and
+    #  renamed by the report's format, e.g. subtype to permit_type)
+    # NOTE: units are not always dwellings
+    #   (e.g. carport with 2 units means 2 cars)
+    if chunksize:
+        reducer = FirstReducer(["permit_number", "geocode"],
+                               ["address", "dwellings"])
+        empty = set()
+        for chunk in iter_report(all_permits, "city", chunksize, empty=empty):
+            reducer.add(city_residential(clean_city(chunk)))
+        res_const = reducer.result()
+        # Leave out the report's columns with no values, like read_report
+        res_const = res_const.drop([c for c in res_const.columns if c in empty
+                                    and res_const[c].isnull().all()], axis=1)
+    else:
+        all_const = clean_city(read_report(all_permits, "city"))
+
+        # Sort data
+        all_const = all_const.sort_values(
+            ["permit_number", "address", "dwellings"], kind="mergesort")
+
         # Finally, groupby permit number, remove duplicates and fix index col
         # ].groupby("permit_number").first().reset_index()
-        ].groupby(["permit_number", "geocode"]).first().reset_index()
+        res_const = city_residential(all_const).groupby(
+            ["permit_number", "geocode"]).first().reset_index()
 
     # TODO: maybe make reports for other construction types too?
     '''
     com_const = all_const[all_const['subtype'].isin(com_codes.keys())]
     pub_const = all_const[all_const['subtype'].isin(pub_codes.keys())]
     '''
-    # Export
-    res_out = res_const.groupby('permit_number').first().reset_index()
+    # Export a report per year (the input can span several years)
+    # res_out = res_const.groupby('permit_number').first().reset_index()
     # res_out.to_excel(res_report, index=False)
-    res_const.to_csv(CITY_OUT.format(year), index=False)
+    if out:
+        write_years(res_const, years or report_years(all_permits))
 
     '''
     com_out = com_const.groupby('permit_number').first().reset_index()
@@ -210,23 +584,16 @@ def city_permits(all_permits):
     return res_const
 
 
-def county_permits(permits, out=True):
-    """Processes County building permits in the Odyssey-system format."""
-    # Only accept XLSX files
-    if not permits.lower().endswith(".xlsx"):
-        raise IOError("Input must be manually cleaned and converted to XLSX")
-    # Get year from filename
-    year = re.findall("\d+", permits)[0]
-    # Read the data
-    df = pd.read_excel(permits)
+def clean_county(df):
+    """Cleans a county report (or a chunk of one) read by read_report and
+    selects its residential permits."""
     # Convert NA_VALUES to real NaN (technically a pandas subclass of float)
-    df = df.applymap(lambda x: pd.np.nan if x in NA_VALUES else x)
-    # Rename columns and drop those that aren't listed in the rename process
-    df.rename(columns=RENAMED_COLUMNS, inplace=True)
-    [df.drop(col, 1, inplace=True) for col in df.columns
-     if col not in RENAMED_COLUMNS.values()]
+    df = df.mask(df.isin(NA_VALUES))
+    # Drop columns that aren't used
+    df = df.drop([col for col in df.columns if col not in ORDERED_COLUMNS],
+                 axis=1)
     # and drop rows where all values are NaN
-    df.dropna(how="all", inplace=True)
+    df = df.dropna(how="all")
 
     # Capitalize addresses
     df["address"] = df["address"].str.upper()
@@ -240,30 +607,86 @@ def county_permits(permits, out=True):
     df["dwellings"] = df["description"].apply(calc_units)
 
     # Query out New Construction, in nearby CITIES, that contain DESC_KEYWORDS
-    res_const = df[(df["permit_type"] == "New Construction") &
-                   (df["city"].apply(lambda x: x.lower() in CITIES)) &
-                   (df["description"].str.contains(DESC_KEYWORDS))].copy()
+    return df[(df["permit_type"] == "New Construction") &
+              (df["city"].apply(lambda x: x.lower() in CITIES)) &
+              (df["description"].str.contains(DESC_KEYWORDS))].copy()
+
+
+def county_permits(permits, out=True, sort=True, chunksize=None):
+    """Processes County building permits in one of the Odyssey-system
+    formats (.xlsx, .csv, or .xml).
+    With chunksize, the report is read and cleaned that many rows at a time
+    (only the residential permits are kept in memory)."""
+    # Get year from filename
+    year = re.findall(r"\d+", os.path.basename(permits))[0]
+    # Read the data (columns renamed by the report's format)
+    if chunksize:
+        res_const = pd.concat(
+            [clean_county(chunk) for chunk in iter_report(
+                permits, "county", chunksize)], ignore_index=True)
+    else:
+        res_const = clean_county(read_report(permits, "county"))
 
     # Standardize date column
     res_const["permit_issued_date"] = pd.to_datetime(
-        res_const["permit_issued_date"], infer_datetime_format=True)
+        res_const["permit_issued_date"])
     # Order columns and sort by date
-    res_const = res_const[ORDERED_COLUMNS].sort("permit_issued_date")
+    res_const = res_const[ORDERED_COLUMNS]
+    if sort:
+        res_const = res_const.sort_values("permit_issued_date",
+                                          kind="mergesort")
     if out:
         res_const.to_csv(CNTY_OUT.format(year), index=False)
     return res_const
 
 
-def combine_odyssey(permits1, permits2, output_intermediate=False):
-    """Used for the 2015 conversion to Odyssey permit system."""
-    # Process and combine the two 2015 permit sets
-    df_one = county_permits(permits1, output_intermediate)
-    df_two = county_permits(permits2, output_intermediate)
-    full_df = df_one.append(df_two)
+# =============================================================================
+# MULTI-PART REPORTS
+# A year's county report can come in any number of parts, e.g. the 2015
+#  Odyssey switch (cnty_2015_1.xlsx, cnty_2015_2.xlsx) or split exports
+
+def part_number(path):
+    """The number of a report part, e.g. 10 for cnty_2015_10.xlsx (0 for a
+    whole year's report); sorts a year's parts 1, 2, ..., 10."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    parts = name.split("_")
+    if len(parts) > 2 and parts[-1].isdigit():
+        return int(parts[-1])
+    return 0
+
+
+def part_permits(permits, chunksize=None):
+    """Processes one part of a year's county report to its own csv (see
+    merge_parts); returns the csv's path."""
+    name = os.path.splitext(os.path.basename(permits))[0]
+    out = CNTY_PART_OUT.format(name)
+    if not os.path.exists(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out))
+    county_permits(permits, out=False, sort=False,
+                   chunksize=chunksize).to_csv(out, index=False)
+    return out
+
+
+def merge_permits(frames, year=None):
+    """Combines the processed permits of a year's parts: one concat, permits
+    in more than one part are kept from the last one, and one sort by date.
+    Writes the year's report if year is given."""
+    full_df = pd.concat(frames, ignore_index=True)
+    full_df = full_df.drop_duplicates("permit_number", keep="last")
     # Standardize date column
     full_df["permit_issued_date"] = pd.to_datetime(
-        full_df["permit_issued_date"], infer_datetime_format=True)
+        full_df["permit_issued_date"])
     # Order columns and sort by date
-    full_df = full_df[ORDERED_COLUMNS].sort("permit_issued_date")
-    full_df.to_csv(CNTY_OUT.format("2015"), index=False)
-    return
+    full_df = full_df[ORDERED_COLUMNS].sort_values(
+        "permit_issued_date", kind="mergesort")
+    if year:
+        full_df.to_csv(CNTY_OUT.format(year), index=False)
+    return full_df
+
+
+def merge_parts(year, part_csvs):
+    """Merges the csvs of a year's parts (see part_permits) into the year's
+    report; later parts win (see merge_permits)."""
+    return merge_permits(
+        [pd.read_csv(p, dtype={"geocode": str})
+         for p in sorted(part_csvs, key=part_number)], year)
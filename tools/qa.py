@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+qa.py -- Spatialization QA
+Author: Garin Wally; Oct 2016
+
+Match rates of the permit tables, computed with one aggregate query each
+(nothing is fetched row by row) and stored in 'qa_match_stats' so they can be
+compared across builds:
+
+    method        what was counted
+    geocode, ...  permits spatialized by each method (spatialize.sql's notes)
+    unmatched     permits left without geometry
+    parcel_join   permits whose geocode is a ufda_parcels parcelid
+    addr_join     permits whose address is a ufda_addrs fulladdress
+
+The 'qa_match_years' view adds up the city and county tables of each year.
+"""
+
+import re
+from datetime import datetime as dt
+
+from tools import statements
+
+
+# =============================================================================
+# DATA
+
+STATS_CREATE = ("CREATE TABLE IF NOT EXISTS qa_match_stats ("
+                "measured TEXT, run_id INTEGER, permit_table TEXT, "
+                "year TEXT, method TEXT, permits INTEGER, matched INTEGER, "
+                "rate REAL)")
+
+# Per build (stats recorded outside of a build are kept on their own)
+YEARS_CREATE = ("CREATE VIEW IF NOT EXISTS qa_match_years AS "
+                "SELECT MAX(measured) AS measured, run_id, year, method, "
+                "  SUM(permits) AS permits, SUM(matched) AS matched, "
+                "  1.0 * SUM(matched) / SUM(permits) AS rate "
+                "FROM qa_match_stats "
+                "GROUP BY COALESCE(run_id, measured), year, method")
+
+# Rows the cascade didn't find keep the last method tried in notes
+METHOD_QRY = ("SELECT CASE WHEN geometry IS NULL THEN 'unmatched' "
+              "  ELSE COALESCE(notes, 'unknown') END AS method, COUNT(*) "
+              "FROM {table} GROUP BY method ORDER BY method")
+
+PARCEL_QRY = ("SELECT COUNT(*), COUNT(u.parcelid) "
+              "FROM {table} p LEFT JOIN ("
+              "  SELECT DISTINCT parcelid FROM ufda_parcels "
+              "  WHERE geometry IS NOT NULL) u "
+              "ON u.parcelid = p.geocode")
+
+ADDR_QRY = ("SELECT COUNT(*), COUNT(a.fulladdress) "
+            "FROM {table} p LEFT JOIN ("
+            "  SELECT DISTINCT fulladdress FROM ufda_addrs) a "
+            "ON a.fulladdress = p.address")
+
+
+# =============================================================================
+# MATCH RATES
+
+def rate(matched, permits):
+    """matched/permits as a float (0.0 for an empty table)."""
+    return float(matched) / permits if permits else 0.0
+
+
+def table_year(permit_table):
+    """Gets the year of a permit table, e.g. 2015 for cnty_res2015."""
+    return re.findall(r"\d{4}", permit_table)[-1]
+
+
+def parcel_matches(conn, permit_table):
+    """Returns (permits, permits with a parcel)."""
+    return tuple(statements.execute(
+        conn, PARCEL_QRY, table=permit_table).fetchone())
+
+
+def addr_matches(conn, permit_table):
+    """Returns (permits, permits with an address point)."""
+    return tuple(statements.execute(
+        conn, ADDR_QRY, table=permit_table).fetchone())
+
+
+def method_matches(conn, permit_table):
+    """Returns a list of (method, permits spatialized by it); permits without
+    geometry are counted as 'unmatched'."""
+    return [tuple(r) for r in statements.execute(
+        conn, METHOD_QRY, table=permit_table).fetchall()]
+
+
+def match_stats(conn, permit_table):
+    """Returns a list of (method, permits, matched, rate) for a table."""
+    permits, parcels = parcel_matches(conn, permit_table)
+    _, addrs = addr_matches(conn, permit_table)
+    stats = [(method, permits, n, rate(n, permits))
+             for method, n in method_matches(conn, permit_table)]
+    stats.append(("parcel_join", permits, parcels, rate(parcels, permits)))
+    stats.append(("addr_join", permits, addrs, rate(addrs, permits)))
+    return stats
+
+
+def record_stats(conn, permit_table, run_id=None):
+    """Adds a table's match_stats to qa_match_stats; returns the stats."""
+    cur = conn.cursor()
+    cur.execute(STATS_CREATE)
+    cur.execute(YEARS_CREATE)
+    stats = match_stats(conn, permit_table)
+    measured = dt.now().isoformat()
+    year = table_year(permit_table)
+    cur.executemany(
+        "INSERT INTO qa_match_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(measured, run_id, permit_table, year) + s for s in stats])
+    return stats
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+reportserver.py -- Accela report downloads
+Author: Garin Wally; Oct 2016
+
+The city permit reports come from the Accela report server (SSRS). Instead of
+driving a browser through the ReportViewer page, reports are rendered with
+SSRS URL access -- one GET with the report's parameters and an export format
+-- and the response is streamed straight to a file:
+
+    http://cpdbprod/ReportServer?/Land/Statistics/New Construction Report
+        &rs:Command=Render&rs:Format=EXCELOPENXML
+        &StartDate=01/01/2016&EndDate=12/31/2016
+
+A ReportClient keeps one pooled HTTP session (so repeated downloads reuse the
+connection), times out requests that hang, and retries failed renders.
+
+    >>> client = ReportClient()
+    >>> client.download_permits("01/01/2016", "12/31/2016")
+    'data/city_permits/raw/city_2016.xlsx'
+
+Longer ranges are downloaded by download_years in month chunks, several at a
+time. Finished chunks are listed in a manifest (raw/chunks/manifest.json), so
+a run that's interrupted -- or has a render fail -- picks up where it left
+off; each year's chunks are stitched into its city_<year>.xlsx at the end.
+
+During the year, download_delta only asks for the permits issued since the
+last ones loaded (less a few days of overlap, for permits entered late) and
+merges them into the year's file, in whichever format (.xlsx, .csv, or .xml)
+it was downloaded as.
+"""
+
+import csv
+import json
+import os
+import re
+from collections import OrderedDict
+from datetime import date, datetime as dt, timedelta
+from multiprocessing.pool import ThreadPool
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    # Python 2
+    from urllib import quote
+
+from tools import process
+
+
+# =============================================================================
+# DATA
+
+REPORT_SERVER = "http://cpdbprod/ReportServer"
+
+PERMIT_REPORT = "/Land/Statistics/New Construction Report"
+
+# Names of the report's date parameters (the ReportViewer's date boxes)
+START_PARAM = "StartDate"
+END_PARAM = "EndDate"
+
+# SSRS rendering extension names and the extensions of their exports
+FORMATS = {
+    "EXCELOPENXML": ".xlsx",
+    "CSV": ".csv",
+    "XML": ".xml"
+    }
+
+CITY_RAW = "data/city_permits/raw/city_{}{}"
+
+# Seconds to wait for a connection / between bytes of the response (renders
+# of a whole year can take a while before the first byte)
+TIMEOUT = (10, 300)
+
+RETRIES = 3
+
+# Statuses worth retrying: the server is busy or the render failed
+RETRY_STATUSES = (500, 502, 503, 504)
+
+CHUNK_SIZE = 64 * 1024
+
+CHUNK_DIR = "data/city_permits/raw/chunks"
+
+# E.g. 'city_20160101_20160131.xlsx'
+CHUNK_FMT = "city_{:%Y%m%d}_{:%Y%m%d}{}"
+
+# Rows of the permit report's export before the first permit: the title
+# rows and the column names (see process.city_permits)
+HEADER_ROWS = 5
+
+PROCESSES = 4
+
+# Days before the last loaded permit that a delta download starts from
+OVERLAP_DAYS = 7
+
+
+class ReportServerError(IOError):
+    """The report server answered with something that isn't an export."""
+    pass
+
+
+# =============================================================================
+# UTILITIES
+
+def as_date(value):
+    """Returns a date for a date or a 'mm/dd/yyyy' string."""
+    if isinstance(value, date):
+        return value
+    return dt.strptime(value, "%m/%d/%Y").date()
+
+
+def date_param(value):
+    """Formats a date (or passes a 'mm/dd/yyyy' string through) for SSRS."""
+    if isinstance(value, date):
+        return value.strftime("%m/%d/%Y")
+    return value
+
+
+def render_url(report, params, fmt="EXCELOPENXML", server=REPORT_SERVER):
+    """Returns the URL-access URL that renders a report to fmt.
+    params is a list of (name, value) report parameters."""
+    query = [quote(report, safe="/"), "rs:Command=Render",
+             "rs:Format={}".format(fmt)]
+    query.extend("{}={}".format(quote(name), quote(date_param(value), "/"))
+                 for name, value in params)
+    return "{}?{}".format(server, "&".join(query))
+
+
+def make_session(retries=RETRIES, pool_size=4, backoff=0.5, auth=None):
+    """Returns a requests session with a connection pool of pool_size and
+    retries (with exponential backoff) on connection errors and
+    RETRY_STATUSES."""
+    session = requests.Session()
+    retry = Retry(total=retries, connect=retries, read=retries,
+                  status=retries, backoff_factor=backoff,
+                  status_forcelist=RETRY_STATUSES)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # E.g. requests_ntlm.HttpNtlmAuth for a server using Windows logins
+    session.auth = auth
+    return session
+
+
+# =============================================================================
+# CLIENT
+
+class ReportClient(object):
+    """Renders reports on a report server and saves the exports."""
+    def __init__(self, server=REPORT_SERVER, session=None, timeout=TIMEOUT):
+        self.server = server
+        self.session = session or make_session()
+        self.timeout = timeout
+
+    def close(self):
+        self.session.close()
+
+    def export(self, report, params, out, fmt="EXCELOPENXML"):
+        """Renders a report and streams the export to out. The file is written
+        under a temporary name first, so a failed download never leaves a
+        partial report behind. Returns out."""
+        url = render_url(report, params, fmt, self.server)
+        out_dir = os.path.dirname(out)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        part = out + ".part"
+        resp = self.session.get(url, stream=True, timeout=self.timeout)
+        try:
+            resp.raise_for_status()
+            # Errors in the report (e.g. a bad parameter) come back as a page
+            if "text/html" in resp.headers.get("Content-Type", ""):
+                raise ReportServerError(
+                    "{} returned a page instead of a {} export".format(
+                        url, fmt))
+            with open(part, "wb") as f:
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+        except Exception:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        finally:
+            resp.close()
+        if os.path.exists(out):
+            os.remove(out)
+        os.rename(part, out)
+        return out
+
+    def download_permits(self, from_date, to_date, out=None,
+                         fmt="EXCELOPENXML"):
+        """Downloads the city's construction permits issued between two dates
+        (inclusive; dates or 'mm/dd/yyyy' strings). Saves to
+        data/city_permits/raw/city_<year of to_date>.xlsx by default."""
+        if out is None:
+            year = date_param(to_date).split("/")[-1]
+            out = CITY_RAW.format(year, FORMATS[fmt])
+        params = [(START_PARAM, from_date), (END_PARAM, to_date)]
+        return self.export(PERMIT_REPORT, params, out, fmt)
+
+
+# =============================================================================
+# CHUNKED DOWNLOADS
+
+def month_chunks(from_date, to_date, months=1):
+    """Splits a date range (inclusive) into (start, end) ranges of up to
+    months calendar months each."""
+    start, end = as_date(from_date), as_date(to_date)
+    chunks = []
+    while start <= end:
+        month = start.month - 1 + months
+        next_start = date(start.year + month // 12, month % 12 + 1, 1)
+        chunks.append((start, min(next_start - timedelta(days=1), end)))
+        start = next_start
+    return chunks
+
+
+class ChunkManifest(object):
+    """The chunks of a download that are finished, saved as JSON after each
+    one so an interrupted download can be resumed."""
+    def __init__(self, path):
+        self.path = path
+        self.chunks = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.chunks = json.load(f)
+
+    def done(self, name):
+        """True if a chunk was downloaded (and its file is still there)."""
+        return name in self.chunks and os.path.exists(self.chunks[name])
+
+    def add(self, name, path):
+        self.chunks[name] = path
+        self.save()
+
+    def remove(self, names):
+        for name in names:
+            self.chunks.pop(name, None)
+        self.save()
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.chunks, f, indent=2, sort_keys=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+
+def download_chunks(client, chunks, chunk_dir=CHUNK_DIR,
+                    processes=PROCESSES, callback=None):
+    """Downloads the permits of (start, end) chunks, processes at a time,
+    skipping chunks the manifest in chunk_dir lists as done. callback is
+    called with each chunk's (start, end) as it finishes.
+    Returns the chunk files in order; raises a ReportServerError after the
+    others are done if any chunk failed (run it again to resume)."""
+    if not os.path.exists(chunk_dir):
+        os.makedirs(chunk_dir)
+    manifest = ChunkManifest(os.path.join(chunk_dir, "manifest.json"))
+    paths = OrderedDict(
+        (chunk, os.path.join(chunk_dir, CHUNK_FMT.format(
+            chunk[0], chunk[1], ".xlsx"))) for chunk in chunks)
+
+    def fetch(chunk):
+        try:
+            client.download_permits(chunk[0], chunk[1], paths[chunk])
+        except Exception as e:
+            return chunk, e
+        return chunk, None
+
+    pending = [c for c, path in paths.items()
+               if not manifest.done(os.path.basename(path))]
+    failed = []
+    pool = ThreadPool(processes)
+    try:
+        # The manifest is only written from this thread
+        for chunk, error in pool.imap_unordered(fetch, pending):
+            if error:
+                failed.append((chunk, error))
+                continue
+            manifest.add(os.path.basename(paths[chunk]), paths[chunk])
+            if callback:
+                callback(chunk)
+    finally:
+        pool.close()
+        pool.join()
+    if failed:
+        raise ReportServerError(
+            "{} of {} chunks failed, run again to resume: {}".format(
+                len(failed), len(chunks), "; ".join(
+                    "{:%m/%d/%Y}-{:%m/%d/%Y} ({})".format(c[0], c[1], e)
+                    for c, e in failed)))
+    return list(paths.values())
+
+
+def stitch_exports(paths, out, header_rows=HEADER_ROWS):
+    """Writes the permits of several exports of the report (in order) to one
+    export that looks like the report was run for the whole range."""
+    frames = [pd.read_excel(path, header=None) for path in paths]
+    permits = pd.concat([frames[0]] + [f.iloc[header_rows:]
+                                       for f in frames[1:]])
+    permits.to_excel(out, header=False, index=False)
+    return out
+
+
+def download_years(years, date_to=None, months=1, processes=PROCESSES,
+                   chunk_dir=CHUNK_DIR, client=None, callback=None):
+    """Downloads years of city permits (through date_to, if given) in chunks
+    of months, processes at a time, and stitches each year into
+    data/city_permits/raw/city_<year>.xlsx. Returns the year files.
+    Chunks are deleted once their year is stitched."""
+    if date_to is not None:
+        date_to = as_date(date_to)
+        years = [y for y in years if y <= date_to.year]
+    year_chunks = OrderedDict()
+    for year in years:
+        end = date(year, 12, 31)
+        if date_to is not None:
+            end = min(end, date_to)
+        year_chunks[year] = month_chunks(date(year, 1, 1), end, months)
+    own_client = client is None
+    if own_client:
+        client = ReportClient(session=make_session(pool_size=processes))
+    try:
+        paths = download_chunks(
+            client, [c for chunks in year_chunks.values() for c in chunks],
+            chunk_dir, processes, callback)
+    finally:
+        if own_client:
+            client.close()
+    manifest = ChunkManifest(os.path.join(chunk_dir, "manifest.json"))
+    outs = []
+    for year, chunks in year_chunks.items():
+        year_paths, paths = paths[:len(chunks)], paths[len(chunks):]
+        outs.append(stitch_exports(year_paths, CITY_RAW.format(
+            year, FORMATS["EXCELOPENXML"])))
+        manifest.remove(os.path.basename(p) for p in year_paths)
+        for path in year_paths:
+            os.remove(path)
+    return outs
+
+
+# =============================================================================
+# DELTA DOWNLOADS
+
+def raw_report(year):
+    """The year's raw city report, whichever of process.REPORT_EXTS it was
+    downloaded as (None if there isn't one)."""
+    for ext in process.REPORT_EXTS:
+        path = CITY_RAW.format(year, ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def export_format(path):
+    """The SSRS export format (e.g. 'CSV') of a report file."""
+    ext = os.path.splitext(path)[1].lower()
+    for fmt, fmt_ext in FORMATS.items():
+        if fmt_ext == ext:
+            return fmt
+    raise ValueError("Unknown export format: {}".format(path))
+
+
+def _merge_csv(path, delta, key):
+    """merge_exports for CSV exports: the export at path is streamed to a new
+    file (only delta's permit numbers are kept in memory)."""
+    with open(delta, "r") as f:
+        new = list(csv.reader(f))
+    header = [i for i, row in enumerate(new[:process.SNIFF_ROWS])
+              if key in [process.header_name(v) for v in row]][0]
+    col = [process.header_name(v) for v in new[header]].index(key)
+    new_permits = new[header + 1:]
+    keys = set(row[col] for row in new_permits if len(row) > col)
+    tmp = path + ".merge"
+    with open(path, "r") as src, open(tmp, "w") as dst:
+        writer = csv.writer(dst, lineterminator="\n")
+        for i, row in enumerate(csv.reader(src)):
+            if i > header and len(row) > col and row[col] in keys:
+                continue
+            writer.writerow(row)
+        writer.writerows(new_permits)
+    os.remove(path)
+    os.rename(tmp, path)
+    return len(new_permits)
+
+
+def _merge_xml(path, delta, key):
+    """merge_exports for SSRS XML exports: detail rows are the elements with
+    a key attribute (e.g. Permit_Number)."""
+    def is_permit(elem):
+        return any(process.header_name(a) == key for a in elem.attrib)
+
+    def permit_number(elem):
+        return [v for a, v in elem.attrib.items()
+                if process.header_name(a) == key][0]
+
+    old = process.ET.parse(path)
+    new = process.ET.parse(delta)
+    root = old.getroot()
+    # Keep the report's default namespace rather than 'ns0:' prefixes
+    namespace = re.match(r"{(.*)}", root.tag)
+    if namespace:
+        process.ET.register_namespace("", namespace.group(1))
+    new_parent = [p for p in new.getroot().iter()
+                  if any(is_permit(e) for e in p)]
+    new_permits = [e for p in new_parent for e in p if is_permit(e)]
+    keys = set(permit_number(e) for e in new_permits)
+    parent = None
+    for elem in root.iter():
+        for child in [e for e in elem if is_permit(e)]:
+            parent = elem
+            if permit_number(child) in keys:
+                elem.remove(child)
+    if parent is None and new_parent:
+        # No permits yet: the (empty) collection they go in
+        parent = next(root.iter(new_parent[0].tag), root)
+    for elem in new_permits:
+        parent.append(elem)
+    old.write(path, encoding="utf-8", xml_declaration=True)
+    return len(new_permits)
+
+
+def merge_exports(path, delta, header_rows=HEADER_ROWS, key="permit_number"):
+    """Merges a later export of part of a report's range into the export at
+    path (both .xlsx, .csv, or .xml). Permits in delta replace those with the
+    same permit number (so the overlap isn't duplicated); returns the number
+    of rows in delta. CSV exports are streamed; an .xlsx (a zip) or .xml
+    export is read and written again whole."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return _merge_csv(path, delta, key)
+    if ext == ".xml":
+        return _merge_xml(path, delta, key)
+    old = pd.read_excel(path, header=None)
+    new = pd.read_excel(delta, header=None)
+    # Column names as process.city_permits makes them
+    names = old.iloc[header_rows - 1].astype(str).str.lower().str.replace(
+        " ", "_")
+    col = names[names == key].index[0]
+    old_permits = old.iloc[header_rows:]
+    new_permits = new.iloc[header_rows:]
+    kept = old_permits[~old_permits[col].isin(new_permits[col])]
+    pd.concat([old.iloc[:header_rows], kept, new_permits]).to_excel(
+        path, header=False, index=False)
+    return len(new_permits)
+
+
+def download_delta(year, last_issued, date_to=None, overlap=OVERLAP_DAYS,
+                   chunk_dir=CHUNK_DIR, client=None):
+    """Downloads the permits issued from overlap days before last_issued (the
+    latest permit already loaded) through date_to (default: today) and merges
+    them into the year's raw report (data/city_permits/raw/city_<year>.*),
+    downloaded in the same format. Returns (the year's file, rows
+    downloaded)."""
+    out = raw_report(year)
+    if out is None:
+        raise IOError("No raw city report for {}".format(year))
+    fmt = export_format(out)
+    from_date = max(as_date(last_issued) - timedelta(days=overlap),
+                    date(year, 1, 1))
+    to_date = min(as_date(date_to) if date_to else date.today(),
+                  date(year, 12, 31))
+    delta = os.path.join(chunk_dir, CHUNK_FMT.format(
+        from_date, to_date, FORMATS[fmt]))
+    own_client = client is None
+    if own_client:
+        client = ReportClient()
+    try:
+        client.download_permits(from_date, to_date, delta, fmt)
+    finally:
+        if own_client:
+            client.close()
+    try:
+        n = merge_exports(out, delta)
+    finally:
+        os.remove(delta)
+    return out, n
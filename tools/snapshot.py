@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+snapshot.py -- Database snapshots
+Author: Garin Wally; Oct 2016
+
+Before make_permit_db.py changes anything it writes a dated copy of the
+permits database to the archive/ folder using SQLite's VACUUM INTO (a
+consistent copy, even with the database open). The latest snapshot is kept
+as a plain .sqlite file; older ones are compressed. Restoring a snapshot is
+just decompressing it next to the database and swapping the files, which
+replaces the old '<table>_bk' copies kept inside the database itself. Only
+the latest SNAPSHOT_KEEP snapshots of a database are kept.
+
+Resetting a few tables (e.g. one year) doesn't need the whole file replaced:
+restore_tables ATTACHes a snapshot (the latest as it is, without
+decompressing it) and swaps the tables in with ALTER TABLE ... RENAME. The
+pages of the replaced tables are then returned with bounded incremental
+vacuum steps (see tuning.py) rather than a full VACUUM.
+"""
+
+import gzip
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime as dt
+from glob import glob
+
+from tools import statements
+
+
+# =============================================================================
+# DATA
+
+ARCHIVE_DIR = os.path.abspath(os.path.join(".", "archive"))
+
+# E.g. 'permits_20161019_134501.sqlite' (+ '.gz' once it's not the latest)
+SNAPSHOT_FMT = "{}_{:%Y%m%d_%H%M%S}.sqlite"
+
+# Snapshots kept per database (older ones are removed after a new one)
+SNAPSHOT_KEEP = 10
+
+# gzip level of older snapshots: the fastest, since one is compressed on
+#  every build (the higher levels take several times longer for little gain)
+COMPRESS_LEVEL = 1
+
+# geometry_columns.geometry_type (SpatiaLite 4) without the dimension
+GEOMETRY_TYPES = {
+    0: "GEOMETRY", 1: "POINT", 2: "LINESTRING", 3: "POLYGON",
+    4: "MULTIPOINT", 5: "MULTILINESTRING", 6: "MULTIPOLYGON",
+    7: "GEOMETRYCOLLECTION"
+    }
+
+
+# =============================================================================
+# SNAPSHOTS
+
+def compress_snapshot(path):
+    """Replaces a snapshot with a gzip'd copy; returns the new path."""
+    out = path + ".gz"
+    with open(path, "rb") as src:
+        with gzip.open(out, "wb", compresslevel=COMPRESS_LEVEL) as dst:
+            shutil.copyfileobj(src, dst)
+    os.remove(path)
+    return out
+
+
+def take_snapshot(conn, db, archive_dir=ARCHIVE_DIR, keep=SNAPSHOT_KEEP):
+    """Writes a copy of conn's database to the archive, compresses the
+    snapshots before it, then prunes all but the latest keep snapshots (None
+    keeps them all). db is the path of the database (used to name the
+    snapshot); returns the snapshot's path."""
+    if not os.path.exists(archive_dir):
+        os.makedirs(archive_dir)
+    name = os.path.splitext(os.path.basename(db))[0]
+    out = os.path.join(archive_dir, SNAPSHOT_FMT.format(name, dt.now()))
+    # Not listed as a snapshot until it's complete
+    tmp = out + ".part"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn.cursor().execute("VACUUM INTO ?", (tmp,))
+    os.rename(tmp, out)
+    if keep is not None:
+        prune_snapshots(db, keep, archive_dir)
+    for path in list_snapshots(db, archive_dir)[:-1]:
+        if not path.endswith(".gz"):
+            compress_snapshot(path)
+    return out
+
+
+def list_snapshots(db, archive_dir=ARCHIVE_DIR):
+    """Returns the snapshots of a database, oldest first."""
+    name = os.path.splitext(os.path.basename(db))[0]
+    pattern = re.compile(re.escape(name) + r"_\d{8}_\d{6}\.sqlite(\.gz)?$")
+    return sorted(f for f in glob(os.path.join(archive_dir, name + "_*"))
+                  if pattern.search(os.path.basename(f)))
+
+
+def prune_snapshots(db, keep=SNAPSHOT_KEEP, archive_dir=ARCHIVE_DIR):
+    """Removes all but the latest keep snapshots of a database; returns the
+    paths removed."""
+    snapshots = list_snapshots(db, archive_dir)
+    old = snapshots[:-keep] if keep > 0 else snapshots
+    for path in old:
+        os.remove(path)
+    return old
+
+
+def restore_snapshot(db, snapshot=None, archive_dir=ARCHIVE_DIR):
+    """Replaces a database with one of its snapshots (default: the latest).
+    All connections to the database must be closed first. Returns the path of
+    the snapshot used."""
+    if snapshot is None:
+        snapshots = list_snapshots(db, archive_dir)
+        if not snapshots:
+            raise IOError("No snapshots of {} in {}".format(db, archive_dir))
+        snapshot = snapshots[-1]
+    tmp = db + ".restore"
+    opener = gzip.open if snapshot.endswith(".gz") else open
+    with opener(snapshot, "rb") as src:
+        with open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    # Swap the files; stale WAL/journal files belong to the old database
+    for ext in ("-wal", "-shm", "-journal"):
+        if os.path.exists(db + ext):
+            os.remove(db + ext)
+    if os.path.exists(db):
+        os.remove(db)
+    os.rename(tmp, db)
+    return snapshot
+
+
+# =============================================================================
+# TABLES
+
+def extract_snapshot(snapshot, out_dir=None):
+    """Decompresses a snapshot to a temporary .sqlite file (which the caller
+    removes) so it can be ATTACHed; uncompressed snapshots are used as is."""
+    if not snapshot.endswith(".gz"):
+        return snapshot
+    fd, out = tempfile.mkstemp(suffix=".sqlite", dir=out_dir)
+    os.close(fd)
+    with gzip.open(snapshot, "rb") as src:
+        with open(out, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    return out
+
+
+def _table_info(cur, schema, table):
+    """Returns a table's (geometry_columns row, index SQL) in a schema."""
+    geom = statements.execute(
+        cur, "SELECT f_geometry_column, srid, geometry_type, "
+        "coord_dimension, spatial_index_enabled "
+        "FROM {schema}.geometry_columns WHERE f_table_name = lower(?)",
+        (table,), schema=schema).fetchone()
+    indexes = [r[0] for r in statements.execute(
+        cur, "SELECT sql FROM {schema}.sqlite_master WHERE type = 'index' "
+        "AND tbl_name = ? AND sql IS NOT NULL", (table,),
+        schema=schema).fetchall()]
+    return geom, indexes
+
+
+def geometry_names(geom_type, dims):
+    """Translates SpatiaLite 4's geometry_columns codes (e.g. 4 and 2) into
+    the names RecoverGeometryColumn takes (e.g. 'MULTIPOINT' and 'XY').
+    Names (the older layout) are returned as they are."""
+    if not str(geom_type).isdigit():
+        return geom_type, dims
+    geom_type = int(geom_type)
+    # Thousands: 0 XY, 1 XYZ, 2 XYM, 3 XYZM
+    return (GEOMETRY_TYPES[geom_type % 1000],
+            ("XY", "XYZ", "XYM", "XYZM")[geom_type // 1000])
+
+
+def swap_table(conn, table, source):
+    """Replaces a table with a copy of source (e.g. 'snap.city_res2015').
+    The copy is made under a temporary name -- from source's own CREATE
+    statement, so its keys, constraints, and column types are kept -- and
+    renamed over the old table; its geometry column, spatial index, and
+    indexes are put back the way they are in source (whatever state the old
+    table was in). Run it inside a transaction/savepoint."""
+    cur = conn.cursor()
+    schema, name = source.split(".")
+    old_geom, _ = _table_info(cur, "main", table)
+    geom, indexes = _table_info(cur, schema, name)
+    row = statements.execute(
+        cur, "SELECT sql FROM {schema}.sqlite_master WHERE type = 'table' "
+        "AND name = ?", (name,), schema=schema).fetchone()
+    if row is None:
+        raise ValueError("No such table: {}".format(source))
+    swap = "{}_swap".format(table)
+    statements.execute(cur, "DROP TABLE IF EXISTS {swap}", swap=swap)
+    # Everything after 'CREATE TABLE <name>' -- the snapshot's own SQL, so
+    #  it's run as it is
+    cur.execute(statements.render("CREATE TABLE {swap} ", swap=swap) +
+                row[0][row[0].index("("):])
+    statements.execute(cur, "INSERT INTO {swap} SELECT * FROM {schema}.{name}",
+                       swap=swap, schema=schema, name=name)
+    if old_geom:
+        # Also drops the spatial index and its triggers
+        cur.execute("SELECT DropGeoTable(?)", (table,)).fetchall()
+    statements.execute(cur, "DROP TABLE IF EXISTS {table}", table=table)
+    statements.execute(cur, "ALTER TABLE {swap} RENAME TO {table}",
+                       swap=swap, table=table)
+    if geom:
+        column, srid, geom_type, dims, spatial_index = geom
+        geom_type, dims = geometry_names(geom_type, dims)
+        # Both return 0 (rather than raising) when they fail
+        if not cur.execute("SELECT RecoverGeometryColumn(?, ?, ?, ?, ?)",
+                           (table, column, srid, geom_type,
+                            dims)).fetchall()[0][0]:
+            raise RuntimeError("Couldn't register {}.{} ({} {} {})".format(
+                table, column, srid, geom_type, dims))
+        if spatial_index and not cur.execute(
+                "SELECT CreateSpatialIndex(?, ?)",
+                (table, column)).fetchall()[0][0]:
+            raise RuntimeError("Couldn't index {}.{}".format(table, column))
+    for sql in indexes:
+        cur.execute(sql)
+    return
+
+
+def restore_tables(conn, db, tables, snapshot=None,
+                   archive_dir=ARCHIVE_DIR):
+    """Puts some tables (e.g. one year's permit tables) back the way they are
+    in a snapshot (default: the latest) without replacing the database.
+    Tables are swapped in one transaction; returns the snapshot used."""
+    if snapshot is None:
+        snapshots = list_snapshots(db, archive_dir)
+        if not snapshots:
+            raise IOError("No snapshots of {} in {}".format(db, archive_dir))
+        snapshot = snapshots[-1]
+    path = extract_snapshot(snapshot, os.path.dirname(os.path.abspath(db)))
+    cur = conn.cursor()
+    cur.execute("ATTACH DATABASE ? AS snap", (path,))
+    try:
+        snap_tables = set(r[0] for r in cur.execute(
+            "SELECT name FROM snap.sqlite_master WHERE type = 'table'"))
+        missing = [t for t in tables if t not in snap_tables]
+        if missing:
+            raise ValueError("Not in {}: {}".format(
+                snapshot, ", ".join(missing)))
+        cur.execute("SAVEPOINT restore_tables;")
+        try:
+            for table in tables:
+                swap_table(conn, table, "snap.{}".format(table))
+        except Exception:
+            cur.execute("ROLLBACK TO restore_tables;")
+            raise
+        finally:
+            cur.execute("RELEASE restore_tables;")
+    finally:
+        cur.execute("DETACH DATABASE snap")
+        if path != snapshot:
+            os.remove(path)
+    return snapshot
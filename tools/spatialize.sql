@@ -8,33 +8,43 @@ always confined within the parcel).
 Any permit that is not spatialized, i.e.
 SELECT * FROM <permit_table> WHERE geometry IS NULL;
 will need to be delt with manually. Bummer, I know.
-*/
 
-BEGIN;
+Only rows that have not been spatialized yet (spatialized = 0) are touched, so
+running this again after appending permits only processes the new ones.
+The geometry, condo_project, and flag columns are added by make_permit_db.py.
 
--- Add geometry column
-SELECT AddGeometryColumn('{0}', 'geometry', 2256, 'MULTIPOINT', 'XY');
--- Add a condo_project column
-ALTER TABLE {0} ADD COLUMN condo_project TEXT;
+Results are shared between tables (and builds) through the geocode_cache
+table: permits with a cached geocode/address are given the cached geometry
+before the lookups below are attempted, and everything the lookups find is
+added to the cache.
+*/
 
+-- A savepoint (not BEGIN) so this also runs inside a --fast-build transaction
+SAVEPOINT spatialize;
 
--- Apply overrides to permit table
+-- Apply overrides to permit table (one join on the overrides' primary key)
 UPDATE {0}
-SET 
-    geocode = (
-        SELECT geocode 
-        FROM overrides 
-        WHERE overrides.permit_number = {0}.permit_number),
-    address = (
-        SELECT address 
-        FROM overrides 
-        WHERE overrides.permit_number = {0}.permit_number)
-WHERE permit_number IN (
-    SELECT o.permit_number 
-    FROM overrides o
-    WHERE o.permit_number = {0}.permit_number);
+SET
+	geocode = o.geocode,
+	address = o.address
+FROM overrides o
+WHERE o.permit_number = {0}.permit_number
+	AND {0}.spatialized = 0;
 DELETE FROM {0}
-  WHERE geocode = 'REMOVE';
+  WHERE spatialized = 0 AND geocode = 'REMOVE';
+
+
+-- Reuse results found for the same geocode/address with the same features
+UPDATE {0}
+SET
+	notes = g.method,
+	geometry = g.geometry
+FROM geocode_cache g
+WHERE {0}.spatialized = 0
+	AND {0}.geometry IS NULL
+	AND g.geocode = {0}.geocode
+	AND g.address IS {0}.address
+	AND g.feature_version = (SELECT version FROM geocode_version);
 
 
 -- Join on parcel geocode
@@ -45,7 +55,7 @@ SET
 		SELECT ST_Multi(PointOnSurface(geometry))
 		FROM ufda_parcels u
 		WHERE u.parcelid={0}.geocode)
-WHERE geometry IS NULL;
+WHERE spatialized = 0 AND geometry IS NULL;
 
 
 -- Join on full address (exact match)
@@ -58,7 +68,7 @@ SET
 		SELECT ST_Multi(geometry)
 		FROM ufda_addrs a
 		WHERE a.fulladdress={0}.address)
-WHERE geometry IS NULL;
+WHERE spatialized = 0 AND geometry IS NULL;
 
 
 -- Join on address geocode
@@ -73,7 +83,7 @@ SET
 		SELECT ST_Multi(geometry)
 		FROM ufda_addrs a
 		WHERE a.parcelid={0}.geocode)
-WHERE geometry IS NULL;
+WHERE spatialized = 0 AND geometry IS NULL;
 
 /*
 UPDATE {0} SET geometry = (
@@ -108,9 +118,20 @@ WHERE geometry IS NULL;
 --		SELECT permit_number FROM {0});
 
 
-SELECT CreateSpatialIndex('{0}', 'geometry');
+-- Cache what was found for the next table/build
+INSERT OR IGNORE INTO geocode_cache
+	SELECT geocode, address, (SELECT version FROM geocode_version),
+		notes, geometry
+	FROM {0}
+	WHERE spatialized = 0 AND geometry IS NOT NULL;
+
+
+-- Mark the processed rows, spatialized or not, as done
+UPDATE {0}
+SET spatialized = 1
+WHERE spatialized = 0;
 
-COMMIT;
+RELEASE spatialize;
 
 	
 /* MISC left-over code I don't just want to throw away
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+sqlscript.py -- SQL script runner
+Author: Garin Wally; Oct 2016
+
+Runs the tools/*.sql scripts one statement at a time (instead of as one big
+cur.execute) so each statement can be timed, and optionally audited with
+EXPLAIN QUERY PLAN for full table scans and correlated subqueries that don't
+use an index. The report shows which statement of a script is hot without
+having to edit the SQL.
+
+Usage:
+    python -m tools.sqlscript permits.sqlite tools/density.sql city_res2015 \
+2015 --explain
+"""
+
+import argparse
+import re
+import time
+
+import dslw
+
+from tools import statements
+
+
+# =============================================================================
+# DATA
+
+# Plan details that read a whole table, e.g. 'SCAN city_res2015' or (older
+#  SQLite) 'SCAN TABLE city_res2015'
+SCAN = re.compile(r"^SCAN (TABLE )?(?P<table>\S+)")
+# ...unless they use an index (incl. an R-tree's) or aren't tables
+INDEXED = re.compile(r"USING|VIRTUAL TABLE INDEX|^SCAN (CONSTANT ROW|"
+                     r"SUBQUERY|\()")
+CORRELATED = re.compile(r"CORRELATED (SCALAR|LIST) SUBQUERY")
+
+# Statements that EXPLAIN can't/needn't look at
+NO_PLAN = re.compile(r"(?is)^\s*(SAVEPOINT|RELEASE|BEGIN|COMMIT|ROLLBACK|"
+                     r"PRAGMA|ATTACH|DETACH|DROP)\b")
+
+
+# =============================================================================
+# SPLITTING
+
+def split_statements(sql):
+    """Splits a script into its statements.
+    Semicolons inside strings, comments, and triggers are left alone (a piece
+    only ends a statement once SQLite says it's complete). Returns a list of
+    (line number, statement) tuples."""
+    statements = []
+    buf = ""
+    line = 1
+    for piece in sql.split(";"):
+        buf += piece + ";"
+        if not dslw.apsw.complete(buf):
+            continue
+        stmt = buf.strip()
+        # Pieces that are only comments/whitespace aren't statements
+        if strip_comments(stmt).strip(" \t\r\n;"):
+            start = line + buf[:len(buf) - len(buf.lstrip())].count("\n")
+            statements.append((start, stmt))
+        line += buf.count("\n")
+        buf = ""
+    return statements
+
+
+def strip_comments(sql):
+    """Removes -- and /* */ comments (good enough for deciding if there's
+    anything left to run; not used on the statements themselves)."""
+    sql = re.sub(r"(?s)/\*.*?\*/", "", sql)
+    return re.sub(r"--[^\n]*", "", sql)
+
+
+# =============================================================================
+# AUDIT
+
+def explain(cur, stmt):
+    """Returns the EXPLAIN QUERY PLAN rows (id, parent, detail) of a
+    statement, or [] if it can't be explained."""
+    if NO_PLAN.match(strip_comments(stmt)):
+        return []
+    try:
+        rows = cur.execute("EXPLAIN QUERY PLAN " + stmt).fetchall()
+    except dslw.apsw.SQLError:
+        # E.g. it uses a table an earlier statement hasn't made yet
+        return []
+    return [(r[0], r[1], r[-1]) for r in rows]
+
+
+def full_scan(detail):
+    """Returns the table a plan detail scans in full (or None)."""
+    match = SCAN.match(detail)
+    if not match or INDEXED.search(detail):
+        return None
+    return match.group("table")
+
+
+def audit_plan(plan):
+    """Flags full table scans and correlated subqueries that scan a table
+    (i.e. run a full scan for every outer row). Returns a list of strings."""
+    flags = []
+    children = {}
+    for node_id, parent, detail in plan:
+        children.setdefault(parent, []).append((node_id, detail))
+
+    def scans_below(node_id):
+        found = []
+        for child_id, detail in children.get(node_id, []):
+            if full_scan(detail):
+                found.append(full_scan(detail))
+            found.extend(scans_below(child_id))
+        return found
+
+    correlated_scans = set()
+    for node_id, _, detail in plan:
+        if CORRELATED.search(detail):
+            tables = scans_below(node_id)
+            for table in tables:
+                flags.append("unindexed correlated subquery on {}".format(
+                    table))
+            correlated_scans.update(tables)
+    for _, _, detail in plan:
+        table = full_scan(detail)
+        if table and table not in correlated_scans:
+            flags.append("full scan of {}".format(table))
+    return flags
+
+
+# =============================================================================
+# RUNNING
+
+class StatementResult(object):
+    """Timing (and plan) of one statement of a script."""
+    def __init__(self, line, sql, seconds, changes, plan=None):
+        self.line = line
+        self.sql = sql
+        self.seconds = seconds
+        self.changes = changes
+        self.plan = plan or []
+        self.flags = audit_plan(self.plan)
+
+    def __repr__(self):
+        return "<StatementResult line {}: {:.3f}s>".format(
+            self.line, self.seconds)
+
+    @property
+    def summary(self):
+        """The statement's first line of code."""
+        for line in strip_comments(self.sql).splitlines():
+            if line.strip():
+                return line.strip()
+        return ""
+
+
+def run_script(conn, script, *args, **kwargs):
+    """Runs a .sql script one statement at a time.
+    The script is formatted with args (e.g. the permit table), which must be
+    identifiers (see statements.check_identifier); pass explain=True to get
+    each statement's query plan (before it runs). Returns a list of StatementResults."""
+    explain_plans = kwargs.get("explain", False)
+    cur = conn.cursor()
+    sql = open(script, "r").read()
+    if args:
+        sql = sql.format(*[statements.check_identifier(a) for a in args])
+    results = []
+    for line, stmt in split_statements(sql):
+        plan = explain(cur, stmt) if explain_plans else None
+        start = time.time()
+        cur.execute(stmt).fetchall()
+        seconds = time.time() - start
+        results.append(
+            StatementResult(line, stmt, seconds, conn.changes(), plan))
+    return results
+
+
+def format_report(results, title="", top=None):
+    """Returns a text report of a script's statements, slowest first."""
+    total = sum(r.seconds for r in results) or 1.0
+    lines = []
+    if title:
+        lines += [title, "=" * len(title)]
+    lines.append("{:>6} {:>9} {:>6} {:>8}  {}".format(
+        "line", "seconds", "%", "changes", "statement"))
+    ranked = sorted(results, key=lambda r: r.seconds, reverse=True)
+    for result in ranked[:top]:
+        lines.append("{:>6} {:>9.3f} {:>6.1f} {:>8}  {}".format(
+            result.line, result.seconds, 100 * result.seconds / total,
+            result.changes, result.summary[:60]))
+        for flag in result.flags:
+            lines.append("{}! {}".format(" " * 34, flag))
+    lines.append("{:>6} {:>9.3f}".format("total", sum(
+        r.seconds for r in results)))
+    return "\n".join(lines) + "\n"
+
+
+def write_report(results, path, title=""):
+    """Writes format_report to a file."""
+    with open(path, "w") as f:
+        f.write(format_report(results, title))
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="sqlscript.py")
+    parser.add_argument("db", help="SQLite/SpatiaLite database")
+    parser.add_argument("script", help=".sql script to run")
+    parser.add_argument("args", nargs="*",
+                        help="Values for the script's {0}, {1}, ...")
+    parser.add_argument("--explain", action="store_true", default=False,
+                        help="Audit each statement's EXPLAIN QUERY PLAN")
+    parser.add_argument("--top", type=int, default=None,
+                        help="Only show the slowest N statements")
+    cli = parser.parse_args()
+    conn = dslw.SpatialDB(cli.db, verbose=False)
+    print(format_report(
+        run_script(conn, cli.script, *cli.args, explain=cli.explain),
+        cli.script, cli.top))
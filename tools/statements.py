@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+statements.py -- Statement templates
+Author: Garin Wally; Oct 2016
+
+Table names can't be bound as parameters, so they used to be spliced into SQL
+with str.format() -- along with the values, which made every statement's text
+(and so SQLite's prepared statement) different. Templates keep the two apart:
+
+    {name} fields are identifiers (table/column names), or lists of them
+        (rendered as 'a, b, c'). They are checked once and the rendered SQL
+        is cached per connection (an LRU), so a loop gets the same SQL text
+        every time and the connection's own statement cache (apsw's, not
+        this module's) reuses the prepared statement.
+    ? / :name parameters are values, bound by SQLite. That includes the
+        table names passed to SpatiaLite functions, e.g. DropGeoTable(?).
+
+    >>> execute(conn, "UPDATE {table} SET geometry = ? WHERE geocode = ?",
+    ...         (geom, geocode), table="city_res2015")
+"""
+
+import re
+import weakref
+from collections import OrderedDict
+
+
+# =============================================================================
+# DATA
+
+# Table/column names, or parts of them (e.g. the '2015_cnty' suffix)
+IDENTIFIER = re.compile(r"^[A-Za-z0-9_]+$")
+
+CACHE_SIZE = 128
+
+
+# =============================================================================
+# IDENTIFIERS
+
+def check_identifier(name):
+    """Returns name if it's safe to put in SQL as an identifier; raises a
+    ValueError otherwise."""
+    name = u"{}".format(name)
+    if not IDENTIFIER.match(name):
+        raise ValueError("Not a valid identifier: {!r}".format(name))
+    return name
+
+
+def render(template, **identifiers):
+    """Fills a template's {name} fields with checked identifiers (lists and
+    tuples of them are joined with ', ')."""
+    fields = {}
+    for key, value in identifiers.items():
+        if isinstance(value, (list, tuple)):
+            fields[key] = ", ".join(check_identifier(v) for v in value)
+        else:
+            fields[key] = check_identifier(value)
+    return template.format(**fields)
+
+
+# =============================================================================
+# CACHE
+
+class StatementCache(object):
+    """LRU of rendered templates (SQL text, not prepared statements) for one
+    connection."""
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.statements = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.statements)
+
+    def sql(self, template, **identifiers):
+        """Returns the SQL of a template for the given identifiers."""
+        key = (template, tuple(sorted(
+            (k, tuple(v) if isinstance(v, list) else v)
+            for k, v in identifiers.items())))
+        if key in self.statements:
+            self.hits += 1
+            sql = self.statements.pop(key)
+        else:
+            self.misses += 1
+            sql = render(template, **identifiers)
+            if len(self.statements) >= self.size:
+                # Drop the least recently used
+                self.statements.popitem(last=False)
+        self.statements[key] = sql
+        return sql
+
+
+# Caches are dropped along with their connections
+_CACHES = weakref.WeakKeyDictionary()
+
+
+def _connection(source):
+    """Returns (connection, cursor) for a connection or one of its cursors."""
+    if hasattr(source, "getconnection"):
+        return source.getconnection(), source
+    return source, source.cursor()
+
+
+def get_cache(conn):
+    """Returns a connection's StatementCache."""
+    if conn not in _CACHES:
+        _CACHES[conn] = StatementCache()
+    return _CACHES[conn]
+
+
+def sql(conn, template, **identifiers):
+    """Returns the (cached) SQL of a template."""
+    return get_cache(conn).sql(template, **identifiers)
+
+
+def execute(conn, template, bindings=None, **identifiers):
+    """Executes a template with its values bound; returns the cursor.
+    conn can also be a cursor, which the template is then executed on."""
+    conn, cur = _connection(conn)
+    return cur.execute(sql(conn, template, **identifiers), bindings)
+
+
+def executemany(conn, template, sequence, **identifiers):
+    """Executes one prepared template for every set of values in sequence
+    (conn can also be a cursor)."""
+    conn, cur = _connection(conn)
+    return cur.executemany(sql(conn, template, **identifiers), sequence)
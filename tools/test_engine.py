@@ -0,0 +1,214 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import dslw
+
+from tools import engine
+from tools import geomstore
+from tools import permit_tables
+
+
+# Features: two parcels, a condo parcel, and address points
+FEATURES = """
+CREATE TABLE ufda_parcels (parcelid TEXT, geocode TEXT);
+SELECT AddGeometryColumn('ufda_parcels', 'geometry', 2256, 'MULTIPOLYGON',
+    'XY');
+INSERT INTO ufda_parcels VALUES ('001', '001', GeomFromText(
+    'MULTIPOLYGON(((0 0, 100 0, 100 100, 0 100, 0 0)))', 2256));
+INSERT INTO ufda_parcels VALUES ('002', '002', GeomFromText(
+    'MULTIPOLYGON(((100 0, 300 0, 300 100, 100 100, 100 0)))', 2256));
+INSERT INTO ufda_parcels VALUES ('003', '003', GeomFromText(
+    'MULTIPOLYGON(((0 100, 100 100, 100 300, 0 300, 0 100)))', 2256));
+SELECT CreateSpatialIndex('ufda_parcels', 'geometry');
+
+CREATE TABLE ufda_addrs (parcelid TEXT, fulladdress TEXT);
+SELECT AddGeometryColumn('ufda_addrs', 'geometry', 2256, 'POINT', 'XY');
+INSERT INTO ufda_addrs VALUES ('002', '1 MAIN ST',
+    GeomFromText('POINT(150 50)', 2256));
+INSERT INTO ufda_addrs VALUES ('999', '9 FAR AWAY RD',
+    GeomFromText('POINT(5000 5000)', 2256));
+SELECT CreateSpatialIndex('ufda_addrs', 'geometry');
+
+CREATE TABLE condos_dis (name TEXT);
+SELECT AddGeometryColumn('condos_dis', 'geometry', 2256, 'MULTIPOLYGON',
+    'XY');
+INSERT INTO condos_dis VALUES ('CONDO A', GeomFromText(
+    'MULTIPOLYGON(((0 100, 100 100, 100 300, 0 300, 0 100)))', 2256));
+SELECT CreateSpatialIndex('condos_dis', 'geometry');
+
+CREATE TABLE overrides (permit_number TEXT PRIMARY KEY, address TEXT,
+    geocode TEXT);
+INSERT INTO overrides VALUES ('P-5', '', 'REMOVE');
+INSERT INTO overrides VALUES ('P-6', '1 MAIN ST', 'X');
+"""
+
+# One permit for each way of being spatialized (or not)
+PERMITS = [
+    ("P-1", "001", "10 FIRST ST", 1),  # parcel geocode
+    ("P-2", "X", "1 MAIN ST", 2),  # full address
+    ("P-3", "003", "3 CONDO LN", 4),  # condo, two rows
+    ("P-3", "003", "3 CONDO LN", 4),
+    ("P-4", "999", "NOWHERE", 1),  # address parcelid, no parcel
+    ("P-5", "001", "5 GONE ST", 1),  # removed by override
+    ("P-6", "777", "6 WRONG ST", 3),  # fixed by override
+    ("P-7", "888", "7 LOST ST", 1)  # not found
+    ]
+
+
+class TestEngineParity(unittest.TestCase):
+    """The Shapely engine gives the same results as the SQL scripts."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conn = dslw.SpatialDB(
+            os.path.join(self.tmp, "permits.sqlite"), verbose=False)
+        self.cur = self.conn.cursor()
+        self.cur.execute(FEATURES).fetchall()
+        permit_tables.init_geocode_cache(self.cur)
+        for table in ("sql_res2099", "eng_res2099"):
+            self.cur.execute(
+                "CREATE TABLE {} (permit_number TEXT, geocode TEXT, "
+                "address TEXT, dwellings INTEGER, notes TEXT)".format(table))
+            self.cur.executemany(
+                "INSERT INTO {} (permit_number, geocode, address, dwellings) "
+                "VALUES (?, ?, ?, ?)".format(table), PERMITS)
+            permit_tables.prep_permit_table(self.cur, table)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def run_sql(self):
+        self.cur.execute(open("tools/spatialize.sql", "r").read().format(
+            "sql_res2099")).fetchall()
+        self.cur.execute(open("tools/density.sql", "r").read().format(
+            "sql_res2099", "2099_sql")).fetchall()
+
+    def run_engine(self, store_dir=None):
+        spatial_engine = engine.SpatialEngine(self.conn, store_dir)
+        spatial_engine.spatialize("eng_res2099")
+        spatial_engine.density("eng_res2099", "2099_eng")
+
+    def select(self, sql, bindings=None):
+        return self.cur.execute(sql, bindings).fetchall()
+
+    def test_spatialize(self):
+        self.run_sql()
+        # Empty the cache so the engine runs the full cascade too
+        self.cur.execute("DELETE FROM geocode_cache")
+        self.run_engine()
+        qry = ("SELECT permit_number, geocode, address, notes, "
+               "AsText(geometry), spatialized FROM {} "
+               "ORDER BY permit_number, ROWID")
+        expected = self.select(qry.format("sql_res2099"))
+        self.assertEqual(self.select(qry.format("eng_res2099")), expected)
+        self.assertEqual(len(expected), len(PERMITS) - 1)
+
+    def test_cache(self):
+        self.run_sql()
+        # Every resolved geocode/address pair is cached by the SQL path
+        self.run_engine()
+        qry = ("SELECT permit_number, notes, AsText(geometry) FROM {} "
+               "ORDER BY permit_number, ROWID")
+        self.assertEqual(self.select(qry.format("eng_res2099")),
+                         self.select(qry.format("sql_res2099")))
+
+    def test_density(self):
+        self.run_sql()
+        self.run_engine()
+        qry = ("SELECT permit_number, geocode, sum_dwellings, acres, duac, "
+               "condo_proj, AsText(geometry) FROM density{} "
+               "ORDER BY permit_number")
+        expected = self.select(qry.format("2099_sql"))
+        result = self.select(qry.format("2099_eng"))
+        self.assertEqual([r[0] for r in expected],
+                         ["P-1", "P-2", "P-3", "P-6"])
+        self.assertEqual(len(result), len(expected))
+        for got, want in zip(result, expected):
+            self.assertEqual(got[:3] + got[4:], want[:3] + want[4:])
+            self.assertAlmostEqual(got[3], want[3])
+
+    def test_th_dev(self):
+        self.run_sql()
+        self.run_engine()
+        qry = "SELECT name, sum_dwellings, acres, proj_duac FROM th_dev{}"
+        self.assertEqual(self.select(qry.format("2099_eng")),
+                         self.select(qry.format("2099_sql")))
+        qry = ("SELECT permit_number, condo_proj FROM permit_condo "
+               "WHERE permit_table = ? ORDER BY permit_number")
+        self.assertEqual(self.select(qry, ("eng_res2099",)),
+                         self.select(qry, ("sql_res2099",)))
+
+    def test_geomstore(self):
+        store_dir = os.path.join(self.tmp, "geomstore")
+        for feature, columns in engine.LAYERS.items():
+            permit_tables.bump_feature_version(self.cur, feature, "a")
+            geomstore.write_store(self.conn, feature, columns, "a", store_dir)
+        store = geomstore.open_store("ufda_addrs", "a", store_dir)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(list(store.query_bbox(0, 0, 200, 200)), [0])
+        # Features from another source (or an unknown one) aren't used
+        self.assertIsNone(geomstore.open_store("ufda_addrs", "b", store_dir))
+        self.assertIsNone(geomstore.open_store("ufda_addrs", None, store_dir))
+        self.run_sql()
+        self.cur.execute("DELETE FROM geocode_cache")
+        self.run_engine(store_dir)
+        qry = ("SELECT permit_number, notes, AsText(geometry) FROM {} "
+               "ORDER BY permit_number, ROWID")
+        self.assertEqual(self.select(qry.format("eng_res2099")),
+                         self.select(qry.format("sql_res2099")))
+
+    def test_lazy_layers(self):
+        """Stored geometries are only parsed when a query needs them."""
+        store_dir = os.path.join(self.tmp, "geomstore")
+        for feature, columns in engine.LAYERS.items():
+            permit_tables.bump_feature_version(self.cur, feature, "a")
+            geomstore.write_store(self.conn, feature, columns, "a", store_dir)
+        spatial_engine = engine.SpatialEngine(self.conn, store_dir)
+        parcels = spatial_engine.parcels
+        self.assertFalse(parcels.parsed.any())
+        points = engine.shapely.points([[150, 50]])
+        self.assertEqual(parcels.query(points).tolist(), [[0], [1]])
+        # Only parcel 002's bounding box holds the point
+        self.assertEqual(parcels.parsed.tolist(), [False, True, False])
+
+    def test_overrides(self):
+        path = os.path.join(self.tmp, "overrides.txt")
+        with open(path, "w") as f:
+            f.write("P-6, 9 OTHER ST, X\n\nP-5, , REMOVE\n"
+                    "P-6, 1 MAIN ST, X\n")
+        self.assertEqual(permit_tables.load_overrides(self.conn, path), 2)
+        self.assertEqual(self.select(
+            "SELECT address FROM overrides WHERE permit_number = 'P-6'"),
+            [("1 MAIN ST",)])
+        with open(path, "a") as f:
+            f.write("P-8, 8 BAD LINE\n")
+        with self.assertRaises(ValueError):
+            permit_tables.load_overrides(self.conn, path)
+
+    def test_append(self):
+        self.run_sql()
+        path = os.path.join(self.tmp, "city_res2099.csv")
+        with open(path, "w") as f:
+            f.write("permit_number,geocode,address,dwellings\n")
+            for permit in PERMITS + [("P-8", "002", "8 NEW ST", 1)]:
+                f.write(",".join(str(v) for v in permit) + "\n")
+        qry = "SELECT permit_number FROM sql_res2099 ORDER BY permit_number"
+        before = self.select(qry)
+        # Overridden (P-6) and removed (P-5) permits aren't added again
+        self.assertEqual(
+            permit_tables.append_permits(self.conn, "sql_res2099", path), 1)
+        self.assertEqual(
+            permit_tables.append_permits(self.conn, "sql_res2099", path), 0)
+        self.assertEqual(self.select(qry), sorted(before + [("P-8",)]))
+
+    def test_flags(self):
+        self.run_engine()
+        for flag in ("spatialized", "densified"):
+            self.assertEqual(
+                permit_tables.count_pending(self.cur, "eng_res2099", flag), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,215 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import dslw
+
+from tools import permit_db_utils
+from tools import permit_tables
+from tools import snapshot
+from tools import tuning
+from tools.test_engine import FEATURES
+
+
+PERMITS = [
+    # On parcel 002 instead of its own (001)
+    ("P-1", "001", "10 FIRST ST", "MULTIPOINT(250 50)"),
+    ("P-2", "002", "1 MAIN ST", "MULTIPOINT(150 50)"),
+    # Address point and parcel from it
+    ("P-3", "888", "1 MAIN ST", None),
+    # Parcel only
+    ("P-4", "003", "3 CONDO LN", None),
+    ("P-5", "777", "NOWHERE", None)
+    ]
+
+
+class TestRepairs(unittest.TestCase):
+    """The set-based repairs fix (and count) the right permits."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conn = dslw.SpatialDB(
+            os.path.join(self.tmp, "permits.sqlite"), verbose=False)
+        self.cur = self.conn.cursor()
+        self.cur.execute(FEATURES).fetchall()
+        self.cur.execute("CREATE TABLE city_res2099 (permit_number TEXT, "
+                         "geocode TEXT, address TEXT, notes TEXT)")
+        permit_tables.prep_permit_table(self.cur, "city_res2099")
+        self.cur.executemany(
+            "INSERT INTO city_res2099 (permit_number, geocode, address, "
+            "geometry) VALUES (?, ?, ?, GeomFromText(?, 2256))", PERMITS)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_repair_table(self):
+        counts = permit_db_utils.repair_table(self.conn, "city_res2099")
+        self.assertEqual(list(counts.items()), [
+            ("correct_misplaced", 1), ("correct_invalid_geoms", 0),
+            ("correct_null_geoms", 1), ("get_parcel_geom", 1)])
+        rows = self.cur.execute(
+            "SELECT permit_number, geocode, "
+            "  Contains(GeomFromText('POLYGON((0 0, 100 0, 100 100, 0 100, "
+            "    0 0))', 2256), geometry), AsText(geometry) "
+            "FROM city_res2099 ORDER BY permit_number").fetchall()
+        self.assertEqual(rows[0][:3], ("P-1", "001", 1))
+        self.assertEqual(rows[2][:2], ("P-3", "002"))
+        self.assertEqual(rows[2][3], "MULTIPOINT(150 50)")
+        self.assertIsNotNone(rows[3][3])
+        self.assertIsNone(rows[4][3])
+
+    def test_repeat(self):
+        permit_db_utils.repair_table(self.conn, "city_res2099")
+        counts = permit_db_utils.repair_table(self.conn, "city_res2099")
+        self.assertEqual(sum(counts.values()), 0)
+
+
+class TestResetTables(unittest.TestCase):
+    """One table is put back from a snapshot without touching the others."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmp, "permits.sqlite")
+        self.archive = os.path.join(self.tmp, "archive")
+        conn = dslw.SpatialDB(self.db, verbose=False)
+        cur = conn.cursor()
+        tuning.enable_incremental_vacuum(cur)
+        cur.execute("VACUUM;")
+        for table in ("city_res2098", "city_res2099"):
+            cur.execute("CREATE TABLE {} (permit_number TEXT PRIMARY KEY, "
+                        "geocode TEXT, address TEXT, notes TEXT)".format(
+                            table))
+            permit_tables.prep_permit_table(cur, table)
+            cur.executemany(
+                "INSERT INTO {} (permit_number, geocode, address, geometry) "
+                "VALUES (?, ?, ?, GeomFromText(?, 2256))".format(table),
+                PERMITS)
+        self.snapshot = snapshot.take_snapshot(conn, self.db, self.archive)
+        cur.execute("UPDATE city_res2098 SET geometry = NULL")
+        cur.execute("DELETE FROM city_res2099")
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_reset_tables(self):
+        permit_db_utils.reset_tables(["city_res2099"], self.db, self.snapshot)
+        conn = dslw.SpatialDB(self.db, verbose=False)
+        cur = conn.cursor()
+        self.assertEqual(cur.execute(
+            "SELECT COUNT(*), COUNT(geometry) FROM city_res2099").fetchone(),
+            (5, 2))
+        # Geometry column, key, and indexes are back
+        self.assertEqual(cur.execute(
+            "SELECT srid, geometry_type, coord_dimension FROM "
+            "geometry_columns WHERE f_table_name = 'city_res2099'"
+            ).fetchone(), (2256, 4, 2))
+        with self.assertRaises(dslw.apsw.ConstraintError):
+            cur.execute("INSERT INTO city_res2099 (permit_number) "
+                        "VALUES ('P-1')")
+        indexes = [r[0] for r in cur.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertIn("idx_city_res2099_permit_number", indexes)
+        self.assertEqual(cur.execute(
+            "SELECT COUNT(geometry) FROM city_res2098").fetchone(), (0,))
+        self.assertEqual(tuning.get_pragma(cur, "freelist_count"), 0)
+        conn.close()
+
+    def test_missing_table(self):
+        # Restoring a table that's gone from the database entirely
+        conn = dslw.SpatialDB(self.db, verbose=False)
+        conn.cursor().execute("SELECT DropGeoTable('city_res2099')")
+        conn.close()
+        permit_db_utils.reset_tables(["city_res2099"], self.db, self.snapshot)
+        conn = dslw.SpatialDB(self.db, verbose=False)
+        cur = conn.cursor()
+        self.assertEqual(cur.execute(
+            "SELECT srid FROM geometry_columns "
+            "WHERE f_table_name = 'city_res2099'").fetchone(), (2256,))
+        indexes = [r[0] for r in cur.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertIn("idx_city_res2099_permit_number", indexes)
+        conn.close()
+
+    def test_compress(self):
+        # Only the latest snapshot is left uncompressed (and ATTACHed as is)
+        conn = dslw.SpatialDB(self.db, verbose=False)
+        time.sleep(1)
+        latest = snapshot.take_snapshot(conn, self.db, self.archive)
+        conn.close()
+        self.assertEqual(snapshot.list_snapshots(self.db, self.archive),
+                         [self.snapshot + ".gz", latest])
+
+
+class TestPruneSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_prune(self):
+        names = ["permits_2016101{}_120000.sqlite.gz".format(i)
+                 for i in range(5)] + ["other_20161010_120000.sqlite.gz"]
+        for name in names:
+            open(os.path.join(self.tmp, name), "w").close()
+        removed = snapshot.prune_snapshots("permits.sqlite", 2, self.tmp)
+        self.assertEqual([os.path.basename(p) for p in removed], names[:3])
+        self.assertEqual(sorted(os.listdir(self.tmp)), sorted(names[3:]))
+
+
+class TestGeometryNames(unittest.TestCase):
+    def test_geometry_names(self):
+        self.assertEqual(snapshot.geometry_names(4, 2), ("MULTIPOINT", "XY"))
+        self.assertEqual(snapshot.geometry_names(1003, 3),
+                         ("POLYGON", "XYZ"))
+        self.assertEqual(snapshot.geometry_names("MULTIPOINT", "XY"),
+                         ("MULTIPOINT", "XY"))
+
+
+class TestPragmaSql(unittest.TestCase):
+    def test_pragma_sql(self):
+        self.assertEqual(tuning.pragma_sql("cache_size", -2000),
+                         "PRAGMA cache_size = -2000;")
+        self.assertEqual(tuning.pragma_sql("journal_mode", "WAL"),
+                         "PRAGMA journal_mode = WAL;")
+        self.assertEqual(tuning.pragma_sql("auto_vacuum"),
+                         "PRAGMA auto_vacuum;")
+        with self.assertRaises(ValueError):
+            tuning.pragma_sql("journal_mode", "WAL; DROP TABLE overrides")
+
+
+class TestStageTransaction(unittest.TestCase):
+    """A failed stage is rolled back and the build's settings put back."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conn = dslw.SpatialDB(
+            os.path.join(self.tmp, "permits.sqlite"), verbose=False)
+        self.cur = self.conn.cursor()
+        self.cur.execute("CREATE TABLE t (a INTEGER)")
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with tuning.pragmas(self.cur, [("cache_size", -4096)]):
+                with tuning.stage_transaction(self.cur):
+                    self.cur.execute("INSERT INTO t VALUES (1)")
+                    raise RuntimeError("stage failed")
+        self.assertTrue(self.conn.getautocommit())
+        self.assertEqual(
+            self.cur.execute("SELECT COUNT(*) FROM t").fetchone()[0], 0)
+        self.assertEqual(tuning.get_pragma(self.cur, "cache_size"), -2000)
+
+    def test_commit(self):
+        with tuning.stage_transaction(self.cur):
+            self.cur.execute("INSERT INTO t VALUES (1)")
+        self.assertEqual(
+            self.cur.execute("SELECT COUNT(*) FROM t").fetchone()[0], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import dslw
+
+from tools import buildlog
+from tools import pipeline
+
+
+def write_file(path, text):
+    """A picklable stage function for the worker pool."""
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def copy_file(src, dst):
+    """Stands in for processing a raw report into a csv."""
+    with open(src) as f:
+        write_file(dst, f.read())
+
+
+class TestPipeline(unittest.TestCase):
+    """Only stale stages run, in dependency order."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conn = dslw.SpatialDB(
+            os.path.join(self.tmp, "permits.sqlite"), verbose=False)
+        self.cur = self.conn.cursor()
+        self.script = os.path.join(self.tmp, "density.sql")
+        write_file(self.script, "-- v1")
+        self.report = os.path.join(self.tmp, "report.txt")
+        write_file(self.report, "1,2")
+        self.csv = os.path.join(self.tmp, "permits.csv")
+        self.calls = []
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def make(self):
+        build = pipeline.Pipeline(self.conn)
+
+        def load(rebuild=False):
+            self.calls.append(("load", rebuild))
+            if "permits" in self.conn.get_tables() and not rebuild:
+                return
+            self.cur.execute("CREATE TABLE IF NOT EXISTS permits (n)")
+            self.cur.execute("DELETE FROM permits")
+            with open(self.csv) as f:
+                self.cur.executemany("INSERT INTO permits VALUES (?)",
+                                     [(n,) for n in f.read().split(",")])
+
+        def density(rebuild=False):
+            self.calls.append(("density", rebuild))
+            self.cur.execute("CREATE TABLE IF NOT EXISTS density (n)")
+
+        build.add(pipeline.Stage("process", copy_file, [self.report, self.csv],
+                                 inputs=[self.report], files=[self.csv],
+                                 parallel=True))
+        build.add(pipeline.Stage("load", load, inputs=[self.csv],
+                                 tables=["permits"], deps=["process"]))
+        build.add(pipeline.Stage("density", density, inputs=[self.script],
+                                 tables=["density"], deps=["load"]))
+        return build
+
+    def test_first_build(self):
+        build = self.make()
+        self.assertEqual([s.name for s, _, _ in build.plan()],
+                         ["process", "load", "density"])
+        self.assertEqual(build.run(processes=1),
+                         ["process", "load", "density"])
+        self.assertTrue(os.path.exists(self.csv))
+        self.assertEqual(self.make().plan(), [])
+
+    def test_script_change(self):
+        self.make().run(processes=1)
+        write_file(self.script, "-- v2")
+        self.calls = []
+        build = self.make()
+        self.assertEqual([(s.name, r) for s, _, r in build.plan()],
+                         [("density", True)])
+        build.run()
+        self.assertEqual(self.calls, [("density", True)])
+
+    def test_report_change(self):
+        self.make().run(processes=1)
+        write_file(self.report, "1,2,3")
+        self.calls = []
+        build = self.make()
+        # The csv hasn't been rewritten yet when the plan is made...
+        self.assertEqual([(s.name, r) for s, _, r in build.plan()],
+                         [("process", True), ("load", False),
+                          ("density", False)])
+        build.run(processes=1)
+        # ...but it has by the time the load starts
+        self.assertEqual(self.calls, [("load", True), ("density", False)])
+        self.assertEqual(self.cur.execute(
+            "SELECT n FROM permits").fetchall(), [("1",), ("2",), ("3",)])
+        self.assertEqual(self.make().plan(), [])
+
+    def test_missing_output(self):
+        self.make().run(processes=1)
+        self.cur.execute("DROP TABLE permits")
+        self.calls = []
+        self.make().run()
+        # Downstream stages run incrementally
+        self.assertEqual(self.calls, [("load", True), ("density", False)])
+
+    def test_build_steps(self):
+        run_id = buildlog.start_run(self.cur)
+        profile_dir = os.path.join(self.tmp, "profiles")
+        self.make().run(processes=1, run_id=run_id, profile_dir=profile_dir)
+        buildlog.finish_run(self.cur, run_id)
+        rows = self.cur.execute(
+            "SELECT stage, wall_s >= 0, cpu_s >= 0, rows_out, profile, "
+            "rss_growth_kb >= 0 AND rss_growth_kb <= peak_rss_kb "
+            "FROM build_steps WHERE run_id = ? ORDER BY ROWID",
+            (run_id,)).fetchall()
+        self.assertEqual([r[0] for r in rows], ["process", "load", "density"])
+        self.assertTrue(all(r[1] and r[2] for r in rows))
+        # Workers don't touch the database
+        self.assertIsNone(rows[0][3])
+        for row in rows:
+            self.assertTrue(os.path.exists(row[4]))
+            if buildlog.resource:
+                self.assertTrue(row[5])
+
+    def test_unknown_dep(self):
+        build = pipeline.Pipeline(self.conn)
+        with self.assertRaises(ValueError):
+            build.add(pipeline.Stage("density", len, deps=["load"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
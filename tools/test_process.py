@@ -0,0 +1,311 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import pandas as pd
+
+from tools import process
+
+
+# The layout of the city's report: title rows, then the column names
+ROWS = [["New Construction Report", None, None, None, None, None, None,
+         None],
+        [None] * 8,
+        ["Issued between", "01/01/2099", None, None, None, None, None, None],
+        [None] * 8,
+        ["Permit Number", "Permit Issued Date", None, "Address", "Geocode",
+         "Number of Dwellings", "Construction Type", "Subtype"],
+        ["P-1", "01/05/2099", None, "1 MAIN ST", "0422", "1",
+         "Residential Construction", "BNSFR - New Single Family Residence"],
+        ["P-2", "02/10/2099", None, "2 MAIN ST", "0423", "2",
+         "Residential Construction", "BNRDX - New Duplex"]]
+
+XML = ('<?xml version="1.0" encoding="utf-8"?>'
+       '<Report xmlns="New_x0020_Construction_x0020_Report" '
+       'Textbox1="New Construction Report">'
+       '<Tablix1 Textbox5="Issued between"><Details_Collection>'
+       '<Details Permit_Number="P-1" Permit_Issued_Date="01/05/2099" '
+       'Address="1 MAIN ST" Geocode="0422" Number_of_Dwellings="1" '
+       'Construction_Type="Residential Construction" '
+       'Subtype="BNSFR - New Single Family Residence" />'
+       '<Details Permit_Number="P-2" Permit_Issued_Date="02/10/2099" '
+       'Address="2 MAIN ST" Geocode="0423" Number_of_Dwellings="2" '
+       'Construction_Type="Residential Construction" '
+       'Subtype="BNRDX - New Duplex" />'
+       '</Details_Collection></Tablix1></Report>')
+
+
+class TestReadReport(unittest.TestCase):
+    """Every export format reads to the same permits."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def check(self, path):
+        df = process.read_report(path, "city")
+        self.assertEqual(list(df.columns), [
+            "permit_number", "permit_issued_date", "address", "geocode",
+            "dwellings", "construction_type", "permit_type"])
+        self.assertEqual(df[["permit_number", "geocode", "dwellings"]].values
+                         .tolist(), [["P-1", "0422", "1"],
+                                     ["P-2", "0423", "2"]])
+
+    def test_xlsx(self):
+        path = os.path.join(self.tmp, "city_2099.xlsx")
+        pd.DataFrame(ROWS).to_excel(path, header=False, index=False)
+        self.check(path)
+
+    def test_csv(self):
+        path = os.path.join(self.tmp, "city_2099.csv")
+        pd.DataFrame(ROWS).to_csv(path, header=False, index=False)
+        self.check(path)
+
+    def test_xml(self):
+        path = os.path.join(self.tmp, "city_2099.xml")
+        with open(path, "w") as f:
+            f.write(XML)
+        self.check(path)
+
+    def test_no_header(self):
+        path = os.path.join(self.tmp, "city_2099.csv")
+        pd.DataFrame(ROWS[:4]).to_csv(path, header=False, index=False)
+        with self.assertRaises(ValueError):
+            process.read_report(path)
+
+
+class TestSniffFormat(unittest.TestCase):
+    """The layouts of the reports in data/ are told apart."""
+    def test_formats(self):
+        for path, name, header in [
+                ("data/city_permits/raw/city_2015.xlsx", "accela", 4),
+                ("data/county_permits/raw/cnty_2015_1.xlsx",
+                 "odyssey_v1", 0),
+                ("data/county_permits/raw/cnty_2015_2.xlsx",
+                 "odyssey_v2", 1)]:
+            found, fmt, i = process.sniff_format(path)
+            self.assertEqual((found, i), (name, header))
+
+    def test_system(self):
+        with self.assertRaises(ValueError):
+            process.read_report("data/county_permits/raw/cnty_2015_1.xlsx",
+                                "city")
+
+    def test_county(self):
+        df = process.read_report("data/county_permits/raw/cnty_2015_2.xlsx",
+                                 "county")
+        for col in ("permit_number", "geocode", "permit_issued_date",
+                    "address", "permit_type", "description", "city"):
+            self.assertIn(col, df.columns)
+        self.assertEqual(df["permit_number"].iloc[0], "MB15020006")
+
+
+class TestDependencies(unittest.TestCase):
+    def test_no_yaml(self):
+        yaml, process.yaml = process.yaml, None
+        try:
+            with self.assertRaises(ImportError) as err:
+                process.load_formats()
+        finally:
+            process.yaml = yaml
+        self.assertIn("pyyaml", str(err.exception))
+
+
+class TestMergePermits(unittest.TestCase):
+    def test_merge(self):
+        columns = process.ORDERED_COLUMNS
+        parts = [
+            pd.DataFrame([["MB-2", "0422", "2099-03-01", "2 MAIN ST", 1,
+                           "New Construction", "NEW SFR", "MISSOULA"],
+                          ["MB-1", "0423", "2099-01-05", "1 MAIN ST", 1,
+                           "New Construction", "NEW SFR", "MISSOULA"]],
+                         columns=columns),
+            # MB-2 again, updated in the later part
+            pd.DataFrame([["MB-2", "0422", "2099-03-02", "2 MAIN ST", 2,
+                           "New Construction", "DUPLEX", "MISSOULA"],
+                          ["MB-3", "0424", "2099-02-10", "3 MAIN ST", 1,
+                           "New Construction", "NEW SFR", "BONNER"]],
+                         columns=columns)]
+        merged = process.merge_permits(parts)
+        self.assertEqual(list(merged.columns), columns)
+        self.assertEqual(list(merged["permit_number"]),
+                         ["MB-1", "MB-3", "MB-2"])
+        self.assertEqual(merged["dwellings"].iloc[-1], 2)
+
+    def test_part_order(self):
+        """Parts merge in number order, so part 10 wins over part 2."""
+        paths = ["cnty_2099_10.xlsx", "cnty_2099_2.xlsx", "cnty_2099_1.xlsx"]
+        self.assertEqual(sorted(paths, key=process.part_number),
+                         ["cnty_2099_1.xlsx", "cnty_2099_2.xlsx",
+                          "cnty_2099_10.xlsx"])
+        self.assertEqual(process.part_number("cnty_2099.xlsx"), 0)
+        tmp = tempfile.mkdtemp()
+        try:
+            part_csvs = []
+            for part, dwellings in [(10, 3), (2, 2)]:
+                part_csvs.append(os.path.join(
+                    tmp, "cnty_2099_{}.csv".format(part)))
+                pd.DataFrame(
+                    [["MB-2", "0422", "2099-03-01", "2 MAIN ST", dwellings,
+                      "New Construction", "NEW SFR", "MISSOULA"]],
+                    columns=process.ORDERED_COLUMNS).to_csv(
+                        part_csvs[-1], index=False)
+            merged = process.merge_parts(None, part_csvs)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.assertEqual(list(merged["dwellings"]), [3])
+
+
+class TestChunks(unittest.TestCase):
+    """Chunked reading/grouping gives the same results as all at once."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_iter_report(self):
+        path = "data/city_permits/raw/city_2015.xlsx"
+        full = process.read_report(path, "city")
+        chunks = list(process.iter_report(path, "city", chunksize=100))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(len(c) <= 100 for c in chunks))
+        chunked = pd.concat(chunks, ignore_index=True)[full.columns]
+        self.assertEqual(len(chunked), len(full))
+        for col in ("permit_number", "geocode", "address", "dwellings"):
+            self.assertEqual(chunked[col].fillna("").tolist(),
+                             full[col].fillna("").tolist())
+        self.assertTrue(pd.to_datetime(chunked["permit_issued_date"]).equals(
+            pd.to_datetime(full["permit_issued_date"])))
+
+    def test_empty_columns(self):
+        rows = [list(r) for r in ROWS]
+        rows[4][2] = "Description"
+        path = os.path.join(self.tmp, "city_2099.csv")
+        pd.DataFrame(rows).to_csv(path, header=False, index=False)
+        empty = set()
+        chunks = list(process.iter_report(path, "city", 1, empty=empty))
+        self.assertEqual(empty, set(["description"]))
+        self.assertEqual(
+            [c for c in chunks[0].columns if c not in empty],
+            list(process.read_report(path, "city").columns))
+
+    def test_empty_report(self):
+        for ext in (".csv", ".xlsx"):
+            path = os.path.join(self.tmp, "city_2099" + ext)
+            write = getattr(pd.DataFrame(ROWS[:5]), "to_" + ext[1:].replace(
+                "xlsx", "excel"))
+            write(path, header=False, index=False)
+            chunks = list(process.iter_report(path, "city", 10))
+            self.assertEqual(len(chunks), 1)
+            self.assertEqual(len(chunks[0]), 0)
+            self.assertIn("permit_issued_date", chunks[0].columns)
+        permits = process.city_permits(path, out=False, chunksize=10)
+        self.assertEqual(len(permits), 0)
+        out_fmt = os.path.join(self.tmp, "city_res{}.csv")
+        process.write_years(permits, ["2099"], out_fmt)
+        self.assertIn("permit_number", pd.read_csv(out_fmt.format(2099)))
+
+    def test_first_reducer(self):
+        keys, order = ["permit_number", "geocode"], ["address"]
+        df = pd.DataFrame(
+            [["P-1", "01", "2 MAIN ST", None, "a"],
+             ["P-1", "01", "1 MAIN ST", None, None],
+             ["P-2", "02", "5 MAIN ST", 3, "b"],
+             ["P-1", "01", "1 MAIN ST", 2, "c"],
+             ["P-1", "03", "9 MAIN ST", 1, None],
+             ["P-2", "02", "4 MAIN ST", None, None],
+             [None, "04", "7 MAIN ST", 1, "d"]],
+            columns=keys + ["address", "dwellings", "description"])
+        expected = df.sort_values(keys + order, kind="mergesort").groupby(
+            keys).first().reset_index()
+        for size in (1, 2, 3, 7):
+            reducer = process.FirstReducer(keys, order)
+            for start in range(0, len(df), size):
+                reducer.add(df.iloc[start:start + size])
+            result = reducer.result()
+            self.assertEqual(result.fillna("").values.tolist(),
+                             expected.fillna("").values.tolist())
+        self.assertEqual(
+            list(process.FirstReducer(keys, order).result().columns), keys)
+
+    def test_city_permits(self):
+        """A real export gives the same permits read whole or in chunks."""
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                            "data", "city_permits", "raw", "city_2015.xlsx")
+        whole = process.city_permits(path, out=False)
+        chunked = process.city_permits(path, out=False, chunksize=50)
+        self.assertEqual(len(whole), 250)
+        self.assertEqual(list(whole.columns), list(chunked.columns))
+        self.assertEqual(whole.fillna("").values.tolist(),
+                         chunked.fillna("").values.tolist())
+
+
+class TestWriteYears(unittest.TestCase):
+    """A report only writes (all of) the years it's named for."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_write_years(self):
+        self.assertEqual(process.report_years("raw/city_2097-2099.xlsx"),
+                         ["2097", "2098", "2099"])
+        permits = pd.DataFrame({
+            "permit_number": ["P-1", "P-2", "P-3"],
+            "permit_issued_date": pd.to_datetime(
+                ["2096-12-30", "2097-01-05", "2099-02-10"])})
+        out_fmt = os.path.join(self.tmp, "city_res{}.csv")
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            paths = process.write_years(
+                permits, ["2097", "2098", "2099"], out_fmt)
+        self.assertEqual(len(caught), 1)
+        self.assertEqual([os.path.basename(p) for p in paths], [
+            "city_res2097.csv", "city_res2098.csv", "city_res2099.csv"])
+        self.assertEqual(
+            [list(pd.read_csv(p)["permit_number"]) for p in paths],
+            [["P-2"], [], ["P-3"]])
+
+
+class TestReportOwners(unittest.TestCase):
+    """Each year is processed from one report when reports overlap."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def touch(self, name, mtime):
+        path = os.path.join(self.tmp, name)
+        open(path, "w").close()
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_overlap(self):
+        multi = self.touch("city_2097-2099.csv", 300)
+        old = self.touch("city_2098.xlsx", 100)
+        new = self.touch("city_2098.csv", 200)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            owners = process.report_owners([multi, old, new])
+        self.assertEqual(owners, [(multi, ["2097", "2099"]),
+                                  (new, ["2098"])])
+        self.assertEqual(len(caught), 2)
+
+    def test_latest_exports(self):
+        old = self.touch("cnty_2098.xlsx", 100)
+        new = self.touch("cnty_2098.csv", 200)
+        part = self.touch("cnty_2099_1.xlsx", 100)
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter("always")
+            self.assertEqual(process.latest_exports([old, new, part]),
+                             sorted([new, part]))
+
+
+if __name__ == "__main__":
+    unittest.main()
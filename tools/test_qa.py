@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import dslw
+
+from tools import permit_db_utils
+from tools import permit_tables
+from tools import qa
+from tools.test_engine import FEATURES, PERMITS
+
+
+class TestMatchStats(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conn = dslw.SpatialDB(
+            os.path.join(self.tmp, "permits.sqlite"), verbose=False)
+        self.cur = self.conn.cursor()
+        self.cur.execute(FEATURES).fetchall()
+        permit_tables.init_geocode_cache(self.cur)
+        for table in ("city_res2099", "cnty_res2099"):
+            self.cur.execute(
+                "CREATE TABLE {} (permit_number TEXT, geocode TEXT, "
+                "address TEXT, dwellings INTEGER, notes TEXT)".format(table))
+            self.cur.executemany(
+                "INSERT INTO {} (permit_number, geocode, address, dwellings) "
+                "VALUES (?, ?, ?, ?)".format(table), PERMITS)
+            permit_tables.prep_permit_table(self.cur, table)
+            self.cur.execute(open("tools/spatialize.sql", "r").read().format(
+                table)).fetchall()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_match_stats(self):
+        stats = dict((s[0], s[1:]) for s in qa.match_stats(
+            self.conn, "city_res2099"))
+        # P-5 was removed by its override
+        self.assertEqual(stats["geocode"], (7, 3, 3 / 7.0))
+        self.assertEqual(stats["fulladdr"][1], 2)
+        self.assertEqual(stats["a.parcelid"][1], 1)
+        self.assertEqual(stats["unmatched"][1], 1)
+        self.assertEqual(stats["parcel_join"][1], 3)
+        self.assertEqual(stats["addr_join"][1], 2)
+
+    def test_matches_parcels(self):
+        self.assertEqual(
+            permit_db_utils.matches_parcels(self.conn, "city_res2099"),
+            (3 / 7.0, "3/7"))
+
+    def test_record(self):
+        for table in ("city_res2099", "cnty_res2099"):
+            qa.record_stats(self.conn, table, run_id=1)
+        self.assertEqual(self.cur.execute(
+            "SELECT permits, matched, rate FROM qa_match_years "
+            "WHERE year = '2099' AND method = 'unmatched'").fetchall(),
+            [(14, 2, 2 / 14.0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
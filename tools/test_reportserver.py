@@ -0,0 +1,249 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import date
+
+import pandas as pd
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import unquote
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib import unquote
+
+from tools import process
+from tools import reportserver
+
+
+# Stands in for an .xlsx export (a zip file)
+EXPORT = b"PK\x03\x04" + b"permits" * 20000
+
+XLSX_TYPE = ("application/vnd.openxmlformats-officedocument."
+             "spreadsheetml.sheet")
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """A report server that renders exports, fails a few renders first if
+    asked to, and answers bad parameters with an error page."""
+    def do_GET(self):
+        server = self.server
+        query = unquote(self.path)
+        server.requests.append(query)
+        if server.failures or any(d in query for d in server.failing):
+            server.failures = max(server.failures - 1, 0)
+            self.send_response(503)
+            self.end_headers()
+            return
+        if server.export:
+            body = server.export(query)
+            self.send_response(200)
+            self.send_header("Content-Type", XLSX_TYPE)
+        elif "StartDate=bad" in query:
+            body = b"<html>The value provided for StartDate is not valid"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+        else:
+            body = EXPORT
+            self.send_response(200)
+            self.send_header("Content-Type", XLSX_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInTest(unittest.TestCase):
+    """Runs a stand-in report server for each test."""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.httpd = HTTPServer(("127.0.0.1", 0), StandIn)
+        self.httpd.requests = []
+        self.httpd.failures = 0
+        self.httpd.failing = []
+        self.httpd.export = None
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        server = "http://127.0.0.1:{}/ReportServer".format(
+            self.httpd.server_address[1])
+        self.client = reportserver.ReportClient(
+            server, reportserver.make_session(backoff=0), timeout=(5, 5))
+
+    def tearDown(self):
+        self.client.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+class TestReportClient(StandInTest):
+    def test_download(self):
+        out = os.path.join(self.tmp, "raw", "city_2099.xlsx")
+        self.client.download_permits("01/01/2099", "12/31/2099", out)
+        with open(out, "rb") as f:
+            self.assertEqual(f.read(), EXPORT)
+        self.assertEqual(self.httpd.requests, [
+            "/ReportServer?/Land/Statistics/New Construction Report"
+            "&rs:Command=Render&rs:Format=EXCELOPENXML"
+            "&StartDate=01/01/2099&EndDate=12/31/2099"])
+
+    def test_retries(self):
+        self.httpd.failures = 2
+        out = os.path.join(self.tmp, "city_2099.xlsx")
+        self.client.download_permits("01/01/2099", "12/31/2099", out)
+        self.assertEqual(len(self.httpd.requests), 3)
+        self.assertTrue(os.path.exists(out))
+
+    def test_error_page(self):
+        out = os.path.join(self.tmp, "city_2099.xlsx")
+        with self.assertRaises(reportserver.ReportServerError):
+            self.client.download_permits("bad", "12/31/2099", out)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+
+def make_export(permits, out=None):
+    """Writes an export with the report's heading rows and a list of
+    (permit_number, issued, address); returns its bytes if out isn't given."""
+    rows = [["New Construction Report", None, None], [None] * 3,
+            ["Issued between", None, None], [None] * 3,
+            ["Permit Number", "Permit Issued Date", "Address"]]
+    rows.extend(list(p) for p in permits)
+    buf = out or io.BytesIO()
+    pd.DataFrame(rows).to_excel(buf, header=False, index=False)
+    return None if out else buf.getvalue()
+
+
+def month_export(query):
+    """An export of one permit, issued on the StartDate of the query."""
+    start = query.split("StartDate=")[1].split("&")[0]
+    return make_export([("P-" + start, start, "1 MAIN ST")])
+
+
+class TestChunks(StandInTest):
+    def setUp(self):
+        StandInTest.setUp(self)
+        self.httpd.export = month_export
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        StandInTest.tearDown(self)
+
+    def test_month_chunks(self):
+        chunks = reportserver.month_chunks("11/15/2098", "03/10/2099", 2)
+        self.assertEqual(chunks, [
+            (date(2098, 11, 15), date(2098, 12, 31)),
+            (date(2099, 1, 1), date(2099, 2, 28)),
+            (date(2099, 3, 1), date(2099, 3, 10))])
+
+    def test_resume(self):
+        self.httpd.failing = ["StartDate=03/01/2099"]
+        with self.assertRaises(reportserver.ReportServerError):
+            reportserver.download_years(
+                [2099], processes=3, client=self.client)
+        with open(os.path.join(reportserver.CHUNK_DIR,
+                               "manifest.json")) as f:
+            self.assertEqual(len(json.load(f)), 11)
+        # Only the failed month is downloaded again
+        self.httpd.failing = []
+        self.httpd.requests = []
+        outs = reportserver.download_years(
+            [2099], processes=3, client=self.client)
+        self.assertEqual(len(self.httpd.requests), 1)
+        self.assertEqual(outs, ["data/city_permits/raw/city_2099.xlsx"])
+        permits = pd.read_excel(outs[0], header=None)
+        self.assertEqual(len(permits), reportserver.HEADER_ROWS + 12)
+        self.assertEqual(permits.iloc[-1, 0], "P-12/01/2099")
+        self.assertEqual(os.listdir(reportserver.CHUNK_DIR),
+                         ["manifest.json"])
+
+
+class TestDelta(StandInTest):
+    def setUp(self):
+        StandInTest.setUp(self)
+        self.httpd.export = lambda query: make_export([
+            ("P-2", "10/10/2099", "2 MAIN ST"),
+            ("P-3", "10/12/2099", "3 MAIN ST")])
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+        os.makedirs("data/city_permits/raw")
+        make_export([("P-1", "01/05/2099", "1 MAIN ST"),
+                     ("P-2", "10/10/2099", "TBD")],
+                    "data/city_permits/raw/city_2099.xlsx")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        StandInTest.tearDown(self)
+
+    def test_delta(self):
+        out, n = reportserver.download_delta(
+            2099, date(2099, 10, 10), "10/19/2099", client=self.client)
+        self.assertEqual(n, 2)
+        self.assertEqual(self.httpd.requests[0].split("&")[-2:], [
+            "StartDate=10/03/2099", "EndDate=10/19/2099"])
+        permits = pd.read_excel(out, header=None).iloc[
+            reportserver.HEADER_ROWS:]
+        self.assertEqual(list(permits[0]), ["P-1", "P-2", "P-3"])
+        self.assertEqual(list(permits[2]),
+                         ["1 MAIN ST", "2 MAIN ST", "3 MAIN ST"])
+        self.assertEqual(os.listdir(reportserver.CHUNK_DIR), [])
+
+    def test_delta_csv(self):
+        """A year downloaded as CSV gets a CSV delta, merged in place."""
+        os.remove("data/city_permits/raw/city_2099.xlsx")
+        with open("data/city_permits/raw/city_2099.csv", "w") as f:
+            f.write("Permit Number,Permit Issued Date,Address\n"
+                    "P-1,01/05/2099,1 MAIN ST\nP-2,10/10/2099,TBD\n")
+        self.httpd.export = lambda query: (
+            b"Permit Number,Permit Issued Date,Address\n"
+            b"P-2,10/10/2099,2 MAIN ST\nP-3,10/12/2099,3 MAIN ST\n")
+        out, n = reportserver.download_delta(
+            2099, date(2099, 10, 10), "10/19/2099", client=self.client)
+        self.assertEqual(out, "data/city_permits/raw/city_2099.csv")
+        self.assertEqual(n, 2)
+        self.assertIn("rs:Format=CSV", self.httpd.requests[0])
+        permits = pd.read_csv(out)
+        self.assertEqual(list(permits["Permit Number"]), ["P-1", "P-2", "P-3"])
+        self.assertEqual(list(permits["Address"]),
+                         ["1 MAIN ST", "2 MAIN ST", "3 MAIN ST"])
+
+    def test_delta_xml(self):
+        os.remove("data/city_permits/raw/city_2099.xlsx")
+        xml = ('<?xml version="1.0" encoding="utf-8"?>'
+               '<Report xmlns="New_x0020_Construction_x0020_Report">'
+               '<Tablix1><Details_Collection>{}</Details_Collection>'
+               '</Tablix1></Report>')
+        row = '<Details Permit_Number="{}" Address="{}" />'
+        with open("data/city_permits/raw/city_2099.xml", "w") as f:
+            f.write(xml.format(row.format("P-1", "1 MAIN ST") +
+                               row.format("P-2", "TBD")))
+        self.httpd.export = lambda query: xml.format(
+            row.format("P-2", "2 MAIN ST") +
+            row.format("P-3", "3 MAIN ST")).encode("utf-8")
+        out, n = reportserver.download_delta(
+            2099, date(2099, 10, 10), "10/19/2099", client=self.client)
+        self.assertEqual(n, 2)
+        permits = process.read_xml(out)
+        self.assertEqual(list(permits["Permit_Number"]), ["P-1", "P-2", "P-3"])
+        self.assertEqual(list(permits["Address"]),
+                         ["1 MAIN ST", "2 MAIN ST", "3 MAIN ST"])
+
+    def test_no_raw_report(self):
+        os.remove("data/city_permits/raw/city_2099.xlsx")
+        self.assertIsNone(reportserver.raw_report(2099))
+        with self.assertRaises(IOError):
+            reportserver.download_delta(2099, date(2099, 10, 10),
+                                        client=self.client)
+
+
+if __name__ == "__main__":
+    unittest.main()
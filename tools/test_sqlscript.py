@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import dslw
+
+from tools import sqlscript
+
+
+SCRIPT = """/* A test script; with a semicolon in the comment
+*/
+CREATE TABLE permits (permit_number TEXT, geocode TEXT);
+CREATE TABLE parcels (geocode TEXT, acres REAL);
+-- Strings can have semicolons too
+INSERT INTO permits VALUES ('P-1;', '001');
+INSERT INTO parcels VALUES ('001', 1.5);
+SELECT * FROM {0};
+UPDATE permits SET geocode = (
+    SELECT geocode FROM parcels WHERE parcels.geocode = permits.geocode);
+"""
+
+
+class TestSqlScript(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conn = dslw.SpatialDB(
+            os.path.join(self.tmp, "test.sqlite"), verbose=False)
+        self.script = os.path.join(self.tmp, "test.sql")
+        with open(self.script, "w") as f:
+            f.write(SCRIPT)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_split(self):
+        statements = sqlscript.split_statements(SCRIPT.format("permits"))
+        self.assertEqual([line for line, _ in statements],
+                         [1, 4, 5, 7, 8, 9])
+        self.assertIn("'P-1;'", statements[2][1])
+
+    def test_run(self):
+        results = sqlscript.run_script(self.conn, self.script, "permits")
+        self.assertEqual(len(results), 6)
+        # Statements after the SELECT still run
+        self.assertEqual(self.conn.cursor().execute(
+            "SELECT geocode FROM permits").fetchall(), [("001",)])
+        report = sqlscript.format_report(results, "test.sql")
+        self.assertIn("UPDATE permits SET geocode = (", report)
+
+    def test_explain(self):
+        results = sqlscript.run_script(self.conn, self.script, "permits",
+                                       explain=True)
+        self.assertIn("unindexed correlated subquery on parcels",
+                      results[-1].flags)
+        self.conn.cursor().execute(
+            "CREATE INDEX idx_parcels_geocode ON parcels (geocode)")
+        with open(self.script, "w") as f:
+            f.write(SCRIPT.split(";", 7)[-1])
+        results = sqlscript.run_script(self.conn, self.script, explain=True)
+        self.assertEqual(results[-1].flags, ["full scan of permits"])
+
+
+if __name__ == "__main__":
+    unittest.main()
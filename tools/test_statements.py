@@ -0,0 +1,47 @@
+import unittest
+
+from tools import statements
+
+
+class TestStatements(unittest.TestCase):
+    def test_identifiers(self):
+        self.assertEqual(statements.check_identifier("city_res2015"),
+                         "city_res2015")
+        self.assertEqual(statements.check_identifier("2015_cnty"),
+                         "2015_cnty")
+        for bad in ("city_res2015; DROP TABLE x", "a b", "'x'", ""):
+            with self.assertRaises(ValueError):
+                statements.check_identifier(bad)
+
+    def test_render(self):
+        self.assertEqual(
+            statements.render("UPDATE {table} SET geometry = ?",
+                              table="cnty_res2015"),
+            "UPDATE cnty_res2015 SET geometry = ?")
+        self.assertEqual(
+            statements.render("SELECT {cols} FROM {table}",
+                              cols=["permit_number", "geocode"], table="a"),
+            "SELECT permit_number, geocode FROM a")
+        with self.assertRaises(ValueError):
+            statements.render("SELECT {cols} FROM a", cols=["x", "y; --"])
+
+    def test_lru(self):
+        cache = statements.StatementCache(size=2)
+        template = "SELECT * FROM {table} WHERE geocode = ?"
+        first = cache.sql(template, table="a")
+        self.assertIs(cache.sql(template, table="a"), first)
+        cache.sql(template, table="b")
+        cache.sql(template, table="c")
+        # 'a' was the least recently used
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        cache.sql(template, table="a")
+        self.assertEqual(cache.misses, 4)
+        # Lists of identifiers are cached too
+        template = "SELECT {cols} FROM a"
+        self.assertIs(cache.sql(template, cols=["x", "y"]),
+                      cache.sql(template, cols=["x", "y"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+tuning.py -- SQLite settings for fast database builds
+Author: Garin Wally; Oct 2016
+
+A full build of permits.sqlite is a long series of small writes. With
+--fast-build, make_permit_db.py swaps in the PRAGMAs below for the length of
+the build (no fsyncs, a big page cache, temp tables in memory), runs each stage
+in a single transaction, and then ANALYZEs the database and puts the original
+settings back. A stage that fails is rolled back, and the settings are put
+back however the build ends.
+
+The trade-off: a crash part-way through a fast build can corrupt the
+database, so it should only be used when there's a snapshot to go back to.
+
+The database is also switched to auto_vacuum=INCREMENTAL, so the pages freed by
+dropping or resetting a table can be given back a bounded number at a time
+instead of by a VACUUM that rewrites the whole file.
+"""
+
+import numbers
+from contextlib import contextmanager
+
+from tools import statements
+
+
+# =============================================================================
+# DATA
+
+FAST_PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "OFF"),
+    ("cache_size", -1048576),  # KiB, i.e. 1 GB
+    ("temp_store", "MEMORY"),
+    ("mmap_size", 1073741824)  # bytes
+    ]
+
+
+# =============================================================================
+# UTILITIES
+
+def pragma_sql(name, value=None):
+    """Returns the SQL that reads (or, given a value, sets) a PRAGMA.
+    PRAGMA values can't be bound, so they must be numbers or keywords such
+    as 'WAL' (checked like identifiers)."""
+    if value is None:
+        return statements.render("PRAGMA {name};", name=name)
+    if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+        return statements.render(
+            "PRAGMA {name} = ", name=name) + "{:d};".format(value)
+    return statements.render("PRAGMA {name} = {value};",
+                             name=name, value=value)
+
+
+def get_pragma(cur, name):
+    """Returns the current value of a PRAGMA."""
+    row = cur.execute(pragma_sql(name)).fetchone()
+    return row[0] if row else None
+
+
+def set_pragmas(cur, pragmas):
+    """Sets a list of (name, value) PRAGMAs and returns the previous values
+    in the same form (for restore_pragmas)."""
+    previous = [(name, get_pragma(cur, name)) for name, _ in pragmas]
+    for name, value in pragmas:
+        cur.execute(pragma_sql(name, value)).fetchall()
+    return previous
+
+
+def restore_pragmas(cur, previous):
+    """Puts back the settings returned by set_pragmas."""
+    # Undo in reverse, e.g. leave WAL mode last
+    for name, value in reversed(previous):
+        if value is not None:
+            cur.execute(pragma_sql(name, value)).fetchall()
+    return
+
+
+@contextmanager
+def pragmas(cur, settings):
+    """Sets a list of (name, value) PRAGMAs for the length of a with block and
+    puts the previous values back when it ends, even on an exception."""
+    previous = set_pragmas(cur, settings)
+    try:
+        yield previous
+    finally:
+        restore_pragmas(cur, previous)
+
+
+@contextmanager
+def stage_transaction(cur, enabled=True):
+    """Runs a with block (a build stage) in one transaction if enabled:
+    committed when the block finishes, rolled back if it raises."""
+    if not enabled:
+        yield
+        return
+    cur.execute("BEGIN;")
+    try:
+        yield
+    except Exception:
+        # SQLite rolls back by itself after some errors (e.g. SQLITE_FULL)
+        if not cur.getconnection().getautocommit():
+            cur.execute("ROLLBACK;")
+        raise
+    cur.execute("COMMIT;")
+
+
+# =============================================================================
+# INCREMENTAL VACUUM
+
+def enable_incremental_vacuum(cur):
+    """Switches the database to auto_vacuum=INCREMENTAL.
+    Takes effect at the next VACUUM (a database can only change to/from
+    auto_vacuum=NONE by being rebuilt); returns True if one is needed."""
+    if get_pragma(cur, "auto_vacuum") == 2:
+        return False
+    cur.execute("PRAGMA auto_vacuum = INCREMENTAL;").fetchall()
+    return True
+
+
+def incremental_vacuum(cur, max_pages=None, step=1000):
+    """Returns free pages to the OS a step at a time (instead of rewriting the
+    whole file with VACUUM), stopping after max_pages if given. Only works on
+    auto_vacuum=INCREMENTAL databases. Returns the number of pages freed."""
+    if get_pragma(cur, "auto_vacuum") != 2:
+        return 0
+    freed = 0
+    while True:
+        free = get_pragma(cur, "freelist_count")
+        if not free or (max_pages is not None and freed >= max_pages):
+            break
+        n = min(step, free)
+        if max_pages is not None:
+            n = min(n, max_pages - freed)
+        cur.execute("PRAGMA incremental_vacuum({:d});".format(
+            int(n))).fetchall()
+        done = free - get_pragma(cur, "freelist_count")
+        if not done:
+            break
+        freed += done
+    return freed